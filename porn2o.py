@@ -23,18 +23,34 @@ import re
 import statistics
 import time
 import json
+import math
+import struct
+import zlib
+import gzip
 import hashlib
+import heapq
 import secrets
+import contextlib
+import contextvars
+import functools
+import itertools
+import threading
+import traceback
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Any, Callable, Dict, Iterator, List, MutableMapping, Optional, Tuple
+from typing import Any, Callable, Deque, Dict, Iterator, List, MutableMapping, NamedTuple, Optional, Sequence, Tuple
 import requests
 import logging
 import ctypes
+from array import array
 
 from telethon import TelegramClient, events, Button
-from telethon.utils import get_peer_id
-from telethon.errors import FloodWaitError
+from telethon.utils import get_input_peer, get_peer_id
+from telethon.errors import FloodWaitError, MultiError
+from telethon.errors.rpcerrorlist import BotResponseTimeoutError
+from telethon.tl import types as tl_types
+from telethon.tl.functions.messages import GetBotCallbackAnswerRequest, SendMessageRequest
 from rich.console import Console
 from rich.panel import Panel
 from rich.style import Style
@@ -75,6 +91,17 @@ QTY_PRE_DELAY=1.0
 RETRIES_MAX=3
 RETRIES_BASE=0.15
 RETRIES_JITTER=0.05
+METRICS_PORT=0
+PAY_CURRENCIES=USDT,LTC
+PIPELINE_QTY=false
+RECORD_DIALOGS=false
+ADAPTIVE_START=false
+START_INTERVAL_MIN=0.3
+START_INTERVAL_MAX=5.0
+SEND_RATE=10.0
+SEND_BURST=5.0
+ATTEMPT_TIMEOUT=45.0
+BATCH_SEND=false
 """
 
 
@@ -159,10 +186,21 @@ class AppConfig:
     start_interval: float = 1.5
     qty_pre_delay: float = 1.0
     retries: RetriesConfig = field(default_factory=RetriesConfig)
+    metrics_port: int = 0
+    pay_currencies: str = "USDT,LTC"
+    pipeline_qty: bool = False
+    record_dialogs: bool = False
+    adaptive_start: bool = False
+    start_interval_min: float = 0.3
+    start_interval_max: float = 5.0
+    send_rate: float = 10.0
+    send_burst: float = 5.0
+    attempt_timeout: float = 45.0
+    batch_send: bool = False
 
 
 class ConfigAdapter(MutableMapping[str, Any]):
-    __slots__ = ("_config",)
+    __slots__ = ("_config", "version")
 
     _SUPPORTED_KEYS = {
         "api_id": "api_id",
@@ -176,10 +214,23 @@ class ConfigAdapter(MutableMapping[str, Any]):
         "start_interval": "start_interval",
         "qty_pre_delay": "qty_pre_delay",
         "retries": "retries",
+        "metrics_port": "metrics_port",
+        "pay_currencies": "pay_currencies",
+        "pipeline_qty": "pipeline_qty",
+        "record_dialogs": "record_dialogs",
+        "adaptive_start": "adaptive_start",
+        "start_interval_min": "start_interval_min",
+        "start_interval_max": "start_interval_max",
+        "send_rate": "send_rate",
+        "send_burst": "send_burst",
+        "attempt_timeout": "attempt_timeout",
+        "batch_send": "batch_send",
     }
 
     def __init__(self, config: AppConfig) -> None:
         self._config = config
+        # Растёт при каждой записи: по нему пересобираются снимки параметров горячего пути
+        self.version = 0
 
     @classmethod
     def _attr(cls, key: str) -> str:
@@ -195,6 +246,7 @@ class ConfigAdapter(MutableMapping[str, Any]):
 
     def __setitem__(self, key: str, value: Any) -> None:
         attr = self._attr(key)
+        self.version += 1
         if attr == "retries":
             if isinstance(value, RetriesConfig):
                 self._config.retries = value
@@ -207,11 +259,13 @@ class ConfigAdapter(MutableMapping[str, Any]):
                 raise TypeError("Неверный тип для RETRIES")
             return
 
-        if attr in {"api_id"}:
+        if attr in {"api_id", "metrics_port"}:
             setattr(self._config, attr, _coerce_int(value, key))
-        elif attr in {"start_interval", "qty_pre_delay"}:
+        elif attr in {"start_interval", "qty_pre_delay", "start_interval_min", "start_interval_max",
+                      "send_rate", "send_burst", "attempt_timeout"}:
             setattr(self._config, attr, _coerce_float(value, key))
-        elif attr in {"preemptive_qty", "verbose"}:
+        elif attr in {"preemptive_qty", "verbose", "pipeline_qty", "record_dialogs", "adaptive_start",
+                      "batch_send"}:
             if isinstance(value, str):
                 setattr(self._config, attr, _bool_from_str(value))
             else:
@@ -314,6 +368,17 @@ def load_config(config_file: str = "config.txt") -> Tuple[ConfigAdapter, Dict[st
         start_interval=_coerce_float(raw.get("START_INTERVAL", 1.5), "START_INTERVAL"),
         qty_pre_delay=_coerce_float(raw.get("QTY_PRE_DELAY", 1.0), "QTY_PRE_DELAY"),
         retries=retries,
+        metrics_port=_coerce_int(raw.get("METRICS_PORT", 0), "METRICS_PORT"),
+        pay_currencies=str(raw.get("PAY_CURRENCIES", "USDT,LTC")),
+        pipeline_qty=_bool_from_str(raw.get("PIPELINE_QTY", "false")),
+        record_dialogs=_bool_from_str(raw.get("RECORD_DIALOGS", "false")),
+        adaptive_start=_bool_from_str(raw.get("ADAPTIVE_START", "false")),
+        start_interval_min=_coerce_float(raw.get("START_INTERVAL_MIN", 0.3), "START_INTERVAL_MIN"),
+        start_interval_max=_coerce_float(raw.get("START_INTERVAL_MAX", 5.0), "START_INTERVAL_MAX"),
+        send_rate=_coerce_float(raw.get("SEND_RATE", 10.0), "SEND_RATE"),
+        send_burst=_coerce_float(raw.get("SEND_BURST", 5.0), "SEND_BURST"),
+        attempt_timeout=_coerce_float(raw.get("ATTEMPT_TIMEOUT", 45.0), "ATTEMPT_TIMEOUT"),
+        batch_send=_bool_from_str(raw.get("BATCH_SEND", "false")),
     )
 
     logger.debug("Конфигурация загружена: %s", config)
@@ -1109,86 +1174,2288 @@ license_client = LicenseClient()
 # ========================
 # Профилировщик латентности
 # ========================
-class LatencyProfiler:
-    def __init__(self) -> None:
-        self._spans_ns: Dict[str, List[int]] = {}
+# Параметры лог-линейной гистограммы (модульные константы — быстрее атрибутов класса на горячем пути)
+_HIST_SUB_BITS = 7
+_HIST_HALF_BITS = _HIST_SUB_BITS - 1
+_HIST_SUB_COUNT = 1 << _HIST_SUB_BITS
+_HIST_MAX_BITS = 41  # 2**41 нс ≈ 36 минут; всё что длиннее — в последнюю корзину
+_HIST_MAX_VALUE = (1 << _HIST_MAX_BITS) - 1
 
-    def record(self, name: str, elapsed_ns: int) -> None:
-        bucket = self._spans_ns.get(name)
-        if bucket is None:
-            bucket = []
-            self._spans_ns[name] = bucket
-        bucket.append(elapsed_ns)
 
-    def timeit(self, name: str):
-        profiler = self
+class LatencyHistogram:
+    """Лог-линейная гистограмма (в стиле HDR) с фиксированным числом корзин.
+
+    Первые 2**SUB_BITS значений хранятся точно, дальше каждая степень двойки
+    делится на 2**(SUB_BITS-1) корзин — относительная ошибка не больше ~1.6%.
+    Запись — O(1), память постоянная, перцентили считаются без сортировки.
+    """
+
+    __slots__ = ("counts", "count", "total", "min", "max")
 
-        class _Ctx:
-            def __enter__(self_inner):
-                self_inner._t0 = time.perf_counter_ns()
-                return self_inner
+    N_BUCKETS = (_HIST_MAX_BITS - _HIST_SUB_BITS + 2) << _HIST_HALF_BITS
 
-            def __exit__(self_inner, exc_type, exc, tb):
-                t1 = time.perf_counter_ns()
-                profiler.record(name, t1 - self_inner._t0)
+    def __init__(self) -> None:
+        self.counts = array("q", bytes(8 * self.N_BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
 
-        return _Ctx()
+    @staticmethod
+    def _index(value: int) -> int:
+        if value < _HIST_SUB_COUNT:
+            return value
+        shift = value.bit_length() - _HIST_SUB_BITS
+        return (shift << _HIST_HALF_BITS) + (value >> shift)
 
-    def _percentile_ns(self, values: List[int], pct: float) -> int:
-        if not values:
+    @staticmethod
+    def _upper_bound(index: int) -> int:
+        """Наибольшее значение, попадающее в корзину index."""
+        if index < _HIST_SUB_COUNT:
+            return index
+        shift = (index >> _HIST_HALF_BITS) - 1
+        sub = index - (shift << _HIST_HALF_BITS)
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value: int) -> None:
+        if value < _HIST_SUB_COUNT:
+            if value < 0:
+                value = 0
+            idx = value
+        else:
+            if value > _HIST_MAX_VALUE:
+                value = _HIST_MAX_VALUE
+            shift = value.bit_length() - _HIST_SUB_BITS
+            idx = (shift << _HIST_HALF_BITS) + (value >> shift)
+        self.counts[idx] += 1
+        if value > self.max:
+            self.max = value
+        if value < self.min or not self.count:
+            self.min = value
+        self.count += 1
+        self.total += value
+
+    def percentile(self, pct: float) -> int:
+        if not self.count:
             return 0
-        values_sorted = sorted(values)
-        k = max(0, min(len(values_sorted) - 1, int(round((pct / 100.0) * (len(values_sorted) - 1)))))
-        return values_sorted[k]
+        # Ранг ближайшего значения, как у прежней реализации на отсортированном списке
+        rank = int(round((pct / 100.0) * (self.count - 1))) + 1
+        seen = 0
+        counts = self.counts
+        for idx in range(self._index(self.max) + 1):
+            c = counts[idx]
+            if not c:
+                continue
+            seen += c
+            if seen >= rank:
+                return max(self.min, min(self.max, self._upper_bound(idx)))
+        return self.max
+
+    def mean(self) -> float:
+        return (self.total / self.count) if self.count else 0.0
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        if not other.count:
+            return
+        counts = self.counts
+        for idx, c in other.to_sparse():
+            counts[idx] += c
+        if not self.count or other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        self.total += other.total
+
+    def to_sparse(self) -> List[Tuple[int, int]]:
+        """Ненулевые корзины (индекс, счётчик) — для компактной сериализации."""
+        counts = self.counts
+        return [(idx, counts[idx]) for idx in range(self._index(self.max) + 1) if counts[idx]]
+
+    @classmethod
+    def from_sparse(cls, count: int, total: int, min_value: int, max_value: int,
+                    buckets: List[Tuple[int, int]]) -> "LatencyHistogram":
+        hist = cls()
+        for idx, c in buckets:
+            if 0 <= idx < cls.N_BUCKETS:
+                hist.counts[idx] = c
+        hist.count = count
+        hist.total = total
+        hist.min = min_value
+        hist.max = max_value
+        return hist
+
+    def copy(self) -> "LatencyHistogram":
+        other = LatencyHistogram.__new__(LatencyHistogram)
+        other.counts = array("q", self.counts)
+        other.count = self.count
+        other.total = self.total
+        other.min = self.min
+        other.max = self.max
+        return other
+
+
+class _AttemptTrace:
+    """Спаны одной попытки _orchestrate."""
+
+    __slots__ = ("no", "trace_id", "root_id", "t0", "t1", "outcome", "args", "events", "stack")
+
+    def __init__(self, no: int, root_id: int, args: Dict[str, Any]) -> None:
+        self.no = no
+        self.trace_id = secrets.token_hex(8)
+        self.root_id = root_id
+        self.t0 = time.perf_counter_ns()
+        self.t1: Optional[int] = None
+        self.outcome: Optional[str] = None
+        self.args = args
+        # (ph, name, span_id, parent_id, t0_ns, dur_ns, args)
+        self.events: List[Tuple[str, str, int, int, int, int, Optional[Dict[str, Any]]]] = []
+        # Открытые спаны попытки: родитель нового спана — вершина стека, иначе корень
+        self.stack: List[int] = []
+
+
+class _SpanHandle:
+    """Открытый спан: попытка, свой id и id родителя. Заполняется tracer.open_span на месте."""
+
+    __slots__ = ("attempt", "span_id", "parent_id")
+
+    def __init__(self) -> None:
+        self.attempt: Optional[_AttemptTrace] = None
+        self.span_id = 0
+        self.parent_id = 0
+
+
+# Текущая попытка задачи. Задачи, созданные внутри попытки, наследуют значение и пишут
+# свои спаны в «свою» попытку даже после её завершения. Ставится один раз на попытку,
+# вложенность спанов ведёт стек _AttemptTrace.stack.
+_current_attempt: "contextvars.ContextVar[Optional[_AttemptTrace]]" = contextvars.ContextVar(
+    "porn2o_current_attempt", default=None
+)
+
+
+class AttemptTracer:
+    """Иерархическая трассировка попыток покупки с экспортом в Chrome trace_event."""
+
+    MAX_EVENTS_PER_ATTEMPT = 2000
+
+    def __init__(self, max_attempts: int = 50) -> None:
+        self._attempts: Deque[_AttemptTrace] = deque(maxlen=max_attempts)
+        self._current: Optional[_AttemptTrace] = None
+        self._ids = itertools.count(1)
+        self._attempt_no = itertools.count(1)
+        self._epoch_ns = time.perf_counter_ns()
+
+    @property
+    def current(self) -> Optional[_AttemptTrace]:
+        return self._current
+
+    def begin_attempt(self, **args: Any) -> _AttemptTrace:
+        if self._current is not None:
+            self.end_attempt("abandoned")
+        attempt = _AttemptTrace(next(self._attempt_no), next(self._ids), args)
+        self._attempts.append(attempt)
+        self._current = attempt
+        _current_attempt.set(attempt)
+        return attempt
+
+    def end_attempt(self, outcome: str) -> None:
+        attempt = self._current
+        if attempt is None:
+            return
+        attempt.t1 = time.perf_counter_ns()
+        attempt.outcome = outcome
+        self._current = None
+        _current_attempt.set(None)
+
+    def _attempt(self) -> Optional[_AttemptTrace]:
+        attempt = _current_attempt.get()
+        if attempt is not None:
+            return attempt
+        # Обработчики событий Telethon не наследуют контекст — вешаем на текущую попытку
+        return self._current
+
+    @staticmethod
+    def _top(attempt: _AttemptTrace) -> int:
+        stack = attempt.stack
+        return stack[-1] if stack else attempt.root_id
+
+    def open_span(self, handle: _SpanHandle) -> None:
+        """Открывает спан в handle. Без активной попытки handle.attempt остаётся None."""
+        attempt = self._attempt()
+        handle.attempt = attempt
+        if attempt is None:
+            return
+        handle.parent_id = self._top(attempt)
+        handle.span_id = span_id = next(self._ids)
+        attempt.stack.append(span_id)
+
+    def close_span(self, handle: _SpanHandle, name: str, args: Optional[Dict[str, Any]],
+                   t0_ns: int, t1_ns: int, exc_type: Any = None) -> None:
+        attempt = handle.attempt
+        if attempt is None:
+            return
+        handle.attempt = None
+        span_id = handle.span_id
+        stack = attempt.stack
+        if stack and stack[-1] == span_id:
+            stack.pop()
+        else:
+            # Конкурентные задачи попытки закрывают спаны не в порядке открытия
+            try:
+                stack.remove(span_id)
+            except ValueError:
+                pass
+        if exc_type is not None:
+            args = dict(args or {})
+            args["error"] = getattr(exc_type, "__name__", str(exc_type))
+        if len(attempt.events) < self.MAX_EVENTS_PER_ATTEMPT:
+            attempt.events.append(("X", name, span_id, handle.parent_id, t0_ns, t1_ns - t0_ns, args))
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        handle = _SpanHandle()
+        self.open_span(handle)
+        t0 = time.perf_counter_ns()
+        exc_type = None
+        try:
+            yield
+        except BaseException as exc:
+            exc_type = type(exc)
+            raise
+        finally:
+            self.close_span(handle, name, args or None, t0, time.perf_counter_ns(), exc_type)
+
+    def instant(self, name: str, **args: Any) -> None:
+        attempt = self._attempt()
+        if attempt is None:
+            return
+        if len(attempt.events) < self.MAX_EVENTS_PER_ATTEMPT:
+            attempt.events.append(("i", name, next(self._ids), self._top(attempt), time.perf_counter_ns(), 0, args or None))
+
+    def to_chrome(self, last_n: int = 5) -> Dict[str, Any]:
+        """Последние last_n попыток в формате Chrome trace_event (chrome://tracing, Perfetto)."""
+        attempts = list(self._attempts)[-max(1, int(last_n)):]
+        epoch = self._epoch_ns
+        now = time.perf_counter_ns()
+        out: List[Dict[str, Any]] = []
+        for attempt in attempts:
+            tid = attempt.no
+            outcome = attempt.outcome or "running"
+            out.append({
+                "ph": "M", "name": "thread_name", "pid": 1, "tid": tid,
+                "args": {"name": f"attempt #{attempt.no} ({outcome})"},
+            })
+            root_args = dict(attempt.args)
+            root_args.update({"trace_id": attempt.trace_id, "span_id": attempt.root_id, "outcome": outcome})
+            out.append({
+                "ph": "X", "name": "attempt", "cat": "attempt", "pid": 1, "tid": tid,
+                "ts": (attempt.t0 - epoch) / 1000.0,
+                "dur": ((attempt.t1 or now) - attempt.t0) / 1000.0,
+                "args": root_args,
+            })
+            for ph, name, span_id, parent_id, t0, dur, args in list(attempt.events):
+                ev_args: Dict[str, Any] = {"trace_id": attempt.trace_id, "span_id": span_id, "parent_id": parent_id}
+                if args:
+                    ev_args.update({k: (v if isinstance(v, (int, float, str, bool)) or v is None else str(v)) for k, v in args.items()})
+                ev: Dict[str, Any] = {
+                    "ph": ph, "name": name, "cat": "attempt", "pid": 1, "tid": tid,
+                    "ts": (t0 - epoch) / 1000.0, "args": ev_args,
+                }
+                if ph == "X":
+                    ev["dur"] = dur / 1000.0
+                else:
+                    ev["s"] = "t"
+                out.append(ev)
+        return {"traceEvents": out, "displayTimeUnit": "ms"}
+
+
+class _SpanToken(_SpanHandle):
+    """Переиспользуемый токен замера. Берётся из пула слота и возвращается в него на выходе.
+
+    Сам же служит дескриптором спана трассировки, так что внутри попытки замер
+    не создаёт ни кортежей, ни contextvars.Token.
+    """
+
+    __slots__ = ("_slot", "_t0")
+
+    def __init__(self, slot: "MetricSlot") -> None:
+        super().__init__()
+        self._slot = slot
+        self._t0 = 0
+
+    def __enter__(self) -> "_SpanToken":
+        self._slot.tracer.open_span(self)
+        self._t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        t1 = time.perf_counter_ns()
+        slot = self._slot
+        slot.hist.record(t1 - self._t0)
+        if self.attempt is not None:
+            slot.tracer.close_span(self, slot.name, None, self._t0, t1, exc_type)
+        slot._free.append(self)
+        return False
+
+
+class MetricSlot:
+    """Предвыделенный слот метрики: гистограмма и пул токенов замера.
+
+    В установившемся режиме замер не создаёт объектов: токен достаётся из пула
+    и возвращается в него. Конкурентные задачи получают разные токены.
+    """
+
+    __slots__ = ("name", "hist", "tracer", "_free")
+
+    def __init__(self, name: str, hist: LatencyHistogram, tracer: AttemptTracer) -> None:
+        self.name = name
+        self.hist = hist
+        self.tracer = tracer
+        self._free: List[_SpanToken] = [_SpanToken(self), _SpanToken(self)]
+
+    def __call__(self) -> _SpanToken:
+        free = self._free
+        return free.pop() if free else _SpanToken(self)
+
+    def since(self, t0_ns: int) -> None:
+        """Записывает время от t0_ns (time.perf_counter_ns) до текущего момента."""
+        self.hist.record(time.perf_counter_ns() - t0_ns)
+
+
+class LatencyProfiler:
+    def __init__(self) -> None:
+        self._spans_ns: Dict[str, LatencyHistogram] = {}
+        self._slots: Dict[str, MetricSlot] = {}
+        self._counters: Dict[str, int] = {}
+        self.tracer = AttemptTracer()
+
+    def slot(self, name: str) -> MetricSlot:
+        slot = self._slots.get(name)
+        if slot is None:
+            hist = self._spans_ns.get(name)
+            if hist is None:
+                hist = LatencyHistogram()
+                self._spans_ns[name] = hist
+            slot = MetricSlot(name, hist, self.tracer)
+            self._slots[name] = slot
+        return slot
+
+    def incr(self, name: str, value: int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def counters(self) -> Dict[str, int]:
+        return dict(self._counters)
+
+    def snapshot(self) -> Tuple[Dict[str, LatencyHistogram], Dict[str, int]]:
+        """Копия гистограмм и счётчиков: дальше с ней можно работать вне цикла событий."""
+        return {name: hist.copy() for name, hist in self._spans_ns.items()}, dict(self._counters)
+
+    def record(self, name: str, elapsed_ns: int) -> None:
+        hist = self._spans_ns.get(name)
+        if hist is None:
+            hist = LatencyHistogram()
+            self._spans_ns[name] = hist
+        hist.record(elapsed_ns)
+
+    def timeit(self, name: str) -> _SpanToken:
+        slot = self._slots.get(name)
+        if slot is None:
+            slot = self.slot(name)
+        return slot()
+
+    def percentile_ms(self, name: str, pct: float) -> float:
+        hist = self._spans_ns.get(name)
+        if hist is None:
+            return 0.0
+        return hist.percentile(pct) / 1_000_000.0
 
     def summary_ms(self) -> Dict[str, Tuple[float, float, float, int]]:
         """Возвращает {name: (avg_ms, p95_ms, p99_ms, count)}"""
         out: Dict[str, Tuple[float, float, float, int]] = {}
-        for name, arr in self._spans_ns.items():
-            if not arr:
+        for name, hist in self._spans_ns.items():
+            if not hist.count:
                 out[name] = (0.0, 0.0, 0.0, 0)
                 continue
-            avg_ms = (sum(arr) / len(arr)) / 1_000_000.0
-            p95_ms = self._percentile_ns(arr, 95) / 1_000_000.0
-            p99_ms = self._percentile_ns(arr, 99) / 1_000_000.0
-            out[name] = (avg_ms, p95_ms, p99_ms, len(arr))
+            avg_ms = hist.mean() / 1_000_000.0
+            p95_ms = hist.percentile(95) / 1_000_000.0
+            p99_ms = hist.percentile(99) / 1_000_000.0
+            out[name] = (avg_ms, p95_ms, p99_ms, hist.count)
         return out
 
 
+_PROM_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+def _prom_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(spans: Dict[str, LatencyHistogram], counters: Dict[str, int]) -> str:
+    """Текстовый формат экспозиции Prometheus (0.0.4) из снимка профилировщика."""
+    lines: List[str] = [
+        "# HELP porn2o_span_seconds Латентность спанов профилировщика",
+        "# TYPE porn2o_span_seconds summary",
+    ]
+    for name in sorted(spans):
+        hist = spans[name]
+        label = _prom_label(name[:-3] if name.endswith("_ms") else name)
+        for q in _PROM_QUANTILES:
+            value = hist.percentile(q * 100.0) / 1e9
+            lines.append(f'porn2o_span_seconds{{span="{label}",quantile="{q}"}} {value:.9f}')
+        lines.append(f'porn2o_span_seconds_sum{{span="{label}"}} {hist.total / 1e9:.9f}')
+        lines.append(f'porn2o_span_seconds_count{{span="{label}"}} {hist.count}')
+    for name in sorted(counters):
+        metric = "porn2o_" + re.sub(r"[^a-zA-Z0-9_]", "_", name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {counters[name]}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Минимальный asyncio HTTP-сервер для GET /metrics на localhost.
+
+    В цикле событий берётся только снимок (копия массивов корзин), а рендер
+    текста выполняется в пуле потоков — скрейп не тормозит _handle_message.
+    """
+
+    def __init__(self, profiler: LatencyProfiler, port: int, host: str = "127.0.0.1") -> None:
+        self._profiler = profiler
+        self.host = host
+        self.port = int(port)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса нам не нужны — просто дочитываем их
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            elif parts[1].split("?", 1)[0] not in ("/metrics", "/"):
+                status, body = "404 Not Found", b""
+            else:
+                spans, counters = self._profiler.snapshot()
+                text = await asyncio.get_running_loop().run_in_executor(None, render_prometheus, spans, counters)
+                status, body = "200 OK", text.encode("utf-8")
+            head = (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            writer.write(head if parts[:1] == ["HEAD"] else head + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+
+class ServerClockEstimator:
+    """Оценка смещения локальных часов относительно серверных (offset = server - local).
+
+    message.date у Telegram округлена вниз до секунды, поэтому каждая выборка
+    даёт не точку, а интервал допустимых смещений. Интервалы последних выборок
+    пересекаются; если пересечение пустое (часы дрейфанули) — начинаем заново.
+    """
+
+    def __init__(self, window: int = 32) -> None:
+        self._intervals: Deque[Tuple[float, float]] = deque(maxlen=window)
+        self.offset = 0.0
+        self.error = math.inf
+        self.samples = 0
+
+    def observe_roundtrip(self, server_date: Optional[datetime], local_send: float, local_recv: float) -> None:
+        """Наш запрос сервер обработал в [date, date+1) где-то между local_send и local_recv."""
+        if server_date is None:
+            return
+        ts = server_date.timestamp()
+        self._add(ts - local_recv, ts + 1.0 - local_send)
+
+    def observe_incoming(self, server_date: Optional[datetime], local_recv: float) -> None:
+        """Сообщение создано не позже, чем мы его получили: только нижняя граница."""
+        if server_date is None:
+            return
+        self._add(server_date.timestamp() - local_recv, math.inf)
+
+    def _add(self, lo: float, hi: float) -> None:
+        self.samples += 1
+        intervals = self._intervals
+        intervals.append((lo, hi))
+        best_lo = max(x[0] for x in intervals)
+        best_hi = min(x[1] for x in intervals)
+        if best_lo > best_hi:
+            intervals.clear()
+            intervals.append((lo, hi))
+            best_lo, best_hi = lo, hi
+        if best_hi == math.inf:
+            self.offset, self.error = best_lo, math.inf
+        else:
+            self.offset = (best_lo + best_hi) / 2.0
+            self.error = (best_hi - best_lo) / 2.0
+
+    def local_time_of(self, server_date: datetime) -> float:
+        """Оценка локального time.time() момента создания сообщения (середина секунды)."""
+        return server_date.timestamp() + 0.5 - self.offset
+
+    def elapsed_ns_since(self, server_date: Optional[datetime]) -> Optional[int]:
+        if server_date is None:
+            return None
+        return max(0, int((time.time() - self.local_time_of(server_date)) * 1_000_000_000))
+
+    def describe(self) -> str:
+        if not self.samples:
+            return "нет выборок"
+        err = "?" if self.error == math.inf else f"{self.error * 1000:.0f}"
+        return f"{self.offset * 1000:+.0f} ± {err} мс (n={self.samples})"
+
+
+# Монитор задержки цикла событий
+LOOP_LAG_INTERVAL = 0.005  # период сэмплирования, сек
+LOOP_STALL_THRESHOLD = 0.1  # фриз дольше этого — снимаем стек, сек
+
+
+class LoopLagMonitor:
+    """Сэмплер задержки планирования цикла событий.
+
+    Корутина каждые LOOP_LAG_INTERVAL секунд засыпает и пишет опоздание
+    пробуждения в серию loop_lag_ms профилировщика. Сторожевой поток следит за
+    отметкой последнего тика и, если цикл стоит дольше порога, снимает стек
+    потока цикла — видно, кто именно его заблокировал.
+    """
+
+    def __init__(
+        self,
+        profiler: LatencyProfiler,
+        *,
+        interval: float = LOOP_LAG_INTERVAL,
+        stall_threshold: float = LOOP_STALL_THRESHOLD,
+        max_stalls: int = 5,
+    ) -> None:
+        self._profiler = profiler
+        self.interval = float(interval)
+        self.stall_threshold = float(stall_threshold)
+        # (время по UTC, длительность фриза в мс, стек)
+        self.stalls: Deque[Tuple[datetime, float, str]] = deque(maxlen=max_stalls)
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._last_tick = time.perf_counter()
+        self._pending_stack: Optional[Tuple[datetime, str]] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._stop_event.clear()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        self._thread = threading.Thread(target=self._watchdog, name="loop-lag-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    async def _sample(self) -> None:
+        interval = self.interval
+        interval_ns = int(interval * 1_000_000_000)
+        record = self._profiler.record
+        while True:
+            t0 = time.perf_counter_ns()
+            await asyncio.sleep(interval)
+            lag_ns = time.perf_counter_ns() - t0 - interval_ns
+            record("loop_lag_ms", lag_ns)
+            self._last_tick = time.perf_counter()
+            pending = self._pending_stack
+            if pending is not None:
+                self._pending_stack = None
+                self.stalls.append((pending[0], lag_ns / 1_000_000.0, pending[1]))
+                self._profiler.incr("loop_stalls")
+
+    def _watchdog(self) -> None:
+        threshold = self.stall_threshold
+        while not self._stop_event.wait(threshold / 2):
+            if self._pending_stack is not None:
+                continue
+            if time.perf_counter() - self._last_tick < threshold + self.interval:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id or 0)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame)[-8:])
+            self._pending_stack = (datetime.now(timezone.utc), stack)
+
+    def last_stall_text(self) -> Optional[str]:
+        if not self.stalls:
+            return None
+        ts, duration_ms, stack = self.stalls[-1]
+        return f"⏸ Последний фриз цикла: {duration_ms:.0f} мс в {ts.strftime('%H:%M:%S')} UTC\n{stack.rstrip()}"
+
+
+# ========================
+# История метрик между запусками
+# ========================
+class MetricsHistory:
+    """Append-only бинарный файл с гистограммами запусков.
+
+    Запись: MAGIC | версия (B) | длина (I) | zlib(payload). В payload —
+    JSON-заголовок (run_id, время, снимок конфига, счётчики) и разреженные
+    гистограммы: для каждого спана count/total/min/max и пары (корзина, счётчик).
+    Запуск может дописать несколько контрольных точек; при чтении берётся
+    последняя запись каждого run_id.
+    """
+
+    MAGIC = b"P2OH"
+    VERSION = 1
+    _FRAME = struct.Struct("<4sBI")
+    _SPAN_HEAD = struct.Struct("<QQQQI")
+    _BUCKET = struct.Struct("<HQ")
+    MAX_BYTES = 4 * 1024 * 1024
+    KEEP_RUNS = 200
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @classmethod
+    def encode(cls, meta: Dict[str, Any], spans: Dict[str, LatencyHistogram]) -> bytes:
+        head = json.dumps(meta, ensure_ascii=False, default=str).encode("utf-8")
+        parts = [struct.pack("<I", len(head)), head, struct.pack("<H", len(spans))]
+        for name, hist in spans.items():
+            raw_name = name.encode("utf-8")[:255]
+            buckets = hist.to_sparse()
+            parts.append(struct.pack("<B", len(raw_name)) + raw_name)
+            parts.append(cls._SPAN_HEAD.pack(hist.count, hist.total, hist.min, hist.max, len(buckets)))
+            parts.append(b"".join(cls._BUCKET.pack(idx, c) for idx, c in buckets))
+        payload = zlib.compress(b"".join(parts), 6)
+        return cls._FRAME.pack(cls.MAGIC, cls.VERSION, len(payload)) + payload
+
+    @classmethod
+    def decode(cls, payload: bytes) -> Tuple[Dict[str, Any], Dict[str, LatencyHistogram]]:
+        data = zlib.decompress(payload)
+        (head_len,) = struct.unpack_from("<I", data, 0)
+        pos = 4
+        meta = json.loads(data[pos:pos + head_len].decode("utf-8"))
+        pos += head_len
+        (n_spans,) = struct.unpack_from("<H", data, pos)
+        pos += 2
+        spans: Dict[str, LatencyHistogram] = {}
+        for _ in range(n_spans):
+            name_len = data[pos]
+            pos += 1
+            name = data[pos:pos + name_len].decode("utf-8", "replace")
+            pos += name_len
+            count, total, min_v, max_v, nnz = cls._SPAN_HEAD.unpack_from(data, pos)
+            pos += cls._SPAN_HEAD.size
+            buckets = [cls._BUCKET.unpack_from(data, pos + k * cls._BUCKET.size) for k in range(nnz)]
+            pos += nnz * cls._BUCKET.size
+            spans[name] = LatencyHistogram.from_sparse(count, total, min_v, max_v, buckets)
+        return meta, spans
+
+    @classmethod
+    def _iter_frames(cls, blob: bytes) -> Iterator[bytes]:
+        pos = 0
+        size = cls._FRAME.size
+        while pos + size <= len(blob):
+            magic, version, length = cls._FRAME.unpack_from(blob, pos)
+            if magic != cls.MAGIC:
+                break  # хвост повреждён (например, оборванная запись)
+            pos += size
+            if version == cls.VERSION:
+                yield blob[pos:pos + length]
+            pos += length
+
+    def append(self, meta: Dict[str, Any], spans: Dict[str, LatencyHistogram]) -> None:
+        _ensure_parent_dir(self.path)
+        with open(self.path, "ab") as f:
+            f.write(self.encode(meta, spans))
+        try:
+            if self.path.stat().st_size > self.MAX_BYTES:
+                self.compact()
+        except OSError:
+            pass
+
+    def load_runs(self) -> List[Tuple[Dict[str, Any], Dict[str, LatencyHistogram]]]:
+        """Последняя контрольная точка каждого запуска, от старых к новым."""
+        if not self.path.exists():
+            return []
+        blob = self.path.read_bytes()
+        runs: Dict[str, Tuple[Dict[str, Any], Dict[str, LatencyHistogram]]] = {}
+        for payload in self._iter_frames(blob):
+            try:
+                meta, spans = self.decode(payload)
+            except Exception:
+                continue
+            run_id = str(meta.get("run_id"))
+            runs.pop(run_id, None)  # переносим в конец — порядок по последней записи
+            runs[run_id] = (meta, spans)
+        return list(runs.values())
+
+    def compact(self) -> None:
+        runs = self.load_runs()[-self.KEEP_RUNS:]
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for meta, spans in runs:
+                f.write(self.encode(meta, spans))
+        os.replace(tmp, self.path)
+
+
+def merge_histograms(runs: List[Dict[str, LatencyHistogram]]) -> Dict[str, LatencyHistogram]:
+    merged: Dict[str, LatencyHistogram] = {}
+    for spans in runs:
+        for name, hist in spans.items():
+            target = merged.get(name)
+            if target is None:
+                merged[name] = hist.copy()
+            else:
+                target.merge(hist)
+    return merged
+
+
+def compare_histograms_text(
+    current: Dict[str, LatencyHistogram],
+    reference: Dict[str, LatencyHistogram],
+    ref_label: str,
+    config_diff: Optional[Dict[str, Tuple[Any, Any]]] = None,
+) -> str:
+    """Таблица перцентилей «текущий запуск против эталона» с дельтами по каждому спану."""
+    lines = [f"📊 Сравнение с {ref_label} (мс, было → стало):"]
+    if config_diff:
+        lines.append("⚙️ Отличия конфига: " + ", ".join(f"{k}: {a} → {b}" for k, (a, b) in config_diff.items()))
+    for name in sorted(set(current) | set(reference)):
+        cur = current.get(name)
+        ref = reference.get(name)
+        if cur is None or not cur.count:
+            lines.append(f"{name}: нет данных в текущем запуске (было n={ref.count if ref else 0})")
+            continue
+        if ref is None or not ref.count:
+            lines.append(f"{name}: новый спан, n={cur.count}")
+            continue
+        cells = []
+        for pct in (50, 95, 99):
+            a = ref.percentile(pct) / 1_000_000.0
+            b = cur.percentile(pct) / 1_000_000.0
+            delta = ((b - a) / a * 100.0) if a else 0.0
+            cells.append(f"p{pct} {a:.1f}→{b:.1f} ({delta:+.0f}%)")
+        lines.append(f"{name}: " + " | ".join(cells) + f" (n {ref.count}→{cur.count})")
+    return "\n".join(lines)
+
+
+def profiled(name: str):
+    """Декоратор для корутин-методов: замеряет каждый вызов в слот name профилировщика self._profiler."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            with self._profiler.timeit(name):
+                return await fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 PAYMENT_REGEX = re.compile(
     r"(crypto[\s-]?bot|crypto\s*pay|перейти\s+к\s+оплате|оплатить|оплата|pay|купить)",
     re.IGNORECASE,
 )
-QUANTITY_PROMPT_REGEX = re.compile(
-    r"(введите\s+количеств|количество\s+товара|минимальное\s+количество|максимальное\s+количество|выберите\s+количеств)",
-    re.IGNORECASE,
+
+
+class ButtonRef(NamedTuple):
+    row: int
+    column: int
+    text: str
+    data: Optional[bytes]  # callback data; None — URL/обычная кнопка, жмём через message.click
+
+
+# Колбэк-кнопка: KeyboardButtonCallback (старый слой схемы) или KeyboardInlineButton с InlineButtonTypeCallback
+_INLINE_CALLBACK_TYPE = getattr(tl_types, "InlineButtonTypeCallback", None)
+
+
+def _button_callback_data(btn) -> Optional[bytes]:
+    src = btn
+    kind = getattr(btn, "type", None)
+    if _INLINE_CALLBACK_TYPE is not None and isinstance(kind, _INLINE_CALLBACK_TYPE):
+        src = kind
+    data = getattr(src, "data", None)
+    # Кнопки с паролем (2FA) отдаём штатному click — ему нужен SRP-чек
+    if not isinstance(data, bytes) or getattr(src, "requires_password", False):
+        return None
+    return data
+
+
+class MarkupPlan:
+    """План действий по reply_markup: своё кол-во, числовая кнопка, платёжные кнопки по приоритету."""
+
+    __slots__ = ("own_qty", "numeric", "payments")
+
+    def __init__(self, own_qty: Optional[ButtonRef], numeric: Optional[ButtonRef], payments: List[ButtonRef]) -> None:
+        self.own_qty = own_qty
+        self.numeric = numeric
+        self.payments = payments
+
+
+def _parse_currency_list(value: Any) -> Tuple[str, ...]:
+    if isinstance(value, (list, tuple)):
+        items = [str(x) for x in value]
+    else:
+        items = re.split(r"[,;\s]+", str(value or ""))
+    return tuple(x.strip().upper() for x in items if x.strip())
+
+
+class ButtonClassifier:
+    """Однопроходный классификатор кнопок: каждая кнопка разметки посещается ровно один раз.
+
+    Платёжные кнопки ранжируются так: точное совпадение с валютой из
+    PAY_CURRENCIES (в порядке предпочтения), затем любые кнопки под
+    PAYMENT_REGEX; внутри ранга — порядок в разметке.
+    """
+
+    def __init__(self, currencies: Sequence[str], is_own_qty: Callable[[str], bool]) -> None:
+        self.currencies = tuple(currencies)
+        self._currency_rank = {c.casefold(): rank for rank, c in enumerate(self.currencies)}
+        self._regex_rank = len(self.currencies)
+        self._payment_search = PAYMENT_REGEX.search
+        self._is_own_qty = is_own_qty
+
+    def classify(self, markup: Any, qty_str: str) -> MarkupPlan:
+        own_qty: Optional[ButtonRef] = None
+        numeric: Optional[ButtonRef] = None
+        ranked: List[Tuple[int, int, ButtonRef]] = []
+        currency_rank = self._currency_rank
+        regex_rank = self._regex_rank
+        payment_search = self._payment_search
+        is_own_qty = self._is_own_qty
+        order = 0
+        for i, row in enumerate(getattr(markup, "rows", None) or ()):
+            for j, btn in enumerate(getattr(row, "buttons", None) or ()):
+                text = (getattr(btn, "text", "") or "").strip()
+                if not text:
+                    continue
+                ref = None
+                if numeric is None and text == qty_str and text.isdigit():
+                    ref = numeric = ButtonRef(i, j, text, _button_callback_data(btn))
+                elif own_qty is None and is_own_qty(text):
+                    ref = own_qty = ButtonRef(i, j, text, _button_callback_data(btn))
+                rank = currency_rank.get(text.casefold())
+                if rank is None and payment_search(text):
+                    rank = regex_rank
+                if rank is not None:
+                    ranked.append((rank, order, ref or ButtonRef(i, j, text, _button_callback_data(btn))))
+                    order += 1
+        ranked.sort()
+        return MarkupPlan(own_qty, numeric, [ref for _, _, ref in ranked])
+
+
+# Версия формата и правил классификации: при изменении ButtonClassifier старые плейбуки не используются
+PLAYBOOK_VERSION = 1
+
+
+def _ref_to_json(ref: Optional[ButtonRef]) -> Optional[List[Any]]:
+    if ref is None:
+        return None
+    return [ref.row, ref.column, ref.text, ref.data.hex() if ref.data else None]
+
+
+def _ref_from_json(raw: Optional[List[Any]]) -> Optional[ButtonRef]:
+    if not raw:
+        return None
+    row, column, text, data = raw
+    return ButtonRef(int(row), int(column), str(text), bytes.fromhex(data) if data else None)
+
+
+class MarkupPlaybook:
+    """Плейбук экранов одной ссылки товара: отпечаток разметки → готовый MarkupPlan.
+
+    Магазин-бот показывает по ссылке одни и те же экраны, поэтому классификация
+    нужна только для незнакомых разметок. Хранится в config_dir/playbooks/<ссылка>.json.
+    Вытеснение LRU: попадание в get освежает экран, так что постоянные карточка
+    и промпт количества переживают поток одноразовых экранов заказов.
+    """
+
+    MAX_SCREENS = 256
+
+    def __init__(self, path: Path, signature: str) -> None:
+        self.path = path
+        self.signature = signature
+        self.dirty = False
+        self._plans: "OrderedDict[str, MarkupPlan]" = OrderedDict()
+
+    @staticmethod
+    def fingerprint(markup) -> str:
+        """Отпечаток раскладки: форма рядов, подписи и callback data (blake2b, 8 байт)."""
+        parts: List[str] = []
+        append = parts.append
+        for row in getattr(markup, "rows", None) or ():
+            append("\x1e")
+            for btn in getattr(row, "buttons", None) or ():
+                data = _button_callback_data(btn)
+                append(getattr(btn, "text", "") or "")
+                append(data.hex() if data else "")
+        raw = "\x1f".join(parts).encode("utf-8", "surrogatepass")
+        return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+    def get(self, fingerprint: str, qty_str: str) -> Optional[MarkupPlan]:
+        key = f"{fingerprint}:{qty_str}"
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        return plan
+
+    def put(self, fingerprint: str, qty_str: str, plan: MarkupPlan) -> None:
+        plans = self._plans
+        if len(plans) >= self.MAX_SCREENS:
+            # Вытесняем давно не встречавшийся экран: одноразовые (номер заказа в
+            # callback) уходят первыми, постоянные освежаются каждым попаданием
+            plans.popitem(last=False)
+        plans[f"{fingerprint}:{qty_str}"] = plan
+        self.dirty = True
+
+    def snapshot(self) -> Dict[str, MarkupPlan]:
+        """Копия экранов для save(); снимается в цикле событий."""
+        self.dirty = False
+        return dict(self._plans)
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+    @classmethod
+    def load(cls, path: Path, signature: str) -> "MarkupPlaybook":
+        book = cls(path, signature)
+        try:
+            if path.exists():
+                data = json.loads(path.read_text(encoding="utf-8"))
+                if data.get("version") == PLAYBOOK_VERSION and data.get("signature") == signature:
+                    for key, raw in (data.get("screens") or {}).items():
+                        book._plans[key] = MarkupPlan(
+                            _ref_from_json(raw.get("own_qty")),
+                            _ref_from_json(raw.get("numeric")),
+                            [_ref_from_json(p) for p in raw.get("payments") or []],
+                        )
+        except Exception as e:
+            logger.debug("Плейбук %s не прочитан: %s", path, e)
+        return book
+
+    def save(self, plans: Optional[Dict[str, MarkupPlan]] = None) -> None:
+        """Выполняется в пуле потоков (plans — snapshot() из цикла); запись через временный файл."""
+        if plans is None:
+            plans = self.snapshot()
+        screens = {
+            key: {
+                "own_qty": _ref_to_json(plan.own_qty),
+                "numeric": _ref_to_json(plan.numeric),
+                "payments": [_ref_to_json(p) for p in plan.payments],
+            }
+            for key, plan in plans.items()
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({"version": PLAYBOOK_VERSION, "signature": self.signature, "screens": screens}, ensure_ascii=False),
+            encoding="utf-8",
+        )
+        os.replace(tmp, self.path)
+
+
+def _playbook_filename(link: str) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", link)[:80] or "default"
+    return f"{safe}-{hashlib.blake2b(link.encode('utf-8'), digest_size=4).hexdigest()}.json"
+
+
+# Нормализация подписи кнопки: всё, кроме букв/цифр (дефисы, тире, эмодзи, пунктуация, пробелы) — в один пробел
+_OWN_QTY_NON_ALNUM_RE = re.compile(r"[^a-zа-я0-9]+")
+# Варианты нажатия "Ввод своего кол-ва"
+_OWN_QTY_PHRASES_RE = re.compile(
+    "|".join(
+        re.escape(p)
+        for p in (
+            "ввод своего кол ва",
+            "ввести свое кол",
+            "ввести свое количество",
+            "ввести количество",
+            "ввод количества",
+            "другое количество",
+        )
+    )
 )
 
 
+@functools.lru_cache(maxsize=512)
+def _is_own_qty_label(text: str) -> bool:
+    """Подпись кнопки "Ввод своего кол-ва"? Кэш по сырому тексту: магазин-бот повторяет одни и те же подписи."""
+    t = _OWN_QTY_NON_ALNUM_RE.sub(" ", text.lower().replace("ё", "е")).strip()
+    if _OWN_QTY_PHRASES_RE.search(t):
+        return True
+    # Общая эвристика: присутствуют корни "сво" и "кол"
+    return ("сво" in t and "кол" in t) or ("ввод" in t and "кол" in t)
+
+
+def own_qty_cache_text() -> str:
+    info = _is_own_qty_label.cache_info()
+    total = info.hits + info.misses
+    rate = (info.hits / total * 100.0) if total else 0.0
+    return f"🧠 Кэш подписей кнопок: hit {rate:.1f}% ({info.hits}/{total}), размер {info.currsize}/{info.maxsize}"
+
+
+# ========================
+# Классы текста ответа бота
+# ========================
+# Фразы хранятся данными: пробел во фразе — любой пробельный промежуток,
+# вложенный список — все части должны встретиться в тексте (в любом порядке).
+# Переопределяется файлом bot_phrases.json в каталоге конфигурации.
+DEFAULT_BOT_PHRASES: Dict[str, List[Any]] = {
+    # Бот ответил ошибкой — попытка неудачна
+    "error": [
+        "непредвиденная ошибка",
+        "ошибка",
+        "что-то пошло не так",
+        "повторите позже",
+    ],
+    # Нужно мгновенно повторить попытку
+    # Примеры: "К сожалению я не смог распознать Вашу команду.",
+    #          "Воспользуйтесь кнопками в меню или отправьте /start",
+    #          "Полная начинка закончилась" / "товар закончился"
+    "retry": [
+        "распознан",
+        "воспользуйтесь кнопками",
+        "полная начинка",
+        ["товар", "законч"],
+        "добавить в избранное",
+    ],
+    # Бот просит ввести количество
+    "qty_prompt": [
+        "введите количеств",
+        "количество товара",
+        "минимальное количество",
+        "максимальное количество",
+        "выберите количеств",
+    ],
+}
+
+# Часть "retry", означающая "бот не понял ввод" (а не "товар закончился"): число
+# пришло раньше, чем бот стал его ждать, и его можно просто дослать
+UNRECOGNISED_INPUT_PHRASES = ("распознан", "воспользуйтесь кнопками")
+
+
+def is_unrecognised_input(text_lc: str) -> bool:
+    return any(phrase in text_lc for phrase in UNRECOGNISED_INPUT_PHRASES)
+
+
+def _phrase_key(phrase: Any) -> str:
+    return " ".join(str(phrase).lower().replace("ё", "е").split())
+
+
+def _trie_pattern(keys: Sequence[str]) -> str:
+    """Регулярное выражение по префиксному дереву фраз: общие начала проверяются
+    один раз, в каждой позиции совпадает самая длинная фраза. Пробел в фразе —
+    любой пробельный промежуток."""
+    trie: Dict[str, Any] = {}
+    for key in keys:
+        node = trie
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: Dict[str, Any]) -> str:
+        alts = [(r"\s+" if ch == " " else re.escape(ch)) + emit(child) for ch, child in node.items() if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return "(?:" + body + ")?" if "" in node else body
+
+    return emit(trie)
+
+
+class BotTextClassifier:
+    """Класс сообщения бота за один проход единым регулярным выражением.
+
+    Фразы собраны в одно выражение по префиксному дереву, текст проходит
+    один findall. Совпадения не пересекаются, поэтому каждое засчитывает
+    все фразы, которые в нём содержатся ("количество товара" — ещё и
+    "товар"), а для фраз, где хвост одной — начало другой, в дерево
+    добавлена их склейка. Приоритет: error > retry > qty_prompt > neutral.
+    Магазин-бот повторяет одни и те же тексты, поэтому результат кэшируется
+    по тексту.
+    """
+
+    ERROR = "error"
+    RETRY = "retry"
+    QTY_PROMPT = "qty_prompt"
+    NEUTRAL = "neutral"
+    PRIORITY = (ERROR, RETRY, QTY_PROMPT)
+
+    def __init__(self, phrases: Dict[str, List[Any]]):
+        # нормализованная фраза -> [(класс, номер составной фразы или -1, номер части)]
+        own: Dict[str, List[Tuple[str, int, int]]] = {}
+        # составные фразы: (класс, число частей)
+        self._conjunctions: List[Tuple[str, int]] = []
+        for cls in self.PRIORITY:
+            for entry in phrases.get(cls) or []:
+                parts = list(entry) if isinstance(entry, (list, tuple)) else [entry]
+                keys = [k for k in (_phrase_key(x) for x in parts) if k]
+                if not keys:
+                    continue
+                conj = -1
+                if len(keys) > 1:
+                    conj = len(self._conjunctions)
+                    self._conjunctions.append((cls, len(keys)))
+                for k, key in enumerate(keys):
+                    own.setdefault(key, []).append((cls, conj, k))
+        # Склейки пар пересекающихся фраз: "...количеств" + "количество товара"
+        keys = set(own)
+        for head in own:
+            for tail in own:
+                for n in range(1, min(len(head), len(tail))):
+                    if head.endswith(tail[:n]):
+                        keys.add(head + tail[n:])
+        # Результат прохода — одна битовая маска: биты 0..2 — найденные классы
+        # (по рангу в PRIORITY), выше — части составных фраз, составная i
+        # занимает биты с offsets[i].
+        n_ranks = len(self.PRIORITY)
+        offsets = list(itertools.accumulate((n for _, n in self._conjunctions), initial=n_ranks))
+        # составная фраза -> (маска всех её частей, бит её класса)
+        self._conj_done = [
+            (((1 << n) - 1) << offsets[i], 1 << self.PRIORITY.index(cls))
+            for i, (cls, n) in enumerate(self._conjunctions)
+        ]
+        self._rank_mask = (1 << n_ranks) - 1
+        # маска найденных классов -> класс с наивысшим приоритетом
+        self._by_ranks = tuple(
+            self.PRIORITY[(r & -r).bit_length() - 1] if r else self.NEUTRAL for r in range(self._rank_mask + 1)
+        )
+        # Выражение возвращает одно (самое длинное) совпадение в позиции и
+        # дальше ищет после него — вложенные фразы засчитываем через таблицу.
+        self._hits: Dict[str, int] = {}
+        for key in keys:
+            mask = 0
+            for other, hits in own.items():
+                if other in key:
+                    for cls, conj, k in hits:
+                        mask |= 1 << (offsets[conj] + k if conj >= 0 else self.PRIORITY.index(cls))
+            self._hits[key] = mask
+        # (?!) — ни одной фразы: выражение, которое никогда не совпадает
+        self._findall = re.compile(_trie_pattern(sorted(keys)) or "(?!)").findall
+        self.classify = functools.lru_cache(maxsize=256)(self.classify_uncached)
+
+    def classify_uncached(self, text_lc: str) -> str:
+        """text_lc — текст в нижнем регистре с заменой "ё" на "е"."""
+        hits = self._hits
+        seen = 0
+        for key in self._findall(text_lc):
+            try:
+                seen |= hits[key]
+            except KeyError:
+                # Перевод строки или несколько пробелов внутри фразы
+                seen |= hits[" ".join(key.split())]
+        if seen > self._rank_mask:
+            for full, cls_bit in self._conj_done:
+                if seen & full == full:
+                    seen |= cls_bit
+        return self._by_ranks[seen & self._rank_mask]
+
+
+def load_bot_phrases(path: Path) -> Dict[str, List[Any]]:
+    """Фразы по умолчанию, поверх — классы из JSON-файла (если есть)."""
+    phrases = {cls: list(items) for cls, items in DEFAULT_BOT_PHRASES.items()}
+    try:
+        if path.exists():
+            data = json.loads(path.read_text(encoding="utf-8"))
+            for cls in BotTextClassifier.PRIORITY:
+                items = data.get(cls)
+                if isinstance(items, list):
+                    phrases[cls] = items
+    except Exception as e:
+        logger.warning("Не удалось прочитать %s: %s", path, e)
+    return phrases
+
+
+# ========================
+# Темп /start
+# ========================
+class AdaptivePacer:
+    """AIMD-подбор интервала /start по измеренному RTT бота.
+
+    RTT — от первого неотвеченного /start до ближайшего ответа бота
+    (сглаживание как в TCP, α = 1/8). Каждый ответ уменьшает интервал на
+    step, но не ниже max(минимум, 1.5 × SRTT): /start быстрее ответа бота
+    только сбрасывает диалог. Тишина дольше интервала — +step, FloodWait —
+    интервал удваивается и не опускается ниже секунд ожидания сервера.
+    Любой путь держит интервал в границах [min, max].
+    """
+
+    __slots__ = ("min", "max", "step", "interval", "srtt", "_pending_since", "floods")
+
+    def __init__(self, initial: float, lo: float, hi: float, step: float = 0.1) -> None:
+        self.min = lo
+        self.max = max(lo, hi)
+        self.step = step
+        self.interval = min(self.max, max(self.min, initial))
+        self.srtt: Optional[float] = None
+        self._pending_since: Optional[float] = None
+        self.floods = 0
+
+    def set_bounds(self, lo: float, hi: float) -> None:
+        """Новые границы из config.txt / конфиг-бота; текущий интервал зажимается в них."""
+        self.min = lo
+        self.max = max(lo, hi)
+        self.interval = min(self.max, max(self.min, self.interval))
+
+    def on_start_sent(self, now: float) -> None:
+        if self._pending_since is None:
+            self._pending_since = now
+
+    def on_bot_reply(self, now: float) -> None:
+        since = self._pending_since
+        if since is None:
+            return
+        self._pending_since = None
+        sample = now - since
+        self.srtt = sample if self.srtt is None else self.srtt + (sample - self.srtt) / 8.0
+        floor = max(self.min, 1.5 * self.srtt)
+        self.interval = min(self.max, max(floor, self.interval - self.step))
+
+    def on_tick(self, now: float) -> None:
+        """Перед очередным /start: прошлый так и не получил ответа — замедляемся."""
+        since = self._pending_since
+        if since is not None and now - since >= self.interval:
+            self.interval = min(self.max, self.interval + self.step)
+
+    def on_flood_wait(self, seconds: float) -> None:
+        self.floods += 1
+        self.interval = min(self.max, max(self.interval * 2.0, float(seconds)))
+        # Ожидание FloodWait — не RTT бота
+        self._pending_since = None
+
+    def describe(self) -> str:
+        rtt = f"{self.srtt * 1000:.0f} мс" if self.srtt is not None else "—"
+        return (
+            f"{self.interval:.2f} с (RTT бота ~{rtt}, границы {self.min:g}–{self.max:g} с,"
+            f" FloodWait: {self.floods})"
+        )
+
+
+# ========================
+# Планировщик отправки
+# ========================
+class SendDropped(Exception):
+    """Повторный /start снят с очереди: готов более важный запрос."""
+
+
+# Выставляется на время вызова из планировщика: BuyerTelegramClient тогда не спит
+# на FloodWait внутри Telethon, а отдаёт ошибку — общий дедлайн держит планировщик
+_NO_FLOOD_SLEEP: contextvars.ContextVar[bool] = contextvars.ContextVar("no_flood_sleep", default=False)
+
+
+class _SendRequest:
+    __slots__ = ("priority", "seq", "factory", "future", "droppable", "cost", "waiters")
+
+    def __init__(self, priority: int, seq: int, factory: Callable[[], Any], future: asyncio.Future,
+                 droppable: bool, cost: float) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.factory = factory
+        self.future = future
+        self.droppable = droppable
+        self.cost = cost
+        self.waiters = 0
+
+    def __lt__(self, other: "_SendRequest") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler:
+    """Единая точка отправки целевому боту: token bucket, приоритеты, общий FloodWait.
+
+    Свободный токен и пустая очередь — запрос выполняется сразу в задаче
+    вызывающего, без лишнего прохода цикла. Иначе запрос ждёт в куче по
+    приоритету (оплата > количество > /start); диспетчер выпускает их по мере
+    токенов, каждый — отдельной задачей, так что медленный RPC не держит
+    остальные. FloodWait любого запроса сдвигает общий дедлайн: до него не
+    уходит ничего. Повторные /start в очереди сливаются в один, а спамовые
+    снимаются, как только в очереди появляется оплата или количество.
+    """
+
+    PAY = 0
+    QTY = 1
+    START = 2
+    NAMES = {PAY: "оплата", QTY: "кол-во", START: "/start"}
+
+    def __init__(self, rate: float = 10.0, burst: float = 5.0,
+                 on_flood: Optional[Callable[[float], None]] = None) -> None:
+        self.rate = max(0.1, float(rate))
+        # Единственное место, где ловится FloodWait отправки: счётчик, пейсер, продление попытки
+        self.on_flood = on_flood
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.flood_until = 0.0
+        self._stamp: Optional[float] = None
+        self._queue: List[_SendRequest] = []
+        self._seq = itertools.count()
+        self._pending_start: Optional[_SendRequest] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set[asyncio.Task] = set()
+        self.sent = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.floods = 0
+
+    @staticmethod
+    def _now() -> float:
+        # Часы цикла событий: в симуляторе время виртуальное
+        return asyncio.get_running_loop().time()
+
+    def _refill(self, now: float) -> None:
+        if self._stamp is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def submit(self, priority: int, factory: Callable[[], Any], *, droppable: bool = False,
+                     cost: float = 1.0) -> Any:
+        """Выполняет factory() с учётом лимитов; droppable — спамовый /start, его можно снять.
+        cost — сколько запросов несёт factory (пачка в одном контейнере), не больше пачки bucket."""
+        now = self._now()
+        self._refill(now)
+        cost = min(float(cost), self.burst)
+        if not self._queue and now >= self.flood_until and self.tokens >= cost:
+            self.tokens -= cost
+            return await self._call(factory)
+        if droppable and priority == self.START and self._has_urgent():
+            # Оплата или количество ещё ждут отправки: спамовый /start за ними сбросил бы диалог
+            self.dropped += 1
+            raise SendDropped()
+        req = self._pending_start if priority == self.START else None
+        if req is not None and not req.future.done():
+            # /start уже ждёт в очереди — второй ничего не добавит
+            self.coalesced += 1
+            req.droppable = req.droppable and droppable
+        else:
+            if priority < self.START:
+                self._drop_starts()
+            req = _SendRequest(priority, next(self._seq), factory,
+                               asyncio.get_running_loop().create_future(), droppable, cost)
+            heapq.heappush(self._queue, req)
+            if priority == self.START:
+                self._pending_start = req
+            self.queued += 1
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._drain())
+        req.waiters += 1
+        try:
+            return await asyncio.shield(req.future)
+        except asyncio.CancelledError:
+            # Запрос, который больше никто не ждёт, не отправляем
+            req.waiters -= 1
+            if req.waiters == 0 and not req.future.done():
+                req.future.cancel()
+            raise
+
+    def _has_urgent(self) -> bool:
+        return any(r.priority < self.START and not r.future.done() for r in self._queue)
+
+    def _drop_starts(self) -> None:
+        req = self._pending_start
+        if req is not None and req.droppable and not req.future.done():
+            req.future.set_exception(SendDropped())
+            self._pending_start = None
+            self.dropped += 1
+
+    async def _drain(self) -> None:
+        queue = self._queue
+        while queue:
+            req = queue[0]
+            if req.future.done():
+                # Снят, отменён или слит — выбрасываем без токена
+                heapq.heappop(queue)
+                if req is self._pending_start:
+                    self._pending_start = None
+                continue
+            now = self._now()
+            self._refill(now)
+            wait = self.flood_until - now
+            if self.tokens < req.cost:
+                wait = max(wait, (req.cost - self.tokens) / self.rate)
+            if wait > 0:
+                # После паузы голова очереди могла смениться на более важный запрос
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(queue)
+            if req is self._pending_start:
+                self._pending_start = None
+            self.tokens -= req.cost
+            task = asyncio.create_task(self._run(req))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, req: _SendRequest) -> None:
+        try:
+            result = await self._call(req.factory)
+        except Exception as e:
+            if not req.future.done():
+                req.future.set_exception(e)
+            return
+        if not req.future.done():
+            req.future.set_result(result)
+
+    async def _call(self, factory: Callable[[], Any]) -> Any:
+        token = _NO_FLOOD_SLEEP.set(True)
+        try:
+            result = await factory()
+        except SendDropped:
+            # Запрос сам отказался уходить (спамовый /start после отправки числа)
+            self.dropped += 1
+            raise
+        except FloodWaitError as e:
+            self.floods += 1
+            self.flood_until = max(self.flood_until, self._now() + e.seconds + 0.5)
+            if self.on_flood is not None:
+                try:
+                    self.on_flood(float(e.seconds))
+                except Exception:
+                    pass
+            raise
+        finally:
+            _NO_FLOOD_SLEEP.reset(token)
+        self.sent += 1
+        return result
+
+    def flood_remaining(self) -> float:
+        try:
+            return max(0.0, self.flood_until - self._now())
+        except RuntimeError:
+            return 0.0
+
+    def describe(self) -> str:
+        text = (
+            f"{self.rate:g}/с, пачка {self.burst:g}; отправлено {self.sent}, ждали в очереди {self.queued},"
+            f" /start слито {self.coalesced}, снято {self.dropped}, FloodWait {self.floods}"
+        )
+        left = self.flood_remaining()
+        if left > 0:
+            text += f" (пауза ещё {left:.1f} с)"
+        return text
+
+
+# ========================
+# Рамка попытки
+# ========================
+class AttemptScope:
+    """Одна попытка покупки: её задачи, подвижный дедлайн и исход.
+
+    Всё, что запускает попытка (первый /start, спам /start, упреждающее
+    число, разбор сообщений бота, проверки тишины), создаётся через spawn.
+    Выход из `async with` отменяет эти задачи разом, так что ничто из
+    прошлой попытки не отправит /start в следующую. wait() возвращает
+    True/False по succeed()/fail() или None по дедлайну; дедлайн можно
+    сдвигать (postpone), но не дальше hard_deadline.
+    """
+
+    __slots__ = ("deadline", "hard_deadline", "closed", "_loop", "_outcome", "_tasks", "_changed")
+
+    def __init__(self, timeout: float, hard_deadline: Optional[float] = None) -> None:
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self.hard_deadline = hard_deadline
+        self.deadline = self._cap(loop.time() + timeout)
+        self.closed = False
+        self._outcome: asyncio.Future = loop.create_future()
+        self._tasks: set = set()
+        self._changed: Optional[asyncio.Future] = None
+
+    def _cap(self, deadline: float) -> float:
+        return deadline if self.hard_deadline is None else min(deadline, self.hard_deadline)
+
+    @property
+    def done(self) -> bool:
+        return self._outcome.done()
+
+    def result(self) -> Optional[bool]:
+        return self._outcome.result() if self._outcome.done() else None
+
+    def spawn(self, coro) -> Optional[asyncio.Task]:
+        if self.closed:
+            coro.close()
+            return None
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled():
+            # Исход попытки решают succeed/fail, но ошибку в горячем пути не глотаем молча
+            exc = task.exception()
+            if exc is not None:
+                logger.debug("Задача попытки %s завершилась ошибкой", task.get_coro(), exc_info=exc)
+
+    def succeed(self) -> None:
+        self._resolve(True)
+
+    def fail(self) -> None:
+        self._resolve(False)
+
+    def _resolve(self, value: bool) -> None:
+        if not self._outcome.done():
+            self._outcome.set_result(value)
+
+    def postpone(self, seconds: float) -> None:
+        self.set_deadline(self.deadline + seconds)
+
+    def set_deadline(self, deadline: float) -> None:
+        self.deadline = self._cap(deadline)
+        changed = self._changed
+        if changed is not None and not changed.done():
+            changed.set_result(None)
+
+    async def wait(self) -> Optional[bool]:
+        outcome = self._outcome
+        while not outcome.done():
+            remaining = self.deadline - self._loop.time()
+            if remaining <= 0:
+                return None
+            self._changed = self._loop.create_future()
+            await asyncio.wait((outcome, self._changed), timeout=remaining,
+                               return_when=asyncio.FIRST_COMPLETED)
+        return outcome.result()
+
+    def cancel(self) -> None:
+        """Закрывает попытку без ожидания: задачи отменены, исход — неудача (если не решён)."""
+        self.closed = True
+        self._resolve(False)
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def close(self) -> None:
+        self.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def __aenter__(self) -> "AttemptScope":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+# ========================
+# Диалог покупки
+# ========================
+class PurchaseDialog:
+    """Конечный автомат диалога с магазин-ботом в рамках одной попытки.
+
+    Экран (класс текста + план разметки) сводится к виду, дальше — один поиск
+    в таблице (состояние, вид, свежесть) → (новое состояние, действия).
+    "Свежий" экран новее нашего последнего числа по id (id в личке с ботом
+    общие и монотонны): такой экран — реакция бота уже после числа, например
+    на очередной /start; несвежие экраны карточки/промпта после отправки числа
+    игнорируются, это и убирает повторные отправки количества.
+
+    Экраны не новее первого /start попытки (floor_id) — ответы на сообщения
+    прошлых попыток, их автомат пропускает; правка старого сообщения живая,
+    если сделана не раньше этого /start (floor_date). Пока число ещё в пути (busy),
+    свежие карточки тоже не выбираются заново: id нашего числа ещё неизвестен.
+    """
+
+    # Состояния
+    START = "start"          # /start отправлен, ждём карточку товара
+    SCANNING = "scanning"    # ищем кнопку "своё кол-во" в истории; живая карточка имеет приоритет
+    QTY_EARLY = "qty_early"  # нажали "своё кол-во" и сразу отправили число; промпт на нажатие ещё впереди
+    QTY_SENT = "qty_sent"    # число отправлено и промпт учтён; ждём экран оплаты
+    DONE = "done"            # оплата нажата или попытка провалена
+
+    # Виды экранов
+    ERROR = "error"
+    RETRY = "retry"
+    UNRECOGNISED = "unrecognised"    # "не распознал" — бот получил число не вовремя
+    PAYMENT = "payment"
+    OWN_QTY = "own_qty"
+    NUMERIC = "numeric"
+    QTY_PROMPT = "qty_prompt"        # просьба ввести количество, в сообщении есть разметка
+    QTY_PROMPT_BARE = "qty_prompt_bare"  # та же просьба без кнопок — кнопку ищем в истории
+    RECENT = "recent"                # начало попытки: кнопка могла остаться в истории чата
+    OTHER = "other"
+
+    # Действия
+    FAIL = "fail"
+    CLICK_OWN_QTY = "click_own_qty"
+    CLICK_NUMERIC = "click_numeric"
+    CLICK_PAYMENT = "click_payment"
+    SEND_QTY = "send_qty"
+    SCAN = "scan"
+
+    TRANSITIONS: Dict[Tuple[str, str, bool], Tuple[str, Tuple[str, ...]]] = {}
+
+    __slots__ = ("state", "qty_msg_id", "floor_id", "floor_date", "busy")
+
+    def __init__(self, floor_id: Optional[int] = 0) -> None:
+        self.state = self.START
+        self.qty_msg_id = 0
+        # None — /start попытки ещё не ушёл, любой экран относится к прошлым попыткам
+        self.floor_id = floor_id
+        self.floor_date: Optional[datetime] = None
+        self.busy = False
+
+    @classmethod
+    def screen_kind(cls, msg_class: str, plan: Optional[MarkupPlan], text_lc: str = "") -> str:
+        if msg_class == BotTextClassifier.ERROR:
+            return cls.ERROR
+        if msg_class == BotTextClassifier.RETRY:
+            return cls.UNRECOGNISED if is_unrecognised_input(text_lc) else cls.RETRY
+        if plan is not None:
+            if plan.own_qty is not None:
+                return cls.OWN_QTY
+            if plan.numeric is not None:
+                return cls.NUMERIC
+            if plan.payments:
+                return cls.PAYMENT
+        if msg_class == BotTextClassifier.QTY_PROMPT:
+            return cls.QTY_PROMPT if plan is not None else cls.QTY_PROMPT_BARE
+        return cls.OTHER
+
+    def step(self, kind: str, msg_id: int, edit_date: Optional[datetime] = None) -> Tuple[str, ...]:
+        """Переход по экрану; возвращает действия. Неизвестная пара — без действий."""
+        if kind != self.RECENT and (self.floor_id is None or msg_id <= self.floor_id):
+            floor_date = self.floor_date
+            if edit_date is None or floor_date is None or edit_date < floor_date:
+                return ()
+        fresh = msg_id > self.qty_msg_id and not self.busy
+        next_state, actions = self.TRANSITIONS.get((self.state, kind, fresh), (self.state, ()))
+        if next_state == self.QTY_EARLY and actions:
+            self.busy = True
+        self.state = next_state
+        return actions
+
+    def wants_start(self) -> bool:
+        """Повторный /start ещё полезен: число не отправлено. После него /start
+        только вернул бы бота к карточке и сбросил ввод количества."""
+        return self.state == self.START or self.state == self.SCANNING
+
+    def revert(self, prev_state: str, expected_state: str) -> None:
+        """Откат неудачного перехода, если состояние с тех пор никто не менял."""
+        if self.state == expected_state:
+            self.state = prev_state
+            self.busy = False
+
+    def note_start(self, sent: Any) -> None:
+        msg_id = getattr(sent, "id", None)
+        self.floor_id = msg_id if isinstance(msg_id, int) else 0
+        date = getattr(sent, "date", None)
+        self.floor_date = date if isinstance(date, datetime) else None
+
+    def note_qty_sent(self, sent: Any) -> None:
+        self.busy = False
+        msg_id = getattr(sent, "id", None)
+        if isinstance(msg_id, int) and msg_id > self.qty_msg_id:
+            self.qty_msg_id = msg_id
+
+
+def _build_dialog_transitions() -> Dict[Tuple[str, str, bool], Tuple[str, Tuple[str, ...]]]:
+    D = PurchaseDialog
+    select_own = (D.QTY_EARLY, (D.CLICK_OWN_QTY, D.SEND_QTY))
+    select_numeric = (D.QTY_SENT, (D.CLICK_NUMERIC, D.CLICK_PAYMENT))
+    scan = (D.SCANNING, (D.SCAN, D.SEND_QTY))
+    table: Dict[Tuple[str, str, bool], Tuple[str, Tuple[str, ...]]] = {}
+    for state in (D.START, D.SCANNING, D.QTY_EARLY, D.QTY_SENT):
+        for fresh in (False, True):
+            table[(state, D.ERROR, fresh)] = (D.DONE, (D.FAIL,))
+            table[(state, D.RETRY, fresh)] = (D.DONE, (D.FAIL,))
+            table[(state, D.UNRECOGNISED, fresh)] = (D.DONE, (D.FAIL,))
+            table[(state, D.PAYMENT, fresh)] = (D.DONE, (D.CLICK_PAYMENT,))
+    for fresh in (False, True):
+        table[(D.START, D.OWN_QTY, fresh)] = select_own
+        table[(D.START, D.NUMERIC, fresh)] = select_numeric
+        table[(D.START, D.QTY_PROMPT, fresh)] = (D.QTY_SENT, (D.SEND_QTY,))
+        table[(D.START, D.QTY_PROMPT_BARE, fresh)] = scan
+        table[(D.START, D.RECENT, fresh)] = scan
+        # Живой экран во время поиска по истории обрабатывается как в START
+        table[(D.SCANNING, D.OWN_QTY, fresh)] = select_own
+        table[(D.SCANNING, D.NUMERIC, fresh)] = select_numeric
+        table[(D.SCANNING, D.QTY_PROMPT, fresh)] = (D.QTY_SENT, (D.SEND_QTY,))
+        # Промпт в ответ на наше нажатие: число уже в пути
+        table[(D.QTY_EARLY, D.QTY_PROMPT, fresh)] = (D.QTY_SENT, ())
+        table[(D.QTY_EARLY, D.QTY_PROMPT_BARE, fresh)] = (D.QTY_SENT, ())
+    # После числа реагируем только на экраны новее него (бот начал диалог заново или переспросил)
+    for state in (D.QTY_EARLY, D.QTY_SENT):
+        table[(state, D.OWN_QTY, True)] = select_own
+        table[(state, D.NUMERIC, True)] = select_numeric
+        # Не распознано одно из наших чисел (раннее или повтор по устаревшей карточке):
+        # ответ на последнее ещё впереди, а /start снова нужен — откатываемся к карточке
+        table[(state, D.UNRECOGNISED, False)] = (D.START, ())
+        table[(state, D.UNRECOGNISED, True)] = (D.START, ())
+    table[(D.QTY_SENT, D.QTY_PROMPT, True)] = (D.QTY_SENT, (D.SEND_QTY,))
+    table[(D.QTY_SENT, D.QTY_PROMPT_BARE, True)] = (D.QTY_SENT, (D.SEND_QTY,))
+    return table
+
+
+PurchaseDialog.TRANSITIONS = _build_dialog_transitions()
+
+
+# ========================
+# Запись диалогов (воспроизведение — porn2o_sim.py)
+# ========================
+def _button_url(btn) -> Optional[str]:
+    url = getattr(btn, "url", None)
+    if url is None:
+        url = getattr(getattr(btn, "type", None), "url", None)
+    return url if isinstance(url, str) else None
+
+
+def _markup_to_rows(markup) -> Optional[List[List[List[Any]]]]:
+    """Компактная форма разметки: [[текст, data в hex или None, url или None], ...] по рядам."""
+    rows = getattr(markup, "rows", None)
+    if markup is None or rows is None:
+        return None
+    out = []
+    for row in rows:
+        cells = []
+        for btn in getattr(row, "buttons", None) or ():
+            data = _button_callback_data(btn)
+            cells.append([getattr(btn, "text", "") or "", data.hex() if data else None, _button_url(btn)])
+        out.append(cells)
+    return out
+
+
+class DialogRecorder:
+    """Запись диалога с магазин-ботом: gzip JSONL в config_dir/recordings/<run_id>.jsonl.gz.
+
+    На горячем пути — только добавление записи в список. По окончании попытки
+    буфер забирается в цикле событий (take), а сжатие и запись на диск
+    выполняются в пуле потоков (write).
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._pending: List[Dict[str, Any]] = []
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _now(self) -> float:
+        return round(time.monotonic() - self._t0, 6)
+
+    def begin_attempt(self, **meta: Any) -> None:
+        self._pending.append({"k": "attempt", "t": self._now(), **meta})
+
+    def incoming(self, message) -> None:
+        date = getattr(message, "date", None)
+        self._pending.append({
+            "k": "in",
+            "t": self._now(),
+            "id": getattr(message, "id", None),
+            "date": date.timestamp() if isinstance(date, datetime) else None,
+            "text": getattr(message, "message", None) or getattr(message, "text", "") or "",
+            "markup": _markup_to_rows(getattr(message, "reply_markup", None)),
+        })
+        edit_date = getattr(message, "edit_date", None)
+        if isinstance(edit_date, datetime):
+            self._pending[-1]["edit"] = edit_date.timestamp()
+
+    def outgoing(self, kind: str, **fields: Any) -> None:
+        self._pending.append({"k": kind, "t": self._now(), **fields})
+
+    def take(self) -> List[Dict[str, Any]]:
+        """Забирает накопленные записи; вызывается в цикле событий."""
+        pending, self._pending = self._pending, []
+        return pending
+
+    def flush(self) -> int:
+        """Синхронная запись всего буфера (при выходе из программы)."""
+        return self.write(self.take())
+
+    def write(self, pending: List[Dict[str, Any]]) -> int:
+        """Выполняется в пуле потоков. Gzip дописывается новым членом — файл читается целиком."""
+        if not pending:
+            return 0
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                for entry in pending:
+                    f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        return len(pending)
+
+
+# ========================
+# Дедупликация сообщений
+# ========================
+class RecentIdFilter:
+    """Ограниченная по памяти дедупликация (peer, msg_id).
+
+    ID сообщений монотонны в пределах peer, поэтому новое сообщение почти
+    всегда выше отметки peer — это одно сравнение целых. Опоздавшие апдейты
+    (ниже отметки не более чем на reorder) сверяются с окном последних ключей:
+    кольцо фиксированной ёмкости + множество, записи старше ttl вытесняются.
+    Всё, что ниже отметки и за пределами reorder, считается уже обработанным.
+    """
+
+    __slots__ = ("capacity", "ttl", "reorder", "total", "_high", "_ring", "_seen")
+
+    def __init__(self, capacity: int = 4096, ttl: float = 3600.0, reorder: int = 256) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.reorder = reorder
+        self.total = 0
+        self._high: Dict[Any, int] = {}
+        self._ring: Deque[Tuple[float, Tuple[Any, int]]] = deque()
+        self._seen: set = set()
+
+    def seen_or_add(self, peer: Any, msg_id: int) -> bool:
+        """True — сообщение уже обработано; иначе запоминает его и возвращает False."""
+        high = self._high.get(peer)
+        if high is None or msg_id > high:
+            self._high[peer] = msg_id
+        else:
+            key = (peer, msg_id)
+            if high - msg_id > self.reorder or key in self._seen:
+                return True
+        self._remember((peer, msg_id))
+        return False
+
+    def _remember(self, key: Tuple[Any, int]) -> None:
+        now = time.monotonic()
+        ring = self._ring
+        seen = self._seen
+        ring.append((now, key))
+        seen.add(key)
+        self.total += 1
+        expire = now - self.ttl
+        while len(ring) > self.capacity or ring[0][0] < expire:
+            seen.discard(ring.popleft()[1])
+
+    def __len__(self) -> int:
+        return len(self._ring)
+
+    def memory_bytes(self) -> int:
+        """Оценка памяти: контейнеры плюс кортежи записей (ключи-int не считаем)."""
+        entry = sys.getsizeof((0.0, None)) + sys.getsizeof((0, 0))
+        return (
+            sys.getsizeof(self._high) + sys.getsizeof(self._ring) + sys.getsizeof(self._seen)
+            + len(self._ring) * entry
+        )
+
+    def describe(self) -> str:
+        return (
+            f"{len(self._ring)}/{self.capacity} в окне {self.ttl / 60:.0f} мин, peers {len(self._high)},"
+            f" всего {self.total}, ~{self.memory_bytes() / 1024:.0f} КБ"
+        )
+
+
+# ========================
+# Кэш сообщений бота
+# ========================
+class RecentMessageCache:
+    """Последние сообщения магазин-бота из апдейтов — "последнее" и "последние N" без RPC.
+
+    Наполняется обработчиками новых и отредактированных сообщений (правка
+    заменяет сообщение по id). Полным кэш считается после заполнения из
+    истории: дальше всё новое приходит апдейтами. Переподключение могло
+    потерять апдейты — кэш помечается неполным, и следующий запрос один раз
+    идёт в сеть, чтобы закрыть дыру.
+    """
+
+    __slots__ = ("capacity", "complete", "fills", "invalidations", "_messages")
+
+    def __init__(self, capacity: int = 16) -> None:
+        self.capacity = capacity
+        self.complete = False
+        self.fills = 0
+        self.invalidations = 0
+        self._messages: Dict[int, Any] = {}
+
+    def put(self, message) -> None:
+        msg_id = getattr(message, "id", None)
+        if not isinstance(msg_id, int) or getattr(message, "out", False):
+            return
+        messages = self._messages
+        messages[msg_id] = message
+        if len(messages) > self.capacity:
+            del messages[min(messages)]
+
+    def fill(self, messages) -> None:
+        """Сообщения из истории чата (наши исходящие пропускаются); после этого кэш полный."""
+        for message in messages or ():
+            self.put(message)
+        self.complete = True
+        self.fills += 1
+
+    def invalidate(self) -> None:
+        self.complete = False
+        self.invalidations += 1
+
+    def latest(self, limit: int) -> List[Any]:
+        """До limit сообщений, новые первыми."""
+        messages = self._messages
+        return [messages[i] for i in sorted(messages, reverse=True)[:limit]]
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def describe(self) -> str:
+        state = "полный" if self.complete else "ждёт дозагрузки"
+        return f"{len(self._messages)}/{self.capacity}, {state}, загрузок {self.fills}, разрывов {self.invalidations}"
+
+
+class BuyerTelegramClient(TelegramClient):
+    """TelegramClient с хуком on_reconnect: после автопереподключения апдейты могли потеряться.
+
+    Для запросов из SendScheduler порог сна на FloodWait — 0: ошибка сразу уходит
+    планировщику. Остальные вызовы (команды, get_entity, история, конфиг-бот)
+    спят по обычному flood_sleep_threshold.
+    """
+
+    @property
+    def flood_sleep_threshold(self):
+        if _NO_FLOOD_SLEEP.get():
+            return 0
+        return TelegramClient.flood_sleep_threshold.fget(self)
+
+    @flood_sleep_threshold.setter
+    def flood_sleep_threshold(self, value):
+        TelegramClient.flood_sleep_threshold.fset(self, value)
+
+    def __init__(self, *args, on_reconnect: Optional[Callable[[], None]] = None, **kwargs) -> None:
+        self.on_reconnect = on_reconnect
+        super().__init__(*args, **kwargs)
+
+    async def _handle_auto_reconnect(self):
+        # Телетон вызывает этот метод после каждого успешного переподключения
+        callback = self.on_reconnect
+        if callback is not None:
+            try:
+                callback()
+            except Exception:
+                pass
+        await super()._handle_auto_reconnect()
+
+
+# ========================
+# Очередь автопокупок
+# ========================
+@dataclass
+class PurchaseJob:
+    """Сработавшее правило мониторинга: что купить, насколько это важно и до какого момента."""
+
+    link: str
+    qty: str
+    priority: int = 0  # больше — важнее
+    deadline: float = 0.0  # часы цикла событий
+    keyword: str = ""
+    channel_id: Optional[int] = None
+    post_date: Optional[datetime] = None
+    seq: int = 0
+    preempted: bool = False
+    coalesced: int = 0  # сколько более ранних срабатываний по этой ссылке он заменил
+
+    def sort_key(self) -> Tuple[int, int]:
+        return (-self.priority, self.seq)
+
+
+class PurchaseScheduler:
+    """Очередь автопокупок по постам каналов: одна покупка за раз, остальные ждут.
+
+    Срабатывания по одной ссылке сливаются — остаётся последнее (его количество,
+    приоритет и дедлайн). Следующая покупка стартует сразу по завершении текущей;
+    просроченные срабатывания выбрасываются, не начавшись. Срабатывание с более
+    высоким приоритетом вытесняет идущую покупку: она останавливается через stop()
+    и возвращается в очередь с прежним дедлайном. busy() — покупка, запущенная
+    вручную (.run): очередь ждёт её завершения, wake() будит очередь после неё.
+    """
+
+    DEFAULT_DEADLINE = 13 * 60.0
+
+    def __init__(self, runner: Callable[[PurchaseJob], Any], stop: Callable[[], None],
+                 busy: Callable[[], bool]) -> None:
+        self._runner = runner
+        self._stop = stop
+        self._busy = busy
+        self._queue: List[Tuple[Tuple[int, int], PurchaseJob]] = []
+        self._pending: Dict[str, PurchaseJob] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.current: Optional[PurchaseJob] = None
+        self.started = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.preemptions = 0
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def submit(self, job: PurchaseJob) -> str:
+        """Ставит срабатывание в очередь. Возвращает, что с ним стало:
+        "queued", "coalesced" (заменило ждущее по той же ссылке), "running" (эта
+        ссылка уже покупается) или "preempt" (вытесняет идущую покупку)."""
+        now = self._now()
+        if job.deadline <= 0:
+            job.deadline = now + self.DEFAULT_DEADLINE
+        job.seq = next(self._seq)
+        current = self.current
+        if current is not None and current.link == job.link and not current.preempted:
+            # Ссылка уже покупается — новое срабатывание ничего не добавит
+            current.coalesced += 1
+            self.coalesced += 1
+            return "running"
+        outcome = "queued"
+        old = self._pending.pop(job.link, None)
+        if old is not None:
+            job.coalesced = old.coalesced + 1
+            self.coalesced += 1
+            outcome = "coalesced"
+        self._pending[job.link] = job
+        heapq.heappush(self._queue, (job.sort_key(), job))
+        if current is not None and not current.preempted and job.priority > current.priority:
+            current.preempted = True
+            self.preemptions += 1
+            self._stop()
+            outcome = "preempt"
+        self.wake()
+        return outcome
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if (self._task is None or self._task.done()) and self._queue:
+            self._task = asyncio.create_task(self._run())
+
+    def _pop(self) -> Optional[PurchaseJob]:
+        now = self._now()
+        while self._queue:
+            _, job = heapq.heappop(self._queue)
+            if self._pending.get(job.link) is not job:
+                # Заменено более поздним срабатыванием по той же ссылке
+                continue
+            del self._pending[job.link]
+            if job.deadline <= now:
+                self.expired += 1
+                continue
+            return job
+        return None
+
+    async def _run(self) -> None:
+        self._wakeup = asyncio.Event()
+        try:
+            while self._queue:
+                if self._busy():
+                    # Идёт ручная покупка — ждём wake() из её завершения
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                job = self._pop()
+                if job is None:
+                    break
+                job.preempted = False
+                self.current = job
+                self.started += 1
+                success = False
+                try:
+                    success = bool(await self._runner(job))
+                except Exception:
+                    pass
+                finally:
+                    self.current = None
+                if job.preempted and not success and job.deadline > self._now() and job.link not in self._pending:
+                    # Вытеснена — продолжит после более важных, срок прежний
+                    self._pending[job.link] = job
+                    heapq.heappush(self._queue, (job.sort_key(), job))
+        finally:
+            self._wakeup = None
+
+    def clear(self) -> int:
+        """Снимает все ждущие срабатывания (идущую покупку не трогает)."""
+        dropped = len(self._pending)
+        self._queue.clear()
+        self._pending.clear()
+        return dropped
+
+    def pending(self) -> List[PurchaseJob]:
+        return sorted(self._pending.values(), key=PurchaseJob.sort_key)
+
+    def describe(self) -> str:
+        text = (
+            f"в очереди {len(self._pending)}; запущено {self.started}, слито {self.coalesced},"
+            f" просрочено {self.expired}, вытеснений {self.preemptions}"
+        )
+        if self.current is not None:
+            text += f"; сейчас {self.current.link} (приоритет {self.current.priority})"
+        return text
+
+
+# ========================
+# Горячий путь
+# ========================
+class HotPathContext(NamedTuple):
+    """Неизменяемый снимок параметров горячего пути.
+
+    Собирается при прогреве и заново после смены конфигурации
+    (ConfigAdapter.version), количества или peer бота: отправки берут готовые
+    InputPeer и тексты вместо нормализации ключей конфигурации, разбора
+    username и f-строк на каждый вызов.
+    """
+
+    bot: Any  # InputPeer бота; username, пока peer не разрешён
+    start_text: str
+    qty_text: str
+    retries_max: int
+    retries_base: float
+    retries_jitter: float
+    config_version: int
+
+
+def _input_peer_to_json(peer) -> Optional[Dict[str, Any]]:
+    if isinstance(peer, tl_types.InputPeerUser):
+        return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+    if isinstance(peer, tl_types.InputPeerChannel):
+        return {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+    if isinstance(peer, tl_types.InputPeerChat):
+        return {"type": "chat", "id": peer.chat_id}
+    return None
+
+
+def _input_peer_from_json(raw: Any) -> Optional[Any]:
+    try:
+        kind = raw.get("type")
+        if kind == "user":
+            return tl_types.InputPeerUser(int(raw["id"]), int(raw["access_hash"]))
+        if kind == "channel":
+            return tl_types.InputPeerChannel(int(raw["id"]), int(raw["access_hash"]))
+        if kind == "chat":
+            return tl_types.InputPeerChat(int(raw["id"]))
+    except Exception:
+        pass
+    return None
+
+
+def load_bot_peer(path: Path, bot: str, session: str) -> Optional[Any]:
+    """InputPeer бота из прошлого запуска. access_hash привязан к аккаунту,
+    поэтому запись другого бота или другой сессии не используется."""
+    try:
+        if path.exists():
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if data.get("bot") == bot and data.get("session") == session:
+                return _input_peer_from_json(data.get("peer"))
+    except Exception as e:
+        logger.debug("Peer бота %s не прочитан: %s", path, e)
+    return None
+
+
+def save_bot_peer(path: Path, bot: str, session: str, peer: Any) -> None:
+    raw = _input_peer_to_json(peer)
+    if raw is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"bot": bot, "session": session, "peer": raw}), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.debug("Peer бота не сохранён в %s: %s", path, e)
+
+
 class FinalAutoBuyer:
-    def __init__(self):
-        # Загружаем конфигурацию из config.txt рядом с exe/скриптом
-        config_path = str(_run_dir().joinpath("config.txt"))
-        self.config, self.products = load_config(config_path)
+    MAX_TRACKED_EDITS = 256
+
+    def __init__(self, config: Optional[ConfigAdapter] = None):
+        if config is None:
+            # Загружаем конфигурацию из config.txt рядом с exe/скриптом
+            config_path = str(_run_dir().joinpath("config.txt"))
+            self.config, self.products = load_config(config_path)
+        else:
+            # Готовая конфигурация (симулятор, бенчмарки)
+            self.config, self.products = config, {}
         setup_logging(bool(self.config.get("VERBOSE", False)))
         logger.debug("Загружено %s преднастроенных товаров", len(self.products))
 
         self.client: Optional[TelegramClient] = None
+        # Снимок параметров горячего пути (_hot); сбрасывается при смене количества/peer бота
+        self._hot_ctx: Optional[HotPathContext] = None
         self.quantity: Optional[str] = None
         self.is_running: bool = False
 
         # Состояние оркестрации
-        self._purchase_done: Optional[asyncio.Future] = None
+        self._scope: Optional[AttemptScope] = None
         self._profiler = LatencyProfiler()
-        self._processed_msg_ids: set = set()
-        self._preemptive_task: Optional[asyncio.Task] = None
-        self._start_spammer_task: Optional[asyncio.Task] = None
+        for counter in (
+            "attempts", "successes", "flood_waits", "watch_posts_seen", "watch_posts_matched",
+            "pipeline_qty_sent", "pipeline_qty_accepted", "pipeline_qty_rejected", "batch_qty_rejected",
+            "playbook_hit", "playbook_miss", "recent_cache_hit", "recent_cache_miss",
+        ):
+            self._profiler.incr(counter, 0)
+        self._metrics_server: Optional[MetricsServer] = None
+        self._loop_monitor = LoopLagMonitor(self._profiler)
+        self._server_clock = ServerClockEstimator()
+        self._run_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        self._run_started_at = datetime.now(timezone.utc).isoformat()
+        self._history = MetricsHistory(license_client.config_dir / "metrics_history.bin")
+        # Фоновые задачи без ожидающего: держим ссылки, иначе GC может снять их на полпути
+        self._background_tasks: set[asyncio.Task] = set()
+        # Запись диалога с ботом для офлайн-воспроизведения (--replay)
+        self._recorder: Optional[DialogRecorder] = None
+        if self.config.get("RECORD_DIALOGS"):
+            self._recorder = DialogRecorder(license_client.config_dir / "recordings" / f"{self._run_id}.jsonl.gz")
+        self._classifier: Optional[ButtonClassifier] = None
+        # Плейбук экранов текущей ссылки товара (подгружается в фоне при старте покупки)
+        self._playbook: Optional[MarkupPlaybook] = None
+        self._sender = SendScheduler(
+            float(self.config.get("SEND_RATE", 10.0)),
+            float(self.config.get("SEND_BURST", 5.0)),
+            on_flood=self._on_flood_wait,
+        )
+        # Автопокупки по постам: очередь по приоритету правил, ручной .run имеет преимущество
+        self._purchases = PurchaseScheduler(self._run_watch_purchase, self._preempt_purchase, lambda: self.is_running)
+        self._pacer = AdaptivePacer(
+            float(self.config.get("START_INTERVAL", 1.5)),
+            float(self.config.get("START_INTERVAL_MIN", 0.3)),
+            float(self.config.get("START_INTERVAL_MAX", 5.0)),
+        )
+        # Версия конфига, с которой сняты границы пейсера (см. _start_interval)
+        self._pacer_config_version = getattr(self.config, "version", None)
+        # Конвейерная отправка количества: номер сообщения бота, после которого
+        # число ушло вслед за нажатием, и счётчик обработанных сообщений бота
+        self._pipeline_pending: Optional[int] = None
+        # Число ушло одним контейнером со /start (BATCH_SEND): бот может его отвергнуть
+        self._early_qty_pending = False
+        self._dialog = PurchaseDialog()
+        self._bot_msg_seq = 0
+        self._bot_input_peer = None
+        self._bot_peer_for: Optional[str] = None
+        self._click_direct_slot = self._profiler.slot("click_direct_ms")
+        self._click_fallback_slot = self._profiler.slot("click_fallback_ms")
+        self._text_classifier = BotTextClassifier(
+            load_bot_phrases(license_client.config_dir / "bot_phrases.json")
+        )
+        # Дата поста, запустившего текущую автопокупку (для post_to_trigger_ms)
+        self._trigger_post_date: Optional[datetime] = None
+        self._bot_msg_filter = RecentIdFilter()
+        # Последние правки сообщений бота: msg_id → (edit_date, отпечаток содержимого)
+        self._bot_edits: Dict[Optional[int], Tuple[float, int]] = {}
+        # Последние сообщения бота из апдейтов: get_messages/iter_messages без RPC
+        self._recent = RecentMessageCache()
 
         # Настройки мониторинга каналов и правил автопокупки
         self.watch_enabled: bool = False
         self.watch_channels: List[int] = []  # channel.id
         self.watch_rules: Dict[str, Dict[str, Any]] = {}
-        self._processed_channel_messages: set = set()  # (channel_id, msg_id)
+        self._channel_msg_filter = RecentIdFilter()  # (channel_id, msg_id)
 
         # Загрузка сохранённых настроек
         try:
@@ -1296,42 +3563,304 @@ class FinalAutoBuyer:
 
     def _is_own_qty_button(self, text: str) -> bool:
         """Проверяет, что кнопка — именно "Ввод своего кол-ва" (с учётом эмодзи/дефисов/регистра)."""
-        t = (text or "").lower().replace("ё", "е")
-        # Нормализуем дефисы/тире и удаляем лишнюю пунктуацию/эмодзи
-        t = t.replace("-", " ").replace("—", " ").replace("–", " ")
-        t = re.sub(r"[^a-zа-я0-9 ]+", " ", t)
-        t = re.sub(r"\s+", " ", t).strip()
-        # Варианты нажатия
-        patterns = [
-            "ввод своего кол ва",
-            "ввести свое кол",
-            "ввести свое количество",
-            "ввести количество",
-            "ввод количества",
-            "другое количество",
-        ]
-        if any(pat in t for pat in patterns):
+        return _is_own_qty_label(text or "")
+
+    def _button_classifier(self) -> ButtonClassifier:
+        """Классификатор компилируется один раз и пересобирается только при смене PAY_CURRENCIES."""
+        currencies = _parse_currency_list(self.config.get("PAY_CURRENCIES") or "USDT,LTC")
+        classifier = self._classifier
+        if classifier is None or classifier.currencies != currencies:
+            classifier = ButtonClassifier(currencies, _is_own_qty_label)
+            self._classifier = classifier
+        return classifier
+
+    @property
+    def quantity(self) -> Optional[str]:
+        return self._quantity
+
+    @quantity.setter
+    def quantity(self, value: Optional[str]) -> None:
+        self._quantity = value
+        self._hot_ctx = None
+
+    def _hot(self) -> HotPathContext:
+        ctx = self._hot_ctx
+        if ctx is None or ctx.config_version != self.config.version:
+            ctx = self._rebuild_hot_context()
+        return ctx
+
+    def _rebuild_hot_context(self) -> HotPathContext:
+        config = self.config
+        bot = str(config["BOT"])
+        retries = config["RETRIES"]
+        ctx = HotPathContext(
+            bot=self._bot_input_peer if self._bot_input_peer is not None and self._bot_peer_for == bot else bot,
+            start_text=f"/start {config['PRODUCT_LINK']}",
+            qty_text=str(self.quantity),
+            retries_max=int(retries["max"]),
+            retries_base=float(retries["base"]),
+            retries_jitter=float(retries["jitter"]),
+            config_version=config.version,
+        )
+        self._hot_ctx = ctx
+        return ctx
+
+    def _set_bot_peer(self, bot: str, peer: Any) -> None:
+        self._bot_input_peer = peer
+        self._bot_peer_for = bot
+        self._rebuild_hot_context()
+
+    async def _resolve_bot_peer(self) -> None:
+        """InputPeer бота для горячего пути: из bot_peer.json без RPC, иначе разрешение username.
+
+        Сохранённый peer, с которым прошёл get_messages, ещё не значит "тот же бот":
+        username могли передать другому боту, а старый id с access_hash остаётся
+        рабочим. Поэтому username всё равно разрешается — в фоне, без задержки
+        старта (_verify_bot_peer)."""
+        bot = str(self.config["BOT"])
+        session = str(self.config["SESSION"])
+        path = license_client.config_dir / "bot_peer.json"
+        cached = load_bot_peer(path, bot, session)
+        if cached is not None:
+            self._set_bot_peer(bot, cached)
+            try:
+                # Первый запрос с сохранённым peer проверяет, что он вообще рабочий
+                await self._refill_recent_cache()
+                self._spawn_background(self._verify_bot_peer(bot, session, path, cached))
+                return
+            except Exception:
+                # Peer устарел (в сессии другой аккаунт, бот удалён) — разрешаем заново
+                pass
+        await self.client.get_entity(bot)  # resolve username → id/DC
+        peer = await self.client.get_input_entity(bot)
+        self._set_bot_peer(bot, peer)
+        save_bot_peer(path, bot, session, peer)
+        await self._refill_recent_cache()
+
+    async def _verify_bot_peer(self, bot: str, session: str, path: Path, cached: Any) -> None:
+        """Фоновая сверка сохранённого peer с текущим владельцем username."""
+        try:
+            entity = await self.client.get_entity(bot)
+            if get_peer_id(entity) == get_peer_id(cached):
+                return
+            peer = get_input_peer(entity)
+        except Exception as e:
+            logger.debug("Не удалось сверить peer бота %s: %s", bot, e)
+            return
+        console.print(f"[yellow]⚠️ {bot} теперь другой аккаунт — обновляю сохранённый peer бота[/]")
+        # BOT могли сменить, пока шло разрешение
+        if str(self.config["BOT"]) == bot:
+            self._set_bot_peer(bot, peer)
+            self._recent.invalidate()
+        save_bot_peer(path, bot, session, peer)
+
+    def _plan_for(self, markup) -> MarkupPlan:
+        """План разметки: из плейбука по отпечатку экрана, иначе классификация с запоминанием."""
+        qty_str = self._hot().qty_text
+        playbook = self._playbook
+        if playbook is None:
+            return self._button_classifier().classify(markup, qty_str)
+        fingerprint = MarkupPlaybook.fingerprint(markup)
+        plan = playbook.get(fingerprint, qty_str)
+        if plan is not None:
+            self._profiler.incr("playbook_hit")
+            return plan
+        self._profiler.incr("playbook_miss")
+        plan = self._button_classifier().classify(markup, qty_str)
+        playbook.put(fingerprint, qty_str, plan)
+        return plan
+
+    def _playbook_signature(self) -> str:
+        return ",".join(self._button_classifier().currencies)
+
+    async def _load_playbook(self, link: str) -> None:
+        path = license_client.config_dir / "playbooks" / _playbook_filename(link)
+        book = await asyncio.get_running_loop().run_in_executor(
+            None, MarkupPlaybook.load, path, self._playbook_signature()
+        )
+        # Ссылку могли сменить, пока читали файл
+        if str(self.config.get("PRODUCT_LINK")) == link:
+            self._playbook = book
+
+    def _save_playbook(self) -> None:
+        book = self._playbook
+        if book is not None and book.dirty:
+            self._spawn_background(self._write_playbook(book, book.snapshot()))
+
+    async def _write_playbook(self, book: MarkupPlaybook, plans: Dict[str, MarkupPlan]) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, book.save, plans)
+        except Exception as e:
+            book.dirty = True
+            logger.debug("Плейбук %s не сохранён: %s", book.path, e)
+
+    async def _click_button(self, message, ref: ButtonRef, priority: int = SendScheduler.QTY) -> bool:
+        """Нажатие кнопки. Колбэк-кнопки — напрямую GetBotCallbackAnswerRequest
+        по (peer, msg_id, data) без поиска по тексту и перезагрузки сообщения;
+        URL/обычные кнопки и неудачи — штатный путь message.click.
+        Оба пути идут через планировщик отправки с приоритетом priority."""
+        if self._recorder is not None:
+            self._recorder.outgoing("click", msg_id=getattr(message, "id", None), text=ref.text,
+                                    data=ref.data.hex() if ref.data else None)
+        if ref.data:
+            try:
+                with self._click_direct_slot():
+                    if await self._sender.submit(priority, lambda: self._click_direct(message, ref.data)):
+                        return True
+            except Exception as e:
+                self._log(f"[yellow]Прямое нажатие не удалось ({type(e).__name__}), штатный click[/]")
+        with self._click_fallback_slot():
+            return await self._sender.submit(priority, lambda: self._click_via_message(message, ref))
+
+    async def _click_direct(self, message, data: bytes) -> bool:
+        peer = getattr(message, "input_chat", None) or self._hot().bot
+        try:
+            await self.client(GetBotCallbackAnswerRequest(peer=peer, msg_id=message.id, data=data))
+        except BotResponseTimeoutError:
+            # Колбэк доставлен, бот просто не ответил на него вовремя (как и в Message.click)
+            pass
+        return True
+
+    async def _click_via_message(self, message, ref: ButtonRef) -> bool:
+        """Нажатие кнопки: по тексту, затем по позиции, затем по callback data."""
+        try:
+            await message.click(text=ref.text)
+            return True
+        except Exception:
+            pass
+        try:
+            await message.click(ref.row, ref.column)
             return True
-        # Общая эвристика: присутствуют корни "сво" и "кол"
-        return ("сво" in t and "кол" in t) or ("ввод" in t and "кол" in t)
+        except Exception:
+            pass
+        if ref.data:
+            try:
+                await message.click(data=ref.data)
+                return True
+            except Exception:
+                pass
+        return False
+
+    def _on_flood_wait(self, seconds: float) -> None:
+        """FloodWait любого запроса через планировщик: _retry, прямые нажатия, пачки."""
+        self._profiler.incr("flood_waits")
+        self._pacer.on_flood_wait(seconds)
+        if self._scope is not None:
+            # Ожидание FloodWait не съедает время попытки
+            self._scope.postpone(seconds + 0.5)
+        self._profiler.tracer.instant("flood_wait", seconds=seconds)
 
     async def _retry(self, coro_factory: Callable[[], asyncio.Future]):
-        cfg = self.config["RETRIES"]
+        hot = self._hot()
         last_exc = None
-        for attempt in range(cfg["max"]):
+        for attempt in range(hot.retries_max):
             try:
                 return await coro_factory()
+            except SendDropped:
+                raise
             except FloodWaitError as e:
-                # У Telethon свой семантический rate limit — уважаем
-                await asyncio.sleep(e.seconds + 0.5)
+                # Паузу держит планировщик отправки (он же учёл FloodWait в _on_flood_wait):
+                # повтор встанет в очередь до конца ожидания
                 last_exc = e
             except Exception as e:
                 # экспоненциальный бэкофф с джиттером
-                backoff = (cfg["base"] * (2 ** attempt)) + random.uniform(0, cfg["jitter"])
-                await asyncio.sleep(backoff)
+                backoff = (hot.retries_base * (2 ** attempt)) + random.uniform(0, hot.retries_jitter)
+                with self._profiler.tracer.span("retry_backoff", attempt=attempt, error=type(e).__name__):
+                    await asyncio.sleep(backoff)
                 last_exc = e
         raise last_exc  # type: ignore[misc]
 
+    async def _send_bot(self, text: str, priority: int = SendScheduler.QTY, *, droppable: bool = False):
+        """send_message целевому боту через планировщик отправки + выборка смещения часов
+        по дате отправленного сообщения."""
+        bot = self._hot().bot
+
+        async def send():
+            if droppable and not self._dialog.wants_start():
+                # Пока спамовый /start ждал очереди или повтора, число уже ушло
+                raise SendDropped()
+            t_send = time.time()
+            sent = await self.client.send_message(bot, text)
+            self._server_clock.observe_roundtrip(getattr(sent, "date", None), t_send, time.time())
+            return sent
+
+        sent = await self._sender.submit(priority, send, droppable=droppable)
+        if self._recorder is not None:
+            self._recorder.outgoing("send", id=getattr(sent, "id", None), text=text)
+        return sent
+
+    async def _send_batch(self, items: Sequence[Tuple[str, Any]], priority: int = SendScheduler.QTY) -> List[Any]:
+        """Несколько запросов к боту одним вызовом client([...], ordered=True).
+
+        Telethon кладёт их в один MTProto-контейнер, а ordered связывает каждый
+        запрос с предыдущим (invokeAfterMsg): сервер выполняет их строго по порядку.
+        items — ("text", строка) или ("click", (message, ButtonRef)). Результат по
+        позициям: отправленное сообщение, True для доставленного нажатия или
+        исключение этого запроса. Telethon собирает ошибки запросов пачки в
+        MultiError; FloodWait из него поднимается для всей пачки, чтобы его увидели
+        планировщик (общий дедлайн), _retry и пейсер.
+        """
+        bot = self._hot().bot
+        requests = []
+        for kind, value in items:
+            if kind == "click":
+                message, ref = value
+                requests.append(GetBotCallbackAnswerRequest(
+                    peer=getattr(message, "input_chat", None) or bot, msg_id=message.id, data=ref.data
+                ))
+            else:
+                requests.append(SendMessageRequest(peer=bot, message=value))
+
+        async def call():
+            t_send = time.time()
+            try:
+                results = list(await self.client(requests, ordered=True))
+            except MultiError as e:
+                for exc in e.exceptions:
+                    if isinstance(exc, FloodWaitError):
+                        raise exc
+                # Часть запросов прошла: ошибки на своих позициях
+                results = [exc if exc is not None else res for exc, res in zip(e.exceptions, e.results)]
+            return t_send, time.time(), results
+
+        t_send, t_recv, raw = await self._sender.submit(priority, call, cost=len(requests))
+        out: List[Any] = []
+        for (kind, value), request, result in zip(items, requests, raw):
+            if kind == "click":
+                message, ref = value
+                if self._recorder is not None:
+                    self._recorder.outgoing("click", msg_id=getattr(message, "id", None), text=ref.text,
+                                            data=ref.data.hex() if ref.data else None)
+                # Таймаут ответа бота — колбэк доставлен (как в _click_direct)
+                delivered = not isinstance(result, BaseException) or isinstance(result, BotResponseTimeoutError)
+                out.append(True if delivered else result)
+                continue
+            if not isinstance(result, BaseException):
+                result = self._response_message(request, result, bot)
+                self._server_clock.observe_roundtrip(getattr(result, "date", None), t_send, t_recv)
+                if self._recorder is not None:
+                    self._recorder.outgoing("send", id=getattr(result, "id", None), text=value)
+            out.append(result)
+        return out
+
+    def _response_message(self, request, result, peer):
+        """Отправленное сообщение из ответа на SendMessageRequest (как в send_message): нужны id и date."""
+        if isinstance(result, tl_types.UpdateShortSentMessage):
+            return result
+        extract = getattr(self.client, "_get_response_message", None)
+        if extract is None:
+            return result
+        try:
+            message = extract(request, result, peer)
+        except Exception:
+            message = None
+        return message if message is not None else result
+
+    def _record_since_server_date(self, name: str, server_date: Optional[datetime]) -> None:
+        elapsed_ns = self._server_clock.elapsed_ns_since(server_date)
+        if elapsed_ns is not None:
+            self._profiler.record(name, elapsed_ns)
+
     # ---------------
     # Инициализация
     # ---------------
@@ -1373,10 +3902,11 @@ class FinalAutoBuyer:
         console.print("\n[bold yellow]🔐 Подключение к Telegram...[/]")
         # Сессия Telegram хранится рядом с exe/скриптом
         session_path = str(_run_dir().joinpath(f"{self.config['SESSION']}.session"))
-        self.client = TelegramClient(
+        self.client = BuyerTelegramClient(
             session_path,
             self.config["API_ID"],
             self.config["API_HASH"],
+            on_reconnect=self._recent.invalidate,
             # Оптимизация TCP/MTProto уровня внутри Telethon по умолчанию
             # Доп.параметры задаются на уровне соединения; оставим дефолтно для стабильности
         )
@@ -1405,13 +3935,28 @@ class FinalAutoBuyer:
         # Предпрогрев: получаем сущности и последний апдейт, чтобы сократить RTT на старте
         with self._profiler.timeit("warmup_ms"):
             await self.client.get_me()
-            await self.client.get_entity(self.config["BOT"])  # resolve username → id/DC
-            await self.client.get_messages(self.config["BOT"], limit=1)
+            # InputPeer бота для отправок и прямых нажатий колбэк-кнопок + кэш последних сообщений
+            await self._resolve_bot_peer()
 
         console.print("[bold green]✅ Подключение успешно![/]\n")
 
+        # Сэмплер задержки цикла событий (серия loop_lag_ms + стеки фризов в .info)
+        try:
+            self._loop_monitor.start()
+        except Exception:
+            pass
+
         # Регистрируем командный обработчик (юзербот)
         self.register_handlers()
+        # Локальный эндпоинт метрик для Prometheus (METRICS_PORT=0 — выключен)
+        try:
+            port = int(self.config.get("METRICS_PORT") or 0)
+            if port > 0:
+                self._metrics_server = MetricsServer(self._profiler, port)
+                await self._metrics_server.start()
+                console.print(f"[green]📈 Метрики: http://127.0.0.1:{port}/metrics[/]")
+        except Exception as e:
+            console.print(f"[yellow]⚠️ Не удалось запустить эндпоинт метрик: {e}[/]")
         # Если есть токен конфиг-бота — запускаем его параллельно
         try:
             if self.config_bot_token and not self.config_bot_client:
@@ -1424,17 +3969,10 @@ class FinalAutoBuyer:
         console.print("[bold cyan]🤖 Активен режим юзербота. Команды: .help, .products, .run, .stop[/]")
         await self.client.run_until_disconnected()
 
-    def _cancel_background_tasks(self) -> None:
-        try:
-            if self._preemptive_task and not self._preemptive_task.done():
-                self._preemptive_task.cancel()
-        except Exception:
-            pass
-        try:
-            if self._start_spammer_task and not self._start_spammer_task.done():
-                self._start_spammer_task.cancel()
-        except Exception:
-            pass
+    def _cancel_attempt(self) -> None:
+        scope = self._scope
+        if scope is not None:
+            scope.cancel()
 
     # -----------------
     # Командный интерфейс
@@ -1455,7 +3993,8 @@ class FinalAutoBuyer:
                 console.print("[bold yellow]⏹ Процесс остановлен без покупки.[/]")
         finally:
             self.is_running = False
-            self._cancel_background_tasks()
+            self._cancel_attempt()
+            self._purchases.wake()
 
     async def stop_bot(self):
         if not self.is_running:
@@ -1463,7 +4002,10 @@ class FinalAutoBuyer:
             return
         self.is_running = False
         console.print("\n[bold red]🛑 Остановлено пользователем[/]")
-        self._cancel_background_tasks()
+        # Стоп останавливает и очередь автопокупок, иначе сразу стартует следующая
+        if self._purchases.clear():
+            console.print("[yellow]🗂 Очередь автопокупок очищена[/]")
+        self._cancel_attempt()
 
     async def settings_menu(self):
         while True:
@@ -1506,237 +4048,355 @@ class FinalAutoBuyer:
         assert self.client is not None
         if not self.quantity:
             raise ValueError("quantity is required")
-        start_monotonic = time.monotonic()
+        # Плейбук экранов ссылки: пока файл читается в фоне, экраны классифицируются как обычно
+        link = str(self.config.get("PRODUCT_LINK"))
+        playbook = self._playbook
+        if (
+            playbook is None
+            or playbook.path.name != _playbook_filename(link)
+            or playbook.signature != self._playbook_signature()
+        ):
+            self._playbook = None
+            self._spawn_background(self._load_playbook(link))
+        try:
+            return await self._orchestrate_attempts(overall_timeout_seconds=overall_timeout_seconds)
+        finally:
+            # Контрольная точка истории метрик после каждой покупки
+            self._spawn_background(self._checkpoint_metrics())
+            self._save_playbook()
+
+    async def _orchestrate_attempts(self, *, overall_timeout_seconds: Optional[float] = None) -> bool:
+        # Часы цикла событий (в симуляторе — виртуальные), в бою совпадают с time.monotonic
+        clock = asyncio.get_running_loop().time
+        start_monotonic = clock()
+        hard_deadline = None
+        if overall_timeout_seconds is not None:
+            hard_deadline = start_monotonic + float(overall_timeout_seconds)
         # Повторяем до успеха или остановки пользователем
         while self.is_running:
             # Глобальный таймаут для автозапуска (например, 13 минут)
-            if overall_timeout_seconds is not None and (time.monotonic() - start_monotonic) > float(overall_timeout_seconds):
+            if hard_deadline is not None and clock() > hard_deadline:
                 self.is_running = False
-                self._cancel_background_tasks()
                 return False
-            # Подготавливаем future на попытку
-            loop = asyncio.get_running_loop()
-            self._purchase_done = loop.create_future()
-
-            # Отправляем старт
-            with self._profiler.timeit("start_send_ms"):
-                await self._retry(
-                    lambda: self.client.send_message(self.config["BOT"], f"/start {self.config['PRODUCT_LINK']}")
-                )
-
-            # Упреждающая отправка количества — чуть раньше, чтобы сэкономить RTT
-            try:
-                if self.config.get("PREEMPTIVE_QTY"):
-                    if self._preemptive_task and not self._preemptive_task.done():
-                        self._preemptive_task.cancel()
-                    self._preemptive_task = asyncio.create_task(self._preemptive_send_quantity())
-            except Exception:
-                pass
-
-            # Фоновая отправка /start каждые START_INTERVAL секунд, пока попытка не завершится
-            try:
-                if self._start_spammer_task and not self._start_spammer_task.done():
-                    self._start_spammer_task.cancel()
-                self._start_spammer_task = asyncio.create_task(self._spam_start_until_done())
-            except Exception:
-                pass
-
-            # Активно попробуем найти кнопку "Ввод своего кол-ва" в последних сообщениях
-            try:
-                clicked = await self._scan_recent_for_own_qty_button()
-                if clicked:
-                    # Небольшая пауза и отправляем количество
-                    await asyncio.sleep(0.05)
-                    await self._retry(lambda: self.client.send_message(self.config["BOT"], str(self.quantity)))
-            except Exception:
-                pass
-
-            # Мгновенно пытаемся обработать уже последнее сообщение (если бот успел ответить)
-            latest = await self.client.get_messages(self.config["BOT"], limit=1)
-            if isinstance(latest, list):
-                latest = latest[0] if latest else None
-            if latest is not None:
-                await self._handle_message(latest)
-
-            # Ждём завершение пайплайна или таймаут одной попытки
+            self._pipeline_pending = None
+            self._early_qty_pending = False
+            self._dialog = PurchaseDialog(floor_id=None)
+            tracer = self._profiler.tracer
+            tracer.begin_attempt(product=str(self.config["PRODUCT_LINK"]), qty=str(self.quantity))
+            if self._recorder is not None:
+                self._recorder.begin_attempt(product=str(self.config["PRODUCT_LINK"]), qty=str(self.quantity))
+            self._profiler.incr("attempts")
+            outcome = "error"
+            # Попытка живёт не дольше ATTEMPT_TIMEOUT и общего дедлайна автозапуска;
+            # всё запущенное ею отменяется на выходе из scope
+            scope = AttemptScope(float(self.config.get("ATTEMPT_TIMEOUT", 45.0)), hard_deadline)
+            self._scope = scope
             try:
-                success = await asyncio.wait_for(self._purchase_done, timeout=45)
+                async with scope:
+                    scope.spawn(self._begin_attempt(scope))
+                    success = await scope.wait()
+                if success is None:
+                    # Дедлайн попытки — начинаем новую
+                    outcome = "timeout"
+                else:
+                    outcome = "success" if success else "failed"
                 if success:
+                    self._profiler.incr("successes")
                     # Фиксируем завершение и выходим с успехом
                     self.is_running = False
-                    self._cancel_background_tasks()
                     return True
-            except asyncio.TimeoutError:
-                # Повторяем новую попытку
-                pass
-            # Короткая задержка между повторами
+            finally:
+                tracer.end_attempt(outcome)
+                if self._recorder is not None:
+                    self._recorder.outgoing("outcome", outcome=outcome)
+                    self._spawn_background(self._flush_recording())
+            # Короткая задержка между повторами. Не темп спама: ответы на /start прошлой
+            # попытки новая отсекает по floor_id, а FloodWait выдерживает планировщик
             await asyncio.sleep(float(self.config.get("START_INTERVAL", 0.5)))
         # Вышли без успеха (остановлено пользователем)
         return False
 
-    async def _handle_message(self, message):
-        """Обрабатываем любое новое сообщение от бота: нажимаем 'свое кол-во', вводим qty, затем жмём оплату."""
+    async def _begin_attempt(self, scope: AttemptScope) -> None:
+        """Начало попытки (задача её scope): /start, фоновые отправки, экран из истории."""
+        loop = asyncio.get_running_loop()
+        hot = self._hot()
+        # BATCH_SEND: упреждающее число уходит одним контейнером со /start, порядок
+        # гарантирует сервер, поэтому отдельная отправка через QTY_PRE_DELAY не нужна
+        batch_qty = bool(self.config.get("BATCH_SEND") and self.config.get("PREEMPTIVE_QTY"))
+        try:
+            with self._profiler.timeit("start_send_ms"):
+                if batch_qty:
+                    self._early_qty_pending = True
+                    started, _ = await self._retry(
+                        lambda: self._send_batch([("text", hot.start_text), ("text", hot.qty_text)])
+                    )
+                    if isinstance(started, BaseException):
+                        raise started
+                else:
+                    started = await self._retry(lambda: self._send_bot(hot.start_text, SendScheduler.START))
+        except Exception:
+            # /start не ушёл и после повторов — следующая попытка начнёт заново
+            scope.fail()
+            return
+        self._dialog.note_start(started)
+        self._pacer.on_start_sent(loop.time())
+        # Сквозная латентность автозапуска: от публикации поста до первого /start
+        if self._trigger_post_date is not None:
+            self._record_since_server_date("post_to_trigger_ms", self._trigger_post_date)
+            self._trigger_post_date = None
+
+        # Упреждающая отправка количества — чуть раньше, чтобы сэкономить RTT
+        if self.config.get("PREEMPTIVE_QTY") and not batch_qty:
+            scope.spawn(self._preemptive_send_quantity())
+        # Фоновая отправка /start каждые START_INTERVAL секунд, пока попытка не завершится
+        scope.spawn(self._spam_start_until_done(scope))
+
+        # Активно попробуем найти кнопку "Ввод своего кол-ва" в последних сообщениях
+        # (через автомат диалога: если бот уже ответил и число ушло — не дублируем)
+        await self._apply_screen(PurchaseDialog.RECENT, None, None)
+
+        # Мгновенно пытаемся обработать уже последнее сообщение (если бот успел ответить)
+        try:
+            with self._profiler.tracer.span("fetch_latest"):
+                latest = await self._recent_bot_messages(1)
+        except Exception:
+            latest = []
+        if latest:
+            await self._handle_message(latest[0], live=False)
+
+    async def _handle_message(self, message, live: bool = True):
+        """Обрабатываем любое новое сообщение от бота: нажимаем 'свое кол-во', вводим qty, затем жмём оплату.
+        live=False — сообщение из кэша/истории, а не из апдейта: RTT бота по нему не меряем."""
         # Работает ТОЛЬКО когда процесс запущен и идёт активная попытка
-        if not self.is_running or self._purchase_done is None:
+        self._server_clock.observe_incoming(getattr(message, "date", None), time.time())
+        self._recent.put(message)
+        if self._recorder is not None:
+            self._recorder.incoming(message)
+        if live:
+            self._pacer.on_bot_reply(asyncio.get_running_loop().time())
+        scope = self._scope
+        if not self.is_running or scope is None or scope.closed:
             return
-        if getattr(message, "id", None) in self._processed_msg_ids:
+        msg_id = getattr(message, "id", None)
+        edit_date = getattr(message, "edit_date", None)
+        if edit_date is not None:
+            # Правка: новый экран в том же сообщении, ключ — (msg_id, edit_date)
+            if self._bot_edit_seen(msg_id, edit_date, message):
+                return
+        elif msg_id is not None and self._bot_msg_filter.seen_or_add(None, msg_id):
             return
-        if getattr(message, "id", None) is not None:
-            self._processed_msg_ids.add(message.id)
 
+        self._profiler.tracer.instant("bot_reply", msg_id=getattr(message, "id", None))
+        # Разбор — задача попытки: её закрытие отменит и клики/отправки этого сообщения
+        task = scope.spawn(self._process_bot_message(message))
+        if task is not None:
+            await asyncio.wait((task,))
+
+    def _bot_edit_seen(self, msg_id: Optional[int], edit_date: datetime, message) -> bool:
+        """True — эта правка уже обработана. edit_date с точностью до секунды, поэтому
+        при равной дате две правки различаем по тексту и разметке."""
+        stamp = edit_date.timestamp()
+        content = hash((
+            getattr(message, "message", None) or "",
+            MarkupPlaybook.fingerprint(getattr(message, "reply_markup", None)),
+        ))
+        edits = self._bot_edits
+        last = edits.get(msg_id)
+        if last is not None and (last[0] > stamp or last == (stamp, content)):
+            return True
+        edits.pop(msg_id, None)
+        edits[msg_id] = (stamp, content)
+        if len(edits) > self.MAX_TRACKED_EDITS:
+            del edits[next(iter(edits))]
+        return False
+
+    @profiled("handle_message_ms")
+    async def _process_bot_message(self, message):
+        """Решение по одному сообщению бота (вызывается из _handle_message после дедупликации)."""
         # Нормализованный текст
         msg_text = (getattr(message, "message", None) or getattr(message, "text", "") or "").strip()
         msg_text_lc = msg_text.lower().replace("ё", "е")
 
-        # Фикс: если бот просит ввести количество, сначала пытаемся нажать
-        # кнопку "ввод своего кол-ва" (если есть), и только если кнопок нет —
-        # шлём число напрямую. Это устраняет ситуацию, когда бот игнорирует
-        # число без предварительного нажатия кнопки.
-        quantity_prompted = bool(QUANTITY_PROMPT_REGEX.search(msg_text_lc))
-
-        # Если бот ответил ошибкой — немедленно помечаем попытку как неудачную
-        if any(err in msg_text_lc for err in [
-            "непредвиденная ошибка",
-            "ошибка",
-            "что-то пошло не так",
-            "повторите позже",
-        ]):
-            if self._purchase_done and not self._purchase_done.done():
-                self._purchase_done.set_result(False)
+        msg_class = self._text_classifier.classify(msg_text_lc)
+        self._bot_msg_seq += 1
+        if self._pipeline_pending is not None and await self._settle_pipelined_qty(msg_class, msg_text_lc):
             return
-
-        # Сообщения, при которых нужно мгновенно повторить попытку
-        # Примеры: "К сожалению я не смог распознать Вашу команду.",
-        #          "Воспользуйтесь кнопками в меню или отправьте /start",
-        #          "Полная начинка закончилась" / "товар закончился"
-        if (
-            "распознан" in msg_text_lc
-            or "воспользуйтесь кнопками" in msg_text_lc
-            or "полная начинка" in msg_text_lc
-            or ("товар" in msg_text_lc and "законч" in msg_text_lc)
-            or "добавить в избранное" in msg_text_lc
-        ):
-            if self._purchase_done and not self._purchase_done.done():
-                self._purchase_done.set_result(False)
+        if self._early_qty_pending and self._settle_early_qty(msg_class, msg_text_lc):
             return
 
-        # 1) Ищем кнопки количества/ввода количества
+        # Один проход по разметке и один переход автомата диалога
+        plan = None
         if getattr(message, "reply_markup", None):
-            rows = getattr(message.reply_markup, "rows", []) or []
-            clicked_own_qty_button = False
-            selected_numeric_qty = False
-            # Кнопка именно "Ввод своего кол-ва"
-            for i, row in enumerate(rows):
-                for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                    text = (getattr(btn, "text", "") or "").strip()
-                    if not text:
-                        continue
-                    if self._is_own_qty_button(text):
-                        with self._profiler.timeit("qty_click_ms"):
-                            try:
-                                await message.click(text=text)
-                                clicked_own_qty_button = True
-                            except Exception:
-                                try:
-                                    await message.click(row=i, column=j)
-                                    clicked_own_qty_button = True
-                                except Exception:
-                                    pass
-                        if clicked_own_qty_button:
-                            with self._profiler.timeit("qty_send_ms"):
-                                await self._retry(
-                                    lambda: self.client.send_message(self.config["BOT"], str(self.quantity))
-                                )
+            plan = self._plan_for(message.reply_markup)
+        await self._apply_screen(PurchaseDialog.screen_kind(msg_class, plan, msg_text_lc), message, plan)
+
+    async def _apply_screen(self, kind: str, message, plan: Optional[MarkupPlan]) -> None:
+        D = PurchaseDialog
+        dialog = self._dialog
+        prev_state = dialog.state
+        actions = dialog.step(kind, getattr(message, "id", 0) or 0, getattr(message, "edit_date", None))
+        if not actions:
+            return
+        entered_state = dialog.state
+        self._profiler.tracer.instant("decision", action=",".join(actions), screen=kind, state=dialog.state)
+        acted = False
+        for i, action in enumerate(actions):
+            try:
+                result = await self._dialog_action(action, message, plan)
+            except Exception:
+                result = False
+            if result is False:
+                # Шаг не удался — откатываемся, следующий экран повторит попытку.
+                # Исключение: количество уже выбрано, не нажалась только оплата.
+                # Состояние мог уже сменить другой экран — тогда откатывать нечего.
+                if i == 0 or action != D.CLICK_PAYMENT:
+                    dialog.revert(prev_state, entered_state)
+                return
+            # Удачный шаг — нажатие или отправка; FAIL и оплата без кнопок ничего не шлют
+            if action != D.FAIL and not (action == D.CLICK_PAYMENT and not plan.payments):
+                acted = True
+            if result is None:
+                break
+        if acted and message is not None:
+            # Для правки экран появился в момент edit_date, а не создания сообщения
+            shown_at = getattr(message, "edit_date", None) or getattr(message, "date", None)
+            self._record_since_server_date("bot_msg_to_click_ms", shown_at)
+
+    async def _dialog_action(self, action: str, message, plan: Optional[MarkupPlan]) -> Optional[bool]:
+        """Выполняет действие автомата: True — дальше по цепочке, None — цепочка завершена, False — неудача."""
+        D = PurchaseDialog
+        if action == D.FAIL:
+            self._finish_attempt(False)
+            return None
+        if action == D.SEND_QTY:
+            with self._profiler.timeit("qty_send_ms"):
+                sent = await self._retry(lambda: self._send_bot(self._hot().qty_text))
+            self._dialog.note_qty_sent(sent)
+            return True
+        if action == D.CLICK_OWN_QTY:
+            if self.config.get("PIPELINE_QTY"):
+                # Число уходит вместе с нажатием — SEND_QTY не нужен
+                return None if await self._pipelined_own_qty(message, plan.own_qty) else False
+            with self._profiler.timeit("qty_click_ms"):
+                return await self._click_button(message, plan.own_qty)
+        if action == D.CLICK_NUMERIC:
+            with self._profiler.timeit("qty_click_ms"):
+                clicked = await self._click_button(message, plan.numeric)
+            if clicked:
+                # Выбор количества кнопкой: экраны новее этого — уже ответ на выбор
+                self._dialog.note_qty_sent(message)
+            return clicked
+        if action == D.CLICK_PAYMENT:
+            if not plan.payments:
+                return None
+            if await self._try_click_payment(message, plan):
+                self._dialog.state = D.DONE
+                self._finish_attempt(True)
+                return None
+            return False
+        if action == D.SCAN:
+            with self._profiler.tracer.span("scan_recent"):
+                clicked = await self._scan_recent_for_own_qty_button(dialog=self._dialog)
+            if clicked:
+                # Небольшая пауза, чтобы бот переключился на ввод количества
+                await asyncio.sleep(0.05)
+            return clicked
+        return True
 
-            # Числовые кнопки, совпадающие с количеством
-            qty_str = str(self.quantity)
-            for i, row in enumerate(rows):
-                for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                    text = (getattr(btn, "text", "") or "").strip()
-                    if text and text.isdigit() and text == qty_str:
-                        with self._profiler.timeit("qty_click_ms"):
-                            try:
-                                await message.click(text=text)
-                                selected_numeric_qty = True
-                            except Exception:
-                                try:
-                                    await message.click(row=i, column=j)
-                                    selected_numeric_qty = True
-                                except Exception:
-                                    pass
-
-            # Если был текст-промпт на ввод количества, но ни одной кнопки
-            # мы не нажали, отправляем число напрямую как fallback
-            if quantity_prompted and not clicked_own_qty_button and not selected_numeric_qty:
-                with self._profiler.timeit("qty_send_ms"):
-                    await self._retry(
-                        lambda: self.client.send_message(self.config["BOT"], str(self.quantity))
+    def _finish_attempt(self, success: bool) -> None:
+        scope = self._scope
+        if scope is not None:
+            if success:
+                scope.succeed()
+            else:
+                scope.fail()
+
+    async def _pipelined_own_qty(self, message, own: ButtonRef) -> bool:
+        """Нажатие "Ввод своего кол-ва" и отправка числа без ожидания ответа на нажатие.
+
+        Колбэк ставится в очередь отправки первым, число — сразу за ним по тому же
+        соединению, так что оба запроса в полёте одновременно (минус один RTT).
+        Порядок здесь не гарантирован: sleep(0) лишь даёт задаче нажатия дойти до
+        очереди, а сервер выполняет независимые запросы как придётся, поэтому число
+        может попасть к боту раньше нажатия. С BATCH_SEND оба идут одним контейнером, и сервер выполняет отправку
+        числа строго после колбэка. Ответ бота разбирает _settle_pipelined_qty.
+        """
+        qty = self._hot().qty_text
+        with self._profiler.timeit("qty_click_ms"):
+            if self.config.get("BATCH_SEND") and own.data:
+                self._pipeline_pending = self._bot_msg_seq
+                self._profiler.incr("pipeline_qty_sent")
+                try:
+                    clicked, sent = await self._retry(
+                        lambda: self._send_batch([("click", (message, own)), ("text", qty)])
                     )
+                except Exception as e:
+                    clicked, sent = False, e
+            else:
+                click = asyncio.create_task(self._click_button(message, own))
+                # Даём задаче нажатия дойти до постановки запроса в очередь
+                await asyncio.sleep(0)
+                send = asyncio.create_task(self._retry(lambda: self._send_bot(qty)))
+                self._pipeline_pending = self._bot_msg_seq
+                self._profiler.incr("pipeline_qty_sent")
+                clicked, sent = await asyncio.gather(click, send, return_exceptions=True)
+        if clicked is not True or isinstance(sent, BaseException):
+            # Нажатие не прошло или число не ушло — обычный путь по следующему промпту
+            self._pipeline_pending = None
+            return clicked is True
+        self._dialog.note_qty_sent(sent)
+        return True
 
-            # 2) Ищем платёжные кнопки
-            clicked = await self._try_click_payment(message)
-            if clicked:
-                if self._purchase_done and not self._purchase_done.done():
-                    self._purchase_done.set_result(True)
-                return
+    async def _settle_pipelined_qty(self, msg_class: str, text_lc: str) -> bool:
+        """Разбор ответа бота после конвейерной отправки числа.
 
-        # Если был текст-промпт и не нашли кнопку в этом сообщении —
-        # попробуем просканировать последние сообщения и нажать там
-        if quantity_prompted:
-            try:
-                scanned_clicked = await self._scan_recent_for_own_qty_button()
-                if scanned_clicked:
-                    await asyncio.sleep(0.05)
-                    await self._retry(lambda: self.client.send_message(self.config["BOT"], str(self.quantity)))
-                    return
-            except Exception:
-                pass
+        Промпт количества — это ответ на нажатие: число уже в пути, ждём ответа
+        на него (тишину добирает таймаут попытки, а не повторная отправка).
+        "Не распознал" — бот получил число раньше нажатия: досылаем его вместо
+        провала попытки. Прочие retry ("товар закончился") идут обычным путём и
+        проваливают попытку. Любой другой ответ — число принято.
+        Возвращает True, если сообщение обработано здесь.
+        """
+        if msg_class == BotTextClassifier.QTY_PROMPT:
+            return True
+        self._pipeline_pending = None
+        if msg_class == BotTextClassifier.RETRY:
+            if not is_unrecognised_input(text_lc):
+                return False
+            await self._resend_pipelined_qty()
+            return True
+        self._profiler.incr("pipeline_qty_accepted")
+        return False
 
-    async def _try_click_payment(self, message) -> bool:
-        rows = getattr(message.reply_markup, "rows", []) or []
-        # Кандидаты: USDT, LTC, затем любые кнопки с PAYMENT_REGEX
-        candidates: List[Tuple[int, int, str, Optional[bytes]]] = []
-        for i, row in enumerate(rows):
-            for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                text = (getattr(btn, "text", "") or "").strip()
-                data = getattr(btn, "data", None)
-                if not text:
-                    continue
-                if re.fullmatch(r"USDT", text, flags=re.IGNORECASE):
-                    candidates.append((i, j, text, data))
-        for i, row in enumerate(rows):
-            for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                text = (getattr(btn, "text", "") or "").strip()
-                data = getattr(btn, "data", None)
-                if not text:
-                    continue
-                if re.fullmatch(r"LTC", text, flags=re.IGNORECASE):
-                    candidates.append((i, j, text, data))
-        for i, row in enumerate(rows):
-            for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                text = (getattr(btn, "text", "") or "").strip()
-                data = getattr(btn, "data", None)
-                if not text:
-                    continue
-                if PAYMENT_REGEX.search(text):
-                    candidates.append((i, j, text, data))
+    def _settle_early_qty(self, msg_class: str, text_lc: str) -> bool:
+        """Ответ на число из контейнера со /start. Бот отвечает по порядку, так что
+        "не распознал" до промпта — отказ от раннего числа: пропускаем его, число
+        уйдёт обычным путём по промпту. "Товар закончился" и прочие retry — ответ
+        на /start, они проваливают попытку как обычно. Промпт — бот уже прошёл
+        мимо числа."""
+        if msg_class == BotTextClassifier.RETRY and is_unrecognised_input(text_lc):
+            self._early_qty_pending = False
+            self._profiler.incr("batch_qty_rejected")
+            return True
+        if msg_class == BotTextClassifier.QTY_PROMPT:
+            self._early_qty_pending = False
+        return False
 
-        for (i, j, text, data) in candidates:
+    async def _resend_pipelined_qty(self) -> None:
+        self._profiler.incr("pipeline_qty_rejected")
+        self._profiler.tracer.instant("decision", action="pipeline_qty_resend")
+        with self._profiler.timeit("qty_send_ms"):
+            sent = await self._retry(lambda: self._send_bot(self._hot().qty_text))
+        self._dialog.note_qty_sent(sent)
+
+    async def _try_click_payment(self, message, plan: Optional[MarkupPlan] = None) -> bool:
+        if plan is None:
+            plan = self._button_classifier().classify(message.reply_markup, self._hot().qty_text)
+        # Кандидаты уже ранжированы: валюты из PAY_CURRENCIES, затем любые кнопки с PAYMENT_REGEX
+        for ref in plan.payments:
             with self._profiler.timeit("payment_click_ms"):
-                try:
-                    await message.click(text=text)
+                if await self._click_button(message, ref, SendScheduler.PAY):
                     return True
-                except Exception:
-                    try:
-                        await message.click(row=i, column=j)
-                        return True
-                    except Exception:
-                        if data:
-                            try:
-                                await message.click(data=data)
-                                return True
-                            except Exception:
-                                continue
         return False
 
     async def _preemptive_send_quantity(self) -> None:
@@ -1746,53 +4406,88 @@ class FinalAutoBuyer:
         try:
             # Минимальная задержка, чтобы бот успел обработать /start
             await asyncio.sleep(float(self.config.get("QTY_PRE_DELAY", 0.5)))
-            await self._retry(lambda: self.client.send_message(self.config["BOT"], str(self.quantity)))
+            # Диалог уже ушёл дальше карточки — число отправлено основным путём
+            if self._dialog.state != PurchaseDialog.START:
+                return
+            with self._profiler.timeit("qty_pre_send_ms"):
+                await self._retry(lambda: self._send_bot(self._hot().qty_text))
         except Exception:
             # Тихо игнорируем: основной поток всё равно отправит при промпте
             pass
 
-    async def _spam_start_until_done(self) -> None:
+    async def _spam_start_until_done(self, scope: AttemptScope) -> None:
         """Периодически отправляет /start, пока текущая попытка не завершится."""
         assert self.client is not None
-        interval = float(self.config.get("START_INTERVAL", 0.5))
-        # Первый /start уже отправлен в _orchestrate; начинаем циклически
-        while self.is_running and self._purchase_done is not None and not self._purchase_done.done():
-            await asyncio.sleep(interval)
+        loop = asyncio.get_running_loop()
+        # Первый /start уже отправлен в _begin_attempt; начинаем циклически
+        while self.is_running and not scope.done:
+            await asyncio.sleep(self._start_interval())
+            if not self._dialog.wants_start():
+                # Число отправлено — ждём экран оплаты; откат шага вернёт спам
+                continue
+            if self.config.get("ADAPTIVE_START"):
+                self._pacer.on_tick(loop.time())
             try:
                 # Отправляем только /start без дублирования сообщений в консоль
-                await self._retry(
-                    lambda: self.client.send_message(self.config["BOT"], f"/start {self.config['PRODUCT_LINK']}")
-                )
+                with self._profiler.timeit("start_spam_ms"):
+                    await self._retry(
+                        lambda: self._send_bot(self._hot().start_text, SendScheduler.START, droppable=True)
+                    )
+                self._pacer.on_start_sent(loop.time())
             except Exception:
                 # Тихо игнорируем единичные сбои
                 pass
 
-    async def _scan_recent_for_own_qty_button(self, *, limit: int = 6) -> bool:
+    async def _refill_recent_cache(self) -> None:
+        messages = await self.client.get_messages(self._hot().bot, limit=self._recent.capacity)
+        self._recent.fill(messages)
+
+    async def _recent_bot_messages(self, limit: int) -> List[Any]:
+        """Последние сообщения бота, новые первыми: из кэша апдейтов, сеть — только после разрыва."""
+        if self._recent.complete:
+            self._profiler.incr("recent_cache_hit")
+        else:
+            self._profiler.incr("recent_cache_miss")
+            await self._refill_recent_cache()
+        return self._recent.latest(limit)
+
+    def _start_interval(self) -> float:
+        if self.config.get("ADAPTIVE_START"):
+            version = getattr(self.config, "version", None)
+            if version != self._pacer_config_version:
+                # Границы могли поменять в config.txt или конфиг-боте
+                self._pacer_config_version = version
+                self._pacer.set_bounds(
+                    float(self.config.get("START_INTERVAL_MIN", 0.3)),
+                    float(self.config.get("START_INTERVAL_MAX", 5.0)),
+                )
+            return self._pacer.interval
+        return float(self.config.get("START_INTERVAL", 0.5))
+
+    async def _scan_recent_for_own_qty_button(self, *, limit: int = 6,
+                                              dialog: Optional[PurchaseDialog] = None) -> bool:
         """Сканирует последние сообщения бота и пытается нажать кнопку ввода своего количества.
-        Возвращает True, если клик выполнен."""
+        Возвращает True, если клик выполнен.
+
+        С dialog нажатие выполняется, только пока автомат в SCANNING: если живая
+        карточка уже обработана, история больше не нужна. На время нажатия
+        автомат переводится в QTY_EARLY, чтобы карточка не выбрала кол-во второй раз.
+        """
+        D = PurchaseDialog
         try:
-            async for message in self.client.iter_messages(self.config["BOT"], limit=limit):
+            for message in await self._recent_bot_messages(limit):
+                if dialog is not None and dialog.state != D.SCANNING:
+                    return False
                 if getattr(message, "reply_markup", None):
-                    rows = getattr(message.reply_markup, "rows", []) or []
-                    for i, row in enumerate(rows):
-                        for j, btn in enumerate(getattr(row, "buttons", []) or []):
-                            text = (getattr(btn, "text", "") or "").strip()
-                            data = getattr(btn, "data", None)
-                            if text and self._is_own_qty_button(text):
-                                try:
-                                    await message.click(text=text)
-                                    return True
-                                except Exception:
-                                    try:
-                                        await message.click(row=i, column=j)
-                                        return True
-                                    except Exception:
-                                        if data:
-                                            try:
-                                                await message.click(data=data)
-                                                return True
-                                            except Exception:
-                                                continue
+                    own = self._plan_for(message.reply_markup).own_qty
+                    if own is None:
+                        continue
+                    if dialog is not None:
+                        dialog.state, dialog.busy = D.QTY_EARLY, True
+                    if await self._click_button(message, own):
+                        return True
+                    if dialog is not None:
+                        dialog.revert(D.SCANNING, D.QTY_EARLY)
             return False
         except Exception:
             return False
@@ -1814,6 +4509,14 @@ class FinalAutoBuyer:
                 # Тихий режим: не ломаем горячий путь логами
                 pass
 
+        # Правки сообщений бота: многие боты меняют экран в том же сообщении
+        @self.client.on(events.MessageEdited(from_users=self.config["BOT"]))
+        async def _edited(event):
+            try:
+                await self._handle_message(event.message)
+            except Exception:
+                pass
+
         # Мониторинг постов: реагируем ТОЛЬКО на сообщения из отслеживаемых каналов
         @self.client.on(events.NewMessage(func=lambda e: (
             getattr(self, 'watch_enabled', False)
@@ -1837,16 +4540,16 @@ class FinalAutoBuyer:
                 # Горячий путь без логов
 
                 msg = event.message
+                self._server_clock.observe_incoming(getattr(msg, "date", None), time.time())
                 msg_id = getattr(msg, "id", None)
                 if msg_id is None:
                     return
 
-                key = (peer_id, msg_id)
-                if key in self._processed_channel_messages:
+                if self._channel_msg_filter.seen_or_add(peer_id, msg_id):
                     console.print(f"[dim yellow]⚠️ Сообщение {msg_id} уже обработано[/]")
                     return
 
-                self._processed_channel_messages.add(key)
+                self._profiler.incr("watch_posts_seen")
 
                 # Показываем содержимое сообщения
                 msg_text = (getattr(msg, "message", "") or "")
@@ -1909,7 +4612,8 @@ class FinalAutoBuyer:
                 await event.reply(f"❌ Ошибка: {e}")
             finally:
                 self.is_running = False
-                self._cancel_background_tasks()
+                self._cancel_attempt()
+                self._purchases.wake()
             return
 
         if command == "stop":
@@ -1917,7 +4621,11 @@ class FinalAutoBuyer:
                 await event.reply("⚠️ Нечего останавливать — процесс не запущен.")
                 return
             self.is_running = False
-            await event.reply("🛑 Останавливаю по запросу пользователя...")
+            dropped = self._purchases.clear()
+            await event.reply(
+                "🛑 Останавливаю по запросу пользователя..."
+                + (f"\n🗂 Снято из очереди автопокупок: {dropped}" if dropped else "")
+            )
             return
 
         if command in ("info", "metrics"):
@@ -1925,7 +4633,34 @@ class FinalAutoBuyer:
             await event.reply(text[:4000])
             return
 
+        if command == "trace":
+            try:
+                last_n = int(args_line.split()[0]) if args_line else 5
+            except ValueError:
+                await event.reply("❌ Использование: .trace [N] — последние N попыток")
+                return
+            path = f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            try:
+                await self._write_trace(path, last_n)
+                await event.reply(f"🧵 Трасса сохранена: {path} (откройте в chrome://tracing или ui.perfetto.dev)")
+            except Exception as e:
+                await event.reply(f"❌ Не удалось сохранить трассу: {e}")
+            return
+
         if command == "report":
+            report_args = args_line.split()
+            if report_args and report_args[0] in ("cmp", "compare", "baseline"):
+                try:
+                    # Снимок метрик и настроек — в цикле, чтение истории и расчёт — в пуле потоков
+                    current, _ = self._profiler.snapshot()
+                    loop = asyncio.get_running_loop()
+                    text = await loop.run_in_executor(
+                        None, self._compare_report, report_args, current, self._history_meta()
+                    )
+                except Exception as e:
+                    text = f"❌ Не удалось построить сравнение: {e}"
+                await event.reply(text[:4000])
+                return
             path = "latency_report.txt"
             try:
                 self._write_metrics_report(path)
@@ -1999,7 +4734,7 @@ class FinalAutoBuyer:
                     ".канал add <@username|id> — добавить канал для мониторинга\n"
                     ".канал del <@username|id> — удалить канал\n"
                     ".канал list — список каналов\n"
-                    ".товар add <ключевое_слово> <id|c_xxx> [qty] — правило покупки\n"
+                    ".товар add <ключевое_слово> <id|c_xxx> [qty] [приоритет] — правило покупки\n"
                     ".товар del <ключевое_слово> — удалить правило\n"
                     ".товар list — список правил"
                 )
@@ -2019,7 +4754,7 @@ class FinalAutoBuyer:
                 status_lines = [
                     f"Статус: {'включен' if self.watch_enabled else 'выключен'}",
                     f"Каналов: {len(self.watch_channels)} | Правил: {len(self.watch_rules)}",
-                    f"Обработано сообщений: {len(self._processed_channel_messages)}"
+                    f"Обработано сообщений: {self._channel_msg_filter.total}"
                 ]
                 if self.watch_channels:
                     status_lines.append("Каналы:")
@@ -2092,7 +4827,7 @@ class FinalAutoBuyer:
         if command in ("товар", "rule"):
             parts = args_line.split()
             if not parts:
-                await event.reply("Использование: .товар add <ключевое_слово> <id|c_xxx> [qty] | .товар del <ключевое_слово> | .товар list")
+                await event.reply("Использование: .товар add <ключевое_слово> <id|c_xxx> [qty] [приоритет] | .товар del <ключевое_слово> | .товар list")
                 return
             action = parts[0].lower()
             if action == "list":
@@ -2101,7 +4836,7 @@ class FinalAutoBuyer:
                     return
                 lines = ["Правила:"]
                 for k, v in self.watch_rules.items():
-                    lines.append(f"- {k} → link={v.get('link')} qty={v.get('qty','1')}")
+                    lines.append(f"- {k} → link={v.get('link')} qty={v.get('qty','1')} приоритет={v.get('priority', 0)}")
                 await event.reply("\n".join(lines)[:4000])
                 return
             if action == "del":
@@ -2118,11 +4853,16 @@ class FinalAutoBuyer:
                 return
             if action == "add":
                 if len(parts) < 3:
-                    await event.reply("❌ Укажите: .товар add <ключевое_слово> <id|c_xxx> [qty]")
+                    await event.reply("❌ Укажите: .товар add <ключевое_слово> <id|c_xxx> [qty] [приоритет]")
                     return
                 keyw = parts[1].lower()
                 ref = parts[2]
                 qty = parts[3] if len(parts) > 3 else "1"
+                try:
+                    priority = int(parts[4]) if len(parts) > 4 else 0
+                except ValueError:
+                    await event.reply("❌ Приоритет — целое число (больше — важнее)")
+                    return
                 link = None
                 if ref in self.products:
                     link = self.products[ref]["link"]
@@ -2131,9 +4871,9 @@ class FinalAutoBuyer:
                 else:
                     await event.reply("❌ Неизвестный товар. Используйте id из .products или ссылку c_*")
                     return
-                self.watch_rules[keyw] = {"link": link, "qty": str(qty)}
+                self.watch_rules[keyw] = {"link": link, "qty": str(qty), "priority": priority}
                 self._save_watch_config()
-                await event.reply(f"✅ Правило добавлено: {keyw} → {link} qty={qty}")
+                await event.reply(f"✅ Правило добавлено: {keyw} → {link} qty={qty} приоритет={priority}")
                 return
             await event.reply("❌ Неизвестное действие. Используйте add|del|list")
             return
@@ -2219,6 +4959,8 @@ class FinalAutoBuyer:
             ".run <qty> [<product|id>] — запустить покупку (id из .products или ссылка c_*)\n"
             ".stop — остановить текущий процесс\n"
             ".info — показать метрики латентности\n"
+            ".trace [N] — выгрузить трассу последних N попыток (Chrome trace JSON)\n"
+            ".report [cmp [N] | baseline [save]] — отчёт и сравнение с прошлыми запусками/эталоном\n"
             ".license — статус лицензии и информация о HWID\n"
             ".парсинг on|off|status — управление мониторингом каналов\n"
             ".канал add|del|list — управление списком каналов\n"
@@ -2243,7 +4985,8 @@ class FinalAutoBuyer:
                 await event.reply("✅ Готово: оплата инициирована. Ожидаю следующую команду.\n❗ ПРОВЕРЬТЕ ЧЕК ОПЛАТЫ ПЕРЕД ТЕМ КАК ОПЛАТИТЬ!!!")
         finally:
             self.is_running = False
-            self._cancel_background_tasks()
+            self._cancel_attempt()
+            self._purchases.wake()
 
     async def _wait_new_bot_message(self, timeout: int = 2):
         assert self.client is not None
@@ -2259,13 +5002,142 @@ class FinalAutoBuyer:
         lines = ["📊 Метрики латентности (мс):"]
         for name, (avg, p95, p99, cnt) in summary.items():
             lines.append(f"{name}: avg={avg:.2f} p95={p95:.2f} p99={p99:.2f} (n={cnt})")
+        counters = self._profiler.counters()
+        if counters:
+            lines.append("🔢 Счётчики: " + ", ".join(f"{k}={v}" for k, v in counters.items()))
+        lines.append(f"🕒 Смещение часов относительно сервера: {self._server_clock.describe()}")
+        lines.append(own_qty_cache_text())
+        if self.config.get("ADAPTIVE_START"):
+            lines.append(f"⏱ Интервал /start (адаптивный): {self._pacer.describe()}")
+        else:
+            lines.append(f"⏱ Интервал /start: {self._start_interval():g} с (фиксированный, ADAPTIVE_START=false)")
+        lines.append(f"📮 Отправка боту: {self._sender.describe()}")
+        lines.append(f"🗂 Очередь автопокупок: {self._purchases.describe()}")
+        lines.append(f"🗂 Кэш сообщений бота: {self._recent.describe()}")
+        lines.append(f"🧹 Дедупликация: бот {self._bot_msg_filter.describe()}; каналы {self._channel_msg_filter.describe()}")
+        if self._playbook is not None:
+            lines.append(f"📒 Плейбук экранов: {len(self._playbook)} (hit {counters.get('playbook_hit', 0)},"
+                         f" miss {counters.get('playbook_miss', 0)})")
+        if counters.get("pipeline_qty_sent"):
+            lines.append(f"⚡ Конвейер количества: {self._pipeline_qty_stats()}")
+        stall = self._loop_monitor.last_stall_text()
+        if stall:
+            lines.append(stall)
         return "\n".join(lines)
 
+    def _pipeline_qty_stats(self) -> str:
+        counters = self._profiler.counters()
+        sent = counters.get("pipeline_qty_sent", 0)
+        rejected = counters.get("pipeline_qty_rejected", 0)
+        if not sent:
+            return "нет отправок"
+        return (
+            f"отправлено {sent}, принято {counters.get('pipeline_qty_accepted', 0)},"
+            f" отвергнуто {rejected} ({rejected / sent * 100:.0f}%)"
+        )
+
     def _write_metrics_report(self, path: str) -> None:
         text = self._metrics_text()
         with open(path, "w", encoding="utf-8") as f:
             f.write(text + "\n")
 
+    async def _flush_recording(self) -> None:
+        # Буфер забираем в цикле, сжатие и запись — в пуле потоков
+        recorder = self._recorder
+        if recorder is None:
+            return
+        entries = recorder.take()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, recorder.write, entries)
+        except Exception as e:
+            logger.warning("Не удалось дописать запись диалога %s: %s", recorder.path, e)
+
+    def _spawn_background(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def _config_snapshot(self) -> Dict[str, Any]:
+        # Без учётных данных: в истории нужны только параметры, влияющие на скорость
+        secret = {"API_ID", "API_HASH", "PHONE", "SESSION"}
+        return {k: v for k, v in self.config.as_dict().items() if k not in secret}
+
+    def _history_meta(self) -> Dict[str, Any]:
+        return {
+            "run_id": self._run_id,
+            "started_at": self._run_started_at,
+            "saved_at": datetime.now(timezone.utc).isoformat(),
+            "client_version": CLIENT_VERSION,
+            "config": self._config_snapshot(),
+            "counters": self._profiler.counters(),
+        }
+
+    def _persist_metrics(self) -> None:
+        """Синхронно дописывает контрольную точку текущего запуска в историю."""
+        spans, _ = self._profiler.snapshot()
+        if spans:
+            self._history.append(self._history_meta(), spans)
+
+    async def _checkpoint_metrics(self) -> None:
+        # Снимок берём в цикле, кодирование и запись на диск — в пуле потоков
+        spans, _ = self._profiler.snapshot()
+        if not spans:
+            return
+        meta = self._history_meta()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._history.append, meta, spans)
+        except Exception as e:
+            logger.debug("Не удалось сохранить историю метрик: %s", e)
+
+    def _baseline_path(self) -> Path:
+        return license_client.config_dir / "metrics_baseline.bin"
+
+    def _compare_report(self, args: List[str], current: Dict[str, LatencyHistogram], cur_meta: Dict[str, Any]) -> str:
+        """Выполняется в пуле потоков: чтение истории и расчёт дельт.
+        current и cur_meta снимаются в цикле событий — профилировщик здесь не трогаем."""
+        cur_cfg = cur_meta.get("config") or {}
+        if args and args[0] == "baseline":
+            baseline = MetricsHistory(self._baseline_path())
+            if len(args) > 1 and args[1] == "save":
+                self._baseline_path().unlink(missing_ok=True)
+                baseline.append(cur_meta, current)
+                return f"📌 Текущий запуск {self._run_id} сохранён как эталон"
+            runs = baseline.load_runs()
+            if not runs:
+                return "❌ Эталон не сохранён. Используйте .report baseline save"
+            meta, ref = runs[-1]
+            label = f"эталоном {meta.get('run_id')}"
+            ref_cfgs = [meta.get("config") or {}]
+        else:
+            try:
+                n = max(1, int(args[1])) if len(args) > 1 else 1
+            except ValueError:
+                n = 1
+            previous = [r for r in self._history.load_runs() if r[0].get("run_id") != self._run_id][-n:]
+            if not previous:
+                return "❌ В истории нет предыдущих запусков"
+            ref = merge_histograms([spans for _, spans in previous])
+            label = f"предыдущим запуском {previous[-1][0].get('run_id')}" if n == 1 else f"{len(previous)} предыдущими запусками"
+            ref_cfgs = [meta.get("config") or {} for meta, _ in previous]
+        diff: Dict[str, Tuple[Any, Any]] = {}
+        for key, value in cur_cfg.items():
+            old_values = {json.dumps(cfg.get(key), sort_keys=True, default=str) for cfg in ref_cfgs}
+            if old_values != {json.dumps(value, sort_keys=True, default=str)}:
+                old = ref_cfgs[-1].get(key)
+                diff[key] = (old if len(old_values) == 1 else "разные", value)
+        return compare_histograms_text(current, ref, label, diff)
+
+    async def _write_trace(self, path: str, last_n: int) -> None:
+        # Снимок собираем в цикле, а сериализацию и запись — в пуле потоков
+        data = self._profiler.tracer.to_chrome(last_n)
+
+        def _dump() -> None:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+
+        await asyncio.get_running_loop().run_in_executor(None, _dump)
+
     # -------------------
     # Автозапуск по постам каналов
     # -------------------
@@ -2273,10 +5145,6 @@ class FinalAutoBuyer:
         try:
             console.print(f"[bold blue]🔍 Анализируем пост на предмет автопокупки...[/]")
             
-            if self.is_running:
-                console.print("[yellow]⚠️ Пропускаем пост - уже запущена покупка[/]")
-                return
-                
             # Получаем текст сообщения
             text = (getattr(message, "message", None) or getattr(message, "text", "") or "").lower().replace("ё", "е")
             console.print(f"[dim]📝 Текст сообщения: '{text[:200]}...'[/]")
@@ -2302,6 +5170,7 @@ class FinalAutoBuyer:
             if not matched_rule:
                 console.print(f"[yellow]🔍 Ключевые слова не найдены в: {text[:100]}...[/]")
                 return
+            self._profiler.incr("watch_posts_matched")
                 
             link = matched_rule.get("link")
             qty = str(matched_rule.get("qty", "1"))
@@ -2309,6 +5178,36 @@ class FinalAutoBuyer:
                 console.print(f"[red]❌ У правила '{matched_key}' нет ссылки[/]")
                 return
                 
+            try:
+                priority = int(matched_rule.get("priority", 0))
+            except Exception:
+                priority = 0
+            job = PurchaseJob(
+                link=str(link), qty=qty, priority=priority, keyword=matched_key or "",
+                channel_id=channel_id, post_date=getattr(message, "date", None),
+            )
+            outcome = self._purchases.submit(job)
+            self._profiler.incr(f"watch_jobs_{outcome}")
+            if outcome == "running":
+                console.print(f"[yellow]⚠️ {link} уже покупается — повторный пост по ключу '{matched_key}' пропущен[/]")
+            elif outcome == "preempt":
+                console.print(f"[bold magenta]⏫ Правило '{matched_key}' (приоритет {priority}) вытесняет текущую покупку[/]")
+            elif self._purchases.current is not None or self.is_running:
+                console.print(f"[cyan]🗂 В очереди автопокупок: '{matched_key}' → {link} (приоритет {priority})[/]")
+        except Exception:
+            pass
+
+    def _preempt_purchase(self) -> None:
+        """Останавливает текущую автопокупку ради более важной (она вернётся в очередь)."""
+        console.print("[bold magenta]⏸ Текущая автопокупка приостановлена[/]")
+        self.is_running = False
+        self._cancel_attempt()
+
+    async def _run_watch_purchase(self, job: PurchaseJob) -> bool:
+        """Одна автопокупка из очереди: запуск _orchestrate до дедлайна срабатывания и уведомление."""
+        matched_key, link, qty, channel_id = job.keyword, job.link, job.qty, job.channel_id
+        remaining = job.deadline - asyncio.get_running_loop().time()
+        try:
             console.print(f"[bold green]🎯 ЗАПУСК АВТОПОКУПКИ![/]")
             console.print(f"[bold green]🔑 Ключевое слово: {matched_key}[/]")
             console.print(f"[bold green]🔗 Ссылка: {link}[/]")
@@ -2317,7 +5216,8 @@ class FinalAutoBuyer:
             self.config["PRODUCT_LINK"] = link
             self.quantity = qty
             self.is_running = True
-            console.print(f"[bold cyan]📡 Обнаружен товар по ключу '{matched_key}' → {link}. Старт автопокупки на 13 минут...[/]")
+            self._trigger_post_date = job.post_date
+            console.print(f"[bold cyan]📡 Обнаружен товар по ключу '{matched_key}' → {link}. Старт автопокупки на {remaining / 60:.0f} мин...[/]")
             # Подготовим метаданные для красивого уведомления
             try:
                 channel_name = None
@@ -2328,7 +5228,7 @@ class FinalAutoBuyer:
             ts_text = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
             started_mon = time.monotonic()
             try:
-                success = await self._orchestrate(overall_timeout_seconds=13 * 60)
+                success = await self._orchestrate(overall_timeout_seconds=remaining)
                 if success:
                     console.print("[bold green]✅ Автопокупка завершена: оплата инициирована[/]")
                     # Оповещение владельцу конфиг-бота (если известен)
@@ -2356,13 +5256,17 @@ class FinalAutoBuyer:
                                     await self.config_bot_client.send_message(target, text)
                     except Exception:
                         pass
+                elif job.preempted:
+                    console.print("[bold yellow]⏸ Автопокупка вытеснена более важной, продолжим после неё[/]")
                 else:
                     console.print("[bold yellow]⏹ Не удалось поймать в отведённое время. Ожидаю новые посты...[/]")
+                return success
             finally:
                 self.is_running = False
-                self._cancel_background_tasks()
+                self._trigger_post_date = None
+                self._cancel_attempt()
         except Exception:
-            pass
+            return False
 
     # -------------------
     # Сохранение настроек мониторинга
@@ -2654,7 +5558,7 @@ class FinalAutoBuyer:
                 return
             lines = ["Правила:"]
             for k, v in self.watch_rules.items():
-                lines.append(f"- {k} → {v.get('link')} qty={v.get('qty','1')}")
+                lines.append(f"- {k} → {v.get('link')} qty={v.get('qty','1')} приоритет={v.get('priority', 0)}")
             await event.edit("\n".join(lines)[:4000], buttons=[[Button.inline("⬅️ Назад", b"rules")]])
 
         @self.config_bot_client.on(events.CallbackQuery(data=b"rule_add"))
@@ -2683,7 +5587,9 @@ class FinalAutoBuyer:
                 await self.config_bot_client.send_message(event.chat_id, "❌ Неизвестный товар")
                 await send_main_menu(event.chat_id)
                 return
-            self.watch_rules[keyw] = {"link": link, "qty": str(qty)}
+            # Приоритет задаётся командой .товар add — при правке из бота сохраняем прежний
+            priority = (self.watch_rules.get(keyw) or {}).get("priority", 0)
+            self.watch_rules[keyw] = {"link": link, "qty": str(qty), "priority": priority}
             self._save_watch_config()
             await self.config_bot_client.send_message(event.chat_id, f"✅ Добавлено: {keyw} → {link} qty={qty}")
             await send_main_menu(event.chat_id)
@@ -2811,7 +5717,9 @@ class FinalAutoBuyer:
                 await self.config_bot_client.send_message(event.chat_id, "❌ У выбранного товара нет ссылки")
                 await send_main_menu(event.chat_id)
                 return
-            self.watch_rules[keyw] = {"link": link, "qty": str(qty)}
+            # Приоритет задаётся командой .товар add — при правке из бота сохраняем прежний
+            priority = (self.watch_rules.get(keyw) or {}).get("priority", 0)
+            self.watch_rules[keyw] = {"link": link, "qty": str(qty), "priority": priority}
             self._save_watch_config()
             await self.config_bot_client.send_message(event.chat_id, f"✅ Правило добавлено: {keyw} → {link} qty={qty}")
             await send_main_menu(event.chat_id)
@@ -2826,13 +5734,15 @@ class FinalAutoBuyer:
                 f"PREEMPTIVE_QTY: {'ON' if self.config.get('PREEMPTIVE_QTY') else 'OFF'}",
                 f"START_INTERVAL: {self.config.get('START_INTERVAL')} c",
                 f"QTY_PRE_DELAY: {self.config.get('QTY_PRE_DELAY')} c",
+                f"PIPELINE_QTY: {'ON' if self.config.get('PIPELINE_QTY') else 'OFF'} ({self._pipeline_qty_stats()})",
+                f"BATCH_SEND: {'ON' if self.config.get('BATCH_SEND') else 'OFF'}",
                 f"Default QTY: {self.config_bot_default_qty}",
                 f"Notify chat: {self.config_bot_notify_chat_id or 'owner'}",
             ]
             kb = [
-                [Button.inline("🔁 PREEMPTIVE", b"set_preemptive")],
+                [Button.inline("🔁 PREEMPTIVE", b"set_preemptive"), Button.inline("⚡ PIPELINE_QTY", b"set_pipeline_qty")],
                 [Button.inline("⏱ START_INTERVAL", b"set_start_interval"), Button.inline("⏳ QTY_PRE_DELAY", b"set_qty_delay")],
-                [Button.inline("🔢 Default QTY", b"set_default_qty")],
+                [Button.inline("📦 BATCH_SEND", b"set_batch_send"), Button.inline("🔢 Default QTY", b"set_default_qty")],
                 [Button.inline("📣 Notify chat", b"set_notify_chat" )],
                 [Button.inline("🖼 Баннер меню", b"set_banner"), Button.inline("🏁 Картинка успеха", b"set_success_img")],
                 [Button.inline("⬅️ Назад", b"back")],
@@ -2847,6 +5757,22 @@ class FinalAutoBuyer:
             await event.answer("Готово")
             await event.edit("Обновлено", buttons=[[Button.inline("⬅️ Назад", b"settings")]])
 
+        @self.config_bot_client.on(events.CallbackQuery(data=b"set_pipeline_qty"))
+        async def _(event):
+            if not await self._is_config_owner(event):
+                return
+            self.config["PIPELINE_QTY"] = not bool(self.config.get("PIPELINE_QTY"))
+            await event.answer("Готово")
+            await event.edit("Обновлено", buttons=[[Button.inline("⬅️ Назад", b"settings")]])
+
+        @self.config_bot_client.on(events.CallbackQuery(data=b"set_batch_send"))
+        async def _(event):
+            if not await self._is_config_owner(event):
+                return
+            self.config["BATCH_SEND"] = not bool(self.config.get("BATCH_SEND"))
+            await event.answer("Готово")
+            await event.edit("Обновлено", buttons=[[Button.inline("⬅️ Назад", b"settings")]])
+
         async def _ask_number(event, prompt: str, min_v: float, max_v: float, key: str):
             await event.edit(prompt)
             resp = await _ask_text_response(event, "")
@@ -3113,6 +6039,17 @@ if __name__ == "__main__":
     # Проверка на отладчики
     _check_debug_environment()
 
+    if "--bench" in sys.argv or "--replay" in sys.argv:
+        # porn2o_sim импортирует этот модуль как porn2o — отдаём ему уже загруженный __main__,
+        # иначе файл выполнится второй раз со своими копиями классов
+        sys.modules.setdefault("porn2o", sys.modules[__name__])
+        import porn2o_sim
+
+    # Офлайн-бенчмарки: не требуют config.txt и подключения к Telegram
+    if "--bench" in sys.argv:
+        porn2o_sim.run_benchmarks(sys.argv[sys.argv.index("--bench") + 1:])
+        sys.exit(0)
+
     try:
         bot = FinalAutoBuyer()
     except FileNotFoundError as e:
@@ -3122,6 +6059,15 @@ if __name__ == "__main__":
         console.print(f"[red]Ошибка конфигурации: {e}[/]")
         sys.exit(1)
 
+    # Офлайн-воспроизведение записанных диалогов (RECORD_DIALOGS=true) без подключения к Telegram
+    if "--replay" in sys.argv:
+        replay_paths, replay_latency, replay_realtime = porn2o_sim._replay_args(sys.argv)
+        if not replay_paths:
+            console.print("[red]Нет записей для воспроизведения: включите RECORD_DIALOGS=true[/]")
+            sys.exit(1)
+        asyncio.run(porn2o_sim.run_replay(bot, replay_paths, replay_latency, replay_realtime))
+        sys.exit(0)
+
     try:
         asyncio.run(bot.start())
     except KeyboardInterrupt:
@@ -3129,6 +6075,16 @@ if __name__ == "__main__":
     except Exception as e:
         console.print(f"💥 Фатальная ошибка: {e}", style=red_style)
     finally:
+        # Сохраняем метрики запуска в историю для сравнения в .report cmp
+        try:
+            bot._persist_metrics()
+        except Exception:
+            pass
+        try:
+            if bot._recorder is not None:
+                bot._recorder.flush()
+        except Exception:
+            pass
         # Очистка временных файлов конфиг-бота
         try:
             import glob
@@ -0,0 +1,966 @@
+"""Офлайн-инструменты porn2o: воспроизведение записей диалогов, симулятор магазина-бота и бенчмарки.
+
+Запускаются из porn2o.py (--replay, --bench); к Telegram не подключаются.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import selectors
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telethon.errors import FloodWaitError, MultiError
+from telethon.tl.functions.messages import GetBotCallbackAnswerRequest, SendMessageRequest
+
+from porn2o import (
+    DEFAULT_BOT_PHRASES,
+    PAYMENT_REGEX,
+    AppConfig,
+    AttemptScope,
+    AttemptTracer,
+    BotTextClassifier,
+    ButtonClassifier,
+    ConfigAdapter,
+    FinalAutoBuyer,
+    LatencyHistogram,
+    LatencyProfiler,
+    MarkupPlaybook,
+    PurchaseDialog,
+    RecentIdFilter,
+    _is_own_qty_label,
+    console,
+    license_client,
+    profiled,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ========================
+# Записи диалогов: чтение и подставной клиент
+# ========================
+def load_recording(path: Path) -> List[Dict[str, Any]]:
+    entries: List[Dict[str, Any]] = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    except (EOFError, OSError, ValueError) as e:
+        # Оборванная запись (процесс убит посреди flush) — берём то, что прочиталось
+        logger.warning("Запись %s прочитана не полностью: %s", path, e)
+    return entries
+
+
+class FakeButton:
+    __slots__ = ("text", "data", "url")
+
+    def __init__(self, text: str, data: Optional[bytes], url: Optional[str]) -> None:
+        self.text = text
+        self.data = data
+        self.url = url
+
+
+class _FakeRow:
+    __slots__ = ("buttons",)
+
+    def __init__(self, buttons: List[FakeButton]) -> None:
+        self.buttons = buttons
+
+
+class FakeMarkup:
+    __slots__ = ("rows",)
+
+    def __init__(self, rows: List[List[List[Any]]]) -> None:
+        self.rows = [
+            _FakeRow([FakeButton(text, bytes.fromhex(data) if data else None, url) for text, data, url in row])
+            for row in rows
+        ]
+
+
+class FakeMessage:
+    """Сообщение для воспроизведения: поля и click() в объёме, который использует покупщик."""
+
+    def __init__(self, client: "FakeTelegramClient", msg_id: int, text: str,
+                 markup: Optional[FakeMarkup], date: Optional[datetime], out: bool = False,
+                 edit_date: Optional[datetime] = None) -> None:
+        self._client = client
+        self.id = msg_id
+        self.message = text
+        self.text = text
+        self.reply_markup = markup
+        self.date = date
+        self.edit_date = edit_date
+        self.out = out
+        self.input_chat = client.bot_peer
+
+    async def click(self, i=None, j=None, *, text=None, data=None):
+        # Сигнатура как у telethon Message.click: позиция (i, j), text= или data=
+        client = self._client
+        if data is not None:
+            await client(GetBotCallbackAnswerRequest(peer=self.input_chat, msg_id=self.id, data=data))
+            return True
+        rows = getattr(self.reply_markup, "rows", None) or []
+        buttons = [b for row in rows for b in row.buttons]
+        target = None
+        if text is not None:
+            target = next((b for b in buttons if b.text == text), None)
+        elif i is not None and j is not None:
+            target = rows[i].buttons[j]
+        elif i is not None:
+            target = buttons[i]
+        if target is None:
+            return None
+        if target.url:
+            return target.url
+        if target.data:
+            await client(GetBotCallbackAnswerRequest(peer=self.input_chat, msg_id=self.id, data=target.data))
+            return True
+        return await client.send_message(client.bot_peer, target.text)
+
+
+class FakeTelegramClient:
+    """Подмена TelegramClient для воспроизведения записей: считает RPC по типам и задаёт задержку ответа."""
+
+    bot_peer = "bot"
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.rpc_counts: Dict[str, int] = {}
+        self.history: List[FakeMessage] = []
+        self._last_id = 0
+        self._delivered_ns = 0
+        self.first_rpc_ns: Optional[int] = None
+
+    async def rpc(self, name: str) -> None:
+        if self.first_rpc_ns is None:
+            self.first_rpc_ns = time.perf_counter_ns()
+        self.rpc_counts[name] = self.rpc_counts.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    def deliver(self, entry: Dict[str, Any]) -> FakeMessage:
+        """Входящее сообщение из записи; id исходящих будут больше него, как в живой переписке."""
+        msg_id = int(entry.get("id") or self._last_id + 1)
+        self._last_id = max(self._last_id, msg_id)
+        date = entry.get("date")
+        edit = entry.get("edit")
+        markup = entry.get("markup")
+        msg = FakeMessage(
+            self, msg_id, entry.get("text") or "",
+            FakeMarkup(markup) if markup is not None else None,
+            datetime.fromtimestamp(date, timezone.utc) if date else None,
+            edit_date=datetime.fromtimestamp(edit, timezone.utc) if edit else None,
+        )
+        if edit:
+            # Правка заменяет сообщение в истории, как на сервере
+            self.history = [m for m in self.history if m.id != msg_id]
+        self.history.append(msg)
+        self.first_rpc_ns = None
+        return msg
+
+    async def send_message(self, entity, text, **kwargs) -> FakeMessage:
+        await self.rpc("SendMessageRequest")
+        self._last_id += 1
+        msg = FakeMessage(self, self._last_id, str(text), None, datetime.now(timezone.utc), out=True)
+        self.history.append(msg)
+        return msg
+
+    async def __call__(self, request, ordered: bool = False):
+        await self.rpc(type(request).__name__)
+        return None
+
+    async def get_input_entity(self, entity):
+        return self.bot_peer
+
+    async def get_messages(self, entity, limit: int = 1):
+        await self.rpc("GetHistoryRequest")
+        return [m for m in reversed(self.history) if not m.out][:limit]
+
+    async def iter_messages(self, entity, limit: Optional[int] = None):
+        await self.rpc("GetHistoryRequest")
+        for m in list(reversed(self.history))[:limit]:
+            yield m
+
+
+# ========================
+# Воспроизведение записей: python porn2o.py --replay [файл ...] [--latency мс] [--realtime]
+# ========================
+def _split_attempts(entries: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    attempts: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]] = [({}, [])]
+    for entry in entries:
+        if entry.get("k") == "attempt":
+            attempts.append((entry, []))
+        else:
+            attempts[-1][1].append(entry)
+    return [(meta, items) for meta, items in attempts if any(e.get("k") == "in" for e in items)]
+
+
+async def _replay_attempt(buyer: "FinalAutoBuyer", meta: Dict[str, Any], entries: List[Dict[str, Any]],
+                          latency: float, realtime: bool) -> Dict[str, Any]:
+    """Прогон входящих сообщений одной попытки через _handle_message на FakeTelegramClient."""
+    client = FakeTelegramClient(latency)
+    buyer.client = client
+    buyer.is_running = True
+    buyer.quantity = str(meta.get("qty") or buyer.quantity or "1")
+    buyer._set_bot_peer(str(buyer.config["BOT"]), client.bot_peer)
+    buyer._bot_msg_filter = RecentIdFilter()
+    buyer._dialog = PurchaseDialog()
+    buyer._pipeline_pending = None
+    buyer._early_qty_pending = False
+    scope = AttemptScope(3600.0)
+    buyer._scope = scope
+    decision = LatencyHistogram()
+    handling = LatencyHistogram()
+    messages = 0
+    prev_t: Optional[float] = None
+    outcome = None
+    for entry in entries:
+        kind = entry.get("k")
+        if kind == "outcome":
+            outcome = entry.get("outcome")
+        if kind != "in" or scope.done:
+            continue
+        if realtime and prev_t is not None:
+            await asyncio.sleep(max(0.0, float(entry.get("t", 0.0)) - prev_t))
+        prev_t = float(entry.get("t", 0.0))
+        msg = client.deliver(entry)
+        messages += 1
+        t0 = time.perf_counter_ns()
+        await buyer._handle_message(msg)
+        handling.record(time.perf_counter_ns() - t0)
+        if client.first_rpc_ns is not None:
+            decision.record(client.first_rpc_ns - t0)
+    # Даём досработать фоновым задачам (конвейер количества, проверки тишины)
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    if pending:
+        _, still = await asyncio.wait(pending, timeout=max(2.0, latency * 4))
+        for t in still:
+            t.cancel()
+    completed = scope.result() is True
+    await scope.close()
+    return {
+        "messages": messages,
+        "decision": decision,
+        "handling": handling,
+        "rpc": dict(client.rpc_counts),
+        "completed": completed,
+        "recorded": outcome,
+    }
+
+
+async def run_replay(buyer: "FinalAutoBuyer", paths: List[Path], latency: float, realtime: bool) -> None:
+    buyer._recorder = None  # воспроизведение не пишет новых записей
+    for path in paths:
+        attempts = _split_attempts(await asyncio.get_running_loop().run_in_executor(None, load_recording, path))
+        console.print(f"[bold]{path.name}[/] — попыток: {len(attempts)}, задержка RPC {latency * 1000:.0f} мс"
+                      f"{', реальный темп' if realtime else ''}")
+        for n, (meta, entries) in enumerate(attempts, 1):
+            r = await _replay_attempt(buyer, meta, entries, latency, realtime)
+            d, h = r["decision"], r["handling"]
+            rpc = r["rpc"]
+            rpc_text = ", ".join(f"{k}={v}" for k, v in sorted(rpc.items())) or "нет"
+            verdict = "[green]покупка[/]" if r["completed"] else "[red]без оплаты[/]"
+            decision_text = (
+                f"p50 {d.percentile(50) / 1e6:.3f} / p99 {d.percentile(99) / 1e6:.3f} мс" if d.count else "—"
+            )
+            console.print(
+                f"  #{n} qty={meta.get('qty', '?')}: сообщений {r['messages']}, "
+                f"решение {decision_text}, "
+                f"обработка p50 {h.percentile(50) / 1e6:.3f} мс; RPC {sum(rpc.values())} ({rpc_text}); "
+                f"{verdict} (в записи: {r['recorded'] or '—'})"
+            )
+
+
+def _replay_args(argv: List[str]) -> Tuple[List[Path], float, bool]:
+    args = argv[argv.index("--replay") + 1:]
+    paths = [Path(a) for a in args if not a.startswith("--")]
+    latency = 0.0
+    if "--latency" in args:
+        i = args.index("--latency")
+        latency = float(args[i + 1]) / 1000.0
+        paths = [p for p in paths if str(p) != args[i + 1]]
+    if not paths:
+        # По умолчанию — последняя запись из каталога конфигурации
+        recordings = sorted((license_client.config_dir / "recordings").glob("*.jsonl.gz"))
+        paths = recordings[-1:]
+    return paths, latency, "--realtime" in args
+
+
+# ========================
+# Симулятор магазин-бота: сквозной прогон _orchestrate_attempts без сети
+# ========================
+class _VirtualClockSelector(selectors.DefaultSelector):
+    """Селектор виртуального времени: вместо ожидания таймера сдвигает часы."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Таймеров нет — ждём только реальные события (например, пул потоков)
+            return super().select(None)
+        self.now += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Цикл событий с управляемыми часами: asyncio.sleep/wait_for/таймауты идут по
+    виртуальному времени, 13 минут дедлайна прогоняются за доли секунды."""
+
+    def __init__(self) -> None:
+        self._clock = _VirtualClockSelector()
+        super().__init__(self._clock)
+
+    def time(self) -> float:
+        return self._clock.now
+
+
+@dataclass
+class SimScenario:
+    name: str
+    rtt: float = 0.08  # полный RTT до сервера Telegram, с
+    jitter: float = 0.02  # разброс ± каждого плеча, с
+    bot_think: float = 0.03  # обработка сообщения магазин-ботом, с
+    out_of_stock: int = 0  # столько первых /start получают "товар закончился"
+    flood_on_send: int = 0  # номер send_message, на котором сервер вернёт FLOOD_WAIT (0 — нет)
+    flood_seconds: int = 3
+    flood_min_interval: float = 0.0  # /start чаще этого (с) — FLOOD_WAIT flood_seconds
+    drop_prompts: int = 0  # столько первых промптов количества бот теряет
+    down_until: float = 0.0  # бот молчит до этого момента (проверка таймаута попытки 45 с)
+    edit_in_place: bool = False  # промпт и экран оплаты — правкой карточки, а не новым сообщением
+    runs: int = 50
+    deadline: float = 13 * 60  # общий дедлайн, как у автозапуска из канала
+    overrides: Dict[str, Any] = field(default_factory=dict)  # параметры config.txt для прогона
+
+
+SIM_SCENARIOS: List[SimScenario] = [
+    SimScenario("fast", rtt=0.06, jitter=0.01),
+    SimScenario("slow", rtt=0.25, jitter=0.08, bot_think=0.15),
+    SimScenario("rate_limit", flood_min_interval=1.0, overrides={"START_INTERVAL": 0.5}),
+    # Бот отвечает дольше интервала /start: спам идёт несколько тиков до первого ответа,
+    # и только здесь видно, что даёт ADAPTIVE_START
+    SimScenario("laggy", bot_think=1.2, runs=30, overrides={"START_INTERVAL": 0.5}),
+    SimScenario("laggy_adaptive", bot_think=1.2, runs=30, overrides={"START_INTERVAL": 0.5, "ADAPTIVE_START": True}),
+    SimScenario("laggy_rate_limit", bot_think=0.6, flood_min_interval=1.0, runs=30,
+                overrides={"START_INTERVAL": 0.5}),
+    SimScenario("laggy_rl_adaptive", bot_think=0.6, flood_min_interval=1.0, runs=30,
+                overrides={"START_INTERVAL": 0.5, "ADAPTIVE_START": True}),
+    SimScenario("sold_out_3", out_of_stock=3),
+    SimScenario("flood", flood_on_send=2, flood_seconds=3),
+    SimScenario("lost_prompt", drop_prompts=1),
+    SimScenario("edit_in_place", edit_in_place=True),
+    SimScenario("bot_down_60s", down_until=60.0, runs=10),
+    SimScenario("sold_out_deadline", out_of_stock=10 ** 9, runs=1),
+]
+
+
+class ShopBotSimulator:
+    """Сценарный магазин-бот: карточка → "Ввод своего кол-ва" → число → оплата.
+
+    /start в любом состоянии возвращает к карточке (как у настоящих ботов),
+    число вне ожидания количества — "не смог распознать". С edit_in_place
+    промпт и экран оплаты приходят правкой последней карточки.
+    """
+
+    CARD_ROWS = [
+        [["Ввод своего кол-ва", b"own_qty".hex(), None]],
+        [["1", b"qty:1".hex(), None], ["2", b"qty:2".hex(), None]],
+        [["Назад", b"back".hex(), None]],
+    ]
+    PAY_ROWS = [[["USDT", b"pay:usdt".hex(), None], ["LTC", b"pay:ltc".hex(), None]]]
+
+    def __init__(self, scenario: SimScenario, rng: random.Random) -> None:
+        self.scenario = scenario
+        self.rng = rng
+        self.loop = asyncio.get_running_loop()
+        self.client: Optional["SimTelegramClient"] = None
+        self.deliver: Callable[[FakeMessage], Any] = lambda msg: None
+        self.state = "idle"
+        self.starts = 0
+        self.prompts = 0
+        self.paid_at: Optional[float] = None
+        self.screen: Optional[FakeMessage] = None
+
+    def leg(self) -> float:
+        sc = self.scenario
+        return max(0.0, sc.rtt / 2 + self.rng.uniform(-sc.jitter, sc.jitter))
+
+    def _reply(self, text: str, rows: Optional[List[List[List[Any]]]] = None, *, screen: bool = False) -> None:
+        self.loop.call_later(self.scenario.bot_think, self._emit, text, rows, screen)
+
+    def _emit(self, text: str, rows, screen: bool = False) -> None:
+        markup = FakeMarkup(rows) if rows is not None else None
+        if screen and self.scenario.edit_in_place and self.screen is not None:
+            msg = self.client.edit_server_message(self.screen, text, markup)
+        else:
+            msg = self.client.server_message(text, markup)
+        if rows is not None:
+            self.screen = msg
+        self.loop.call_later(self.leg(), self.deliver, msg)
+
+    def on_text(self, text: str) -> None:
+        if self.loop.time() < self.scenario.down_until:
+            return
+        if text.startswith("/start"):
+            self.starts += 1
+            if self.starts <= self.scenario.out_of_stock:
+                self.state = "idle"
+                self._reply("К сожалению, товар закончился")
+                return
+            self.state = "card"
+            self._reply("Товар: шоколад 5г\nЦена: 4500 руб.", self.CARD_ROWS)
+        elif self.state == "await_qty" and text.strip().isdigit():
+            self.state = "await_pay"
+            self._reply(f"Заказ на {text.strip()} шт. создан. Выберите способ оплаты", self.PAY_ROWS, screen=True)
+        else:
+            self._reply("К сожалению я не смог распознать Вашу команду. Воспользуйтесь кнопками в меню или отправьте /start")
+
+    def on_callback(self, data: bytes) -> None:
+        if self.loop.time() < self.scenario.down_until:
+            return
+        if data == b"own_qty" and self.state == "card":
+            self.state = "await_qty"
+            self.prompts += 1
+            if self.prompts > self.scenario.drop_prompts:
+                self._reply("Введите количество товара", screen=True)
+        elif data.startswith(b"pay:") and self.state == "await_pay" and self.paid_at is None:
+            self.state = "paid"
+            self.paid_at = self.loop.time()
+
+
+class SimTelegramClient(FakeTelegramClient):
+    """Telegram для симулятора: плечи RTT с разбросом, id сообщений в порядке прихода на сервер, FLOOD_WAIT."""
+
+    def __init__(self, sim: ShopBotSimulator) -> None:
+        super().__init__(0.0)
+        self.sim = sim
+        self.sends = 0
+        self.containers = 0
+        self._last_start: Optional[float] = None
+        sim.client = self
+
+    def server_message(self, text: str, markup: Optional[FakeMarkup], out: bool = False) -> FakeMessage:
+        self._last_id += 1
+        msg = FakeMessage(self, self._last_id, text, markup, datetime.now(timezone.utc), out=out)
+        self.history.append(msg)
+        return msg
+
+    def edit_server_message(self, msg: FakeMessage, text: str, markup: Optional[FakeMarkup]) -> FakeMessage:
+        edited = FakeMessage(self, msg.id, text, markup, msg.date, edit_date=datetime.now(timezone.utc))
+        self.history = [edited if m.id == msg.id else m for m in self.history]
+        return edited
+
+    def _count(self, name: str) -> None:
+        self.rpc_counts[name] = self.rpc_counts.get(name, 0) + 1
+
+    async def rpc(self, name: str) -> None:
+        self._count(name)
+        await asyncio.sleep(self.sim.leg() + self.sim.leg())
+
+    async def send_message(self, entity, text, **kwargs) -> FakeMessage:
+        self._count("SendMessageRequest")
+        await asyncio.sleep(self.sim.leg())
+        try:
+            msg = self._accept_text(str(text))
+        except FloodWaitError:
+            await asyncio.sleep(self.sim.leg())
+            raise
+        await asyncio.sleep(self.sim.leg())
+        return msg
+
+    def _accept_text(self, text: str) -> FakeMessage:
+        """Сообщение дошло до сервера: FLOOD_WAIT по правилам сценария или доставка боту."""
+        self.sends += 1
+        sc = self.sim.scenario
+        now = asyncio.get_running_loop().time()
+        flood = self.sends == sc.flood_on_send
+        if str(text).startswith("/start"):
+            flood = flood or (
+                sc.flood_min_interval > 0 and self._last_start is not None and now - self._last_start < sc.flood_min_interval
+            )
+            self._last_start = now
+        if flood:
+            raise FloodWaitError(None, sc.flood_seconds)
+        msg = self.server_message(text, None, out=True)
+        self.sim.on_text(text)
+        return msg
+
+    async def __call__(self, request, ordered: bool = False):
+        batch = request if isinstance(request, list) else [request]
+        for r in batch:
+            self._count(type(r).__name__)
+        if len(batch) > 1:
+            self.containers += 1
+        # Контейнер — одно плечо туда и одно обратно; на сервере запросы выполняются по порядку
+        await asyncio.sleep(self.sim.leg())
+        results: List[Any] = []
+        errors: List[Optional[Exception]] = []
+        for r in batch:
+            try:
+                if isinstance(r, SendMessageRequest):
+                    results.append(self._accept_text(r.message))
+                else:
+                    if isinstance(r, GetBotCallbackAnswerRequest):
+                        self.sim.on_callback(r.data)
+                    results.append(None)
+                errors.append(None)
+            except FloodWaitError as e:
+                results.append(None)
+                errors.append(e)
+        await asyncio.sleep(self.sim.leg())
+        if not isinstance(request, list):
+            if errors[0] is not None:
+                raise errors[0]
+            return results[0]
+        if any(e is not None for e in errors):
+            # Как Telethon: ошибки запросов списка — одним MultiError по позициям
+            raise MultiError(errors, results, batch)
+        return results
+
+
+def _sim_config(overrides: Optional[Dict[str, Any]] = None) -> ConfigAdapter:
+    config = ConfigAdapter(AppConfig(
+        api_id=0, api_hash="", phone="", bot="@sim_shop_bot", session="sim", product_link="c_sim",
+    ))
+    for key, value in (overrides or {}).items():
+        config[key] = value
+    return config
+
+
+async def _sim_run(scenario: SimScenario, seed: int) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    buyer = FinalAutoBuyer(config=_sim_config(scenario.overrides))
+    buyer._recorder = None
+    sim = ShopBotSimulator(scenario, random.Random(seed))
+    client = SimTelegramClient(sim)
+    handlers: set = set()
+
+    def deliver(msg: FakeMessage) -> None:
+        # Как обработчик NewMessage в telethon: каждое сообщение — отдельная задача
+        task = loop.create_task(buyer._handle_message(msg))
+        handlers.add(task)
+        task.add_done_callback(handlers.discard)
+
+    sim.deliver = deliver
+    buyer.client = client
+    buyer._set_bot_peer(str(buyer.config["BOT"]), client.bot_peer)
+    buyer.quantity = "5"
+    buyer.is_running = True
+    # Как прогрев в start(): кэш сообщений бота заполнен до первой попытки
+    await buyer._refill_recent_cache()
+    t0 = loop.time()
+    success = await buyer._orchestrate_attempts(overall_timeout_seconds=scenario.deadline)
+    buyer._cancel_attempt()
+    for task in list(handlers):
+        task.cancel()
+    return {
+        # Успех — оплата, которую увидел магазин; success попытки — лишь то, что считает покупатель
+        "paid": sim.paid_at is not None,
+        "claimed": success,
+        "to_pay": (sim.paid_at - t0) if sim.paid_at is not None else None,
+        "elapsed": loop.time() - t0,
+        "attempts": buyer._profiler.counters().get("attempts", 0),
+        "rpc": sum(client.rpc_counts.values()),
+        "containers": client.containers,
+    }
+
+
+def run_sim_scenario(scenario: SimScenario, seed0: int = 1) -> Dict[str, Any]:
+    """Прогоняет сценарий scenario.runs раз, каждый — на свежем цикле с виртуальными часами."""
+    to_pay = LatencyHistogram()
+    results = []
+    real_t0 = time.perf_counter()
+    for i in range(scenario.runs):
+        loop = VirtualClockLoop()
+        try:
+            results.append(loop.run_until_complete(_sim_run(scenario, seed0 + i)))
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            loop.close()
+        if results[-1]["to_pay"] is not None:
+            to_pay.record(int(results[-1]["to_pay"] * 1e9))
+    n = max(len(results), 1)
+    return {
+        "to_pay": to_pay,
+        "paid": sum(1 for r in results if r["paid"]) / n,
+        "claimed": sum(1 for r in results if r["claimed"]) / n,
+        "attempts": sum(r["attempts"] for r in results) / n,
+        "rpc": sum(r["rpc"] for r in results) / n,
+        "containers": sum(r["containers"] for r in results) / n,
+        "elapsed": max(r["elapsed"] for r in results) if results else 0.0,
+        "real_ms": (time.perf_counter() - real_t0) * 1000.0 / n,
+    }
+
+
+# ========================
+# Микробенчмарки: python porn2o.py --bench [имя ...]
+# ========================
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(name: str):
+    def decorator(fn: Callable[[], None]) -> Callable[[], None]:
+        BENCHMARKS[name] = fn
+        return fn
+
+    return decorator
+
+
+def _bench_ns_per_op(fn: Callable[[int], None], n: int, repeat: int = 5) -> float:
+    """Лучшее из repeat прогонов fn(n), нс на одну операцию."""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        fn(n)
+        elapsed = time.perf_counter_ns() - t0
+        best = elapsed if best is None or elapsed < best else best
+    return (best or 0) / float(n)
+
+
+def _bench_blocks_per_op(fn: Callable[[int], None], n: int) -> float:
+    """Сколько блоков памяти остаётся висеть на операцию при выключенном GC."""
+    import gc
+
+    fn(n)  # прогрев: пулы токенов, слоты
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        fn(n)
+        after = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+    return (after - before) / float(n)
+
+
+@benchmark("timing")
+def _bench_timing() -> None:
+    """Накладные расходы на один записанный спан."""
+    profiler = LatencyProfiler()
+
+    def legacy_timeit(name: str):
+        # Прежняя реализация: новый класс, экземпляр и замыкание на каждый вызов
+        class _Ctx:
+            def __enter__(self_inner):
+                self_inner._t0 = time.perf_counter_ns()
+                return self_inner
+
+            def __exit__(self_inner, exc_type, exc, tb):
+                profiler.record(name, time.perf_counter_ns() - self_inner._t0)
+
+        return _Ctx()
+
+    def run_legacy(n: int) -> None:
+        for _ in range(n):
+            with legacy_timeit("bench_legacy_ms"):
+                pass
+
+    def run_timeit(n: int) -> None:
+        timeit = profiler.timeit
+        for _ in range(n):
+            with timeit("bench_timeit_ms"):
+                pass
+
+    slot = profiler.slot("bench_slot_ms")
+
+    def run_slot(n: int) -> None:
+        for _ in range(n):
+            with slot():
+                pass
+
+    def run_since(n: int) -> None:
+        now = time.perf_counter_ns
+        since = slot.since
+        for _ in range(n):
+            since(now())
+
+    class _Holder:
+        def __init__(self) -> None:
+            self._profiler = profiler
+
+        @profiled("bench_decorated_ms")
+        async def handler(self) -> None:
+            return None
+
+    holder = _Holder()
+
+    def run_decorated(n: int) -> None:
+        handler = holder.handler
+        for _ in range(n):
+            coro = handler()
+            try:
+                coro.send(None)
+            except StopIteration:
+                pass
+
+    def run_empty(n: int) -> None:
+        for _ in range(n):
+            pass
+
+    tracer = profiler.tracer
+
+    def run_slot_idle(n: int) -> None:
+        tracer.end_attempt("bench")
+        run_slot(n)
+
+    n = 100_000
+    base = _bench_ns_per_op(run_empty, n)
+    console.print(f"[bold]timing[/] — накладные расходы на спан (n={n}, пустой цикл {base:.1f} нс вычтен)")
+    console.print("  блоки — объекты, которые остаются висеть при выключенном GC (мусор для сборщика)")
+    console.print(
+        f"  замеры идут внутри активной попытки; буфер событий ({AttemptTracer.MAX_EVENTS_PER_ATTEMPT}) "
+        "заполняется на прогреве, так что блоки — только накладные расходы спана"
+    )
+    for label, fn, in_attempt in (
+        ("legacy timeit (класс на вызов)", run_legacy, True),
+        ("timeit (токен из пула)", run_timeit, True),
+        ("slot() (предвыделенный слот)", run_slot, True),
+        ("slot() вне попытки", run_slot_idle, False),
+        ("slot.since(t0)", run_since, True),
+        ("@profiled корутина", run_decorated, True),
+    ):
+        if in_attempt:
+            tracer.begin_attempt(bench="timing")
+        ns = _bench_ns_per_op(fn, n) - base
+        blocks = _bench_blocks_per_op(fn, 10_000)
+        tracer.end_attempt("bench")
+        console.print(f"  {label:<32} {ns:9.1f} нс/спан  {blocks:6.2f} блоков/спан")
+
+
+def _bench_markup(rows: List[List[Tuple[str, Optional[bytes]]]]) -> Any:
+    """Разметка в форме Telethon (rows[].buttons[].text/.data) без зависимости от TL-типов."""
+    from types import SimpleNamespace
+
+    return SimpleNamespace(rows=[
+        SimpleNamespace(buttons=[SimpleNamespace(text=text, data=data) for text, data in row]) for row in rows
+    ])
+
+
+# Типичные экраны магазин-бота: карточка товара, выбор оплаты, каталог
+BENCH_MARKUPS: Dict[str, List[List[Tuple[str, Optional[bytes]]]]] = {
+    "product": [
+        [("1", b"q:1"), ("2", b"q:2"), ("3", b"q:3"), ("5", b"q:5")],
+        [("10", b"q:10"), ("✏️ Ввод своего кол-ва", b"q:own")],
+        [("⭐ Добавить в избранное", b"fav"), ("⬅️ Назад", b"back")],
+    ],
+    "payment": [
+        [("BTC", b"p:btc"), ("LTC", b"p:ltc"), ("USDT", b"p:usdt")],
+        [("💎 CryptoBot", b"p:cb"), ("💳 Перейти к оплате", b"p:go")],
+        [("❌ Отмена", b"cancel")],
+    ],
+    "catalog": [[(f"📦 Товар №{i} — 100г", f"c:{i}".encode()), (f"ℹ️ Инфо {i}", f"i:{i}".encode())] for i in range(12)]
+    + [[("⬅️ Назад", b"back"), ("🏠 Меню", b"menu")]],
+}
+
+
+@benchmark("classifier")
+def _bench_classifier() -> None:
+    """Однопроходный ButtonClassifier против прежних пяти проходов по разметке."""
+    is_own_qty = _is_own_qty_label
+    classifier = ButtonClassifier(("USDT", "LTC"), is_own_qty)
+
+    def legacy(markup: Any, qty_str: str) -> Tuple[Any, Any, list]:
+        rows = getattr(markup, "rows", []) or []
+        own = numeric = None
+        for i, row in enumerate(rows):
+            for j, btn in enumerate(getattr(row, "buttons", []) or []):
+                text = (getattr(btn, "text", "") or "").strip()
+                if text and is_own_qty(text):
+                    own = own or (i, j, text)
+        for i, row in enumerate(rows):
+            for j, btn in enumerate(getattr(row, "buttons", []) or []):
+                text = (getattr(btn, "text", "") or "").strip()
+                if text and text.isdigit() and text == qty_str:
+                    numeric = numeric or (i, j, text)
+        candidates = []
+        for pattern in (r"USDT", r"LTC"):
+            for i, row in enumerate(rows):
+                for j, btn in enumerate(getattr(row, "buttons", []) or []):
+                    text = (getattr(btn, "text", "") or "").strip()
+                    if text and re.fullmatch(pattern, text, flags=re.IGNORECASE):
+                        candidates.append((i, j, text, getattr(btn, "data", None)))
+        for i, row in enumerate(rows):
+            for j, btn in enumerate(getattr(row, "buttons", []) or []):
+                text = (getattr(btn, "text", "") or "").strip()
+                if text and PAYMENT_REGEX.search(text):
+                    candidates.append((i, j, text, getattr(btn, "data", None)))
+        return own, numeric, candidates
+
+    n = 5_000
+    console.print(f"[bold]classifier[/] — разбор reply_markup (n={n})")
+    for screen, rows in BENCH_MARKUPS.items():
+        markup = _bench_markup(rows)
+        n_buttons = sum(len(r) for r in rows)
+        old_ns = _bench_ns_per_op(lambda k: [legacy(markup, "5") for _ in range(k)], n)
+        new_ns = _bench_ns_per_op(lambda k: [classifier.classify(markup, "5") for _ in range(k)], n)
+        console.print(
+            f"  {screen:<8} ({n_buttons:2d} кнопок)  прежний {old_ns / 1000:7.2f} мкс"
+            f"  ButtonClassifier {new_ns / 1000:7.2f} мкс  ×{old_ns / max(new_ns, 1e-9):.1f}"
+        )
+
+
+@benchmark("own_qty")
+def _bench_own_qty() -> None:
+    """Проверка подписи "Ввод своего кол-ва": без кэша против LRU по сырому тексту."""
+    labels = [text for rows in BENCH_MARKUPS.values() for row in rows for text, _ in row]
+    uncached = _is_own_qty_label.__wrapped__
+    n = 2_000
+    old_ns = _bench_ns_per_op(lambda k: [uncached(t) for _ in range(k) for t in labels], n) / len(labels)
+    new_ns = _bench_ns_per_op(lambda k: [_is_own_qty_label(t) for _ in range(k) for t in labels], n) / len(labels)
+    console.print(
+        f"[bold]own_qty[/] — {len(labels)} подписей: нормализация {old_ns:.0f} нс,"
+        f" с кэшем {new_ns:.0f} нс (×{old_ns / max(new_ns, 1e-9):.1f})"
+    )
+
+
+BENCH_BOT_TEXTS = [
+    "введите количество товара (минимальное количество 1, максимальное количество 50)",
+    "к сожалению я не смог распознать вашу команду. воспользуйтесь кнопками в меню или отправьте /start",
+    "полная начинка 5г\n\nцена: 4500 руб.\nвыберите способ оплаты",
+    "произошла непредвиденная ошибка, повторите позже",
+    "заказ №48213 создан. у вас есть 30 минут на оплату, реквизиты ниже. " * 3,
+]
+
+
+@benchmark("text")
+def _bench_text() -> None:
+    """Класс текста ответа бота: отдельные проверки подряд против единого выражения."""
+    prompt_re = re.compile(
+        r"(введите\s+количеств|количество\s+товара|минимальное\s+количество|максимальное\s+количество|выберите\s+количеств)"
+    )
+
+    def legacy(t: str) -> str:
+        prompted = bool(prompt_re.search(t))
+        if any(err in t for err in ["непредвиденная ошибка", "ошибка", "что-то пошло не так", "повторите позже"]):
+            return "error"
+        if (
+            "распознан" in t
+            or "воспользуйтесь кнопками" in t
+            or "полная начинка" in t
+            or ("товар" in t and "законч" in t)
+            or "добавить в избранное" in t
+        ):
+            return "retry"
+        return "qty_prompt" if prompted else "neutral"
+
+    classifier = BotTextClassifier(DEFAULT_BOT_PHRASES)
+    n = 2_000
+    console.print(
+        "[bold]text[/] — класс ответа бота, нс на сообщение; × — во сколько раз быстрее прежних проверок"
+        " (меньше 1 — медленнее): новый текст одним проходом и повтор текста из кэша"
+    )
+    for t in BENCH_BOT_TEXTS:
+        assert legacy(t) == classifier.classify(t), t
+        old_ns = _bench_ns_per_op(lambda k: [legacy(t) for _ in range(k)], n)
+        cold_ns = _bench_ns_per_op(lambda k: [classifier.classify_uncached(t) for _ in range(k)], n)
+        warm_ns = _bench_ns_per_op(lambda k: [classifier.classify(t) for _ in range(k)], n)
+        console.print(
+            f"  {classifier.classify(t):<10} ({len(t):3d} симв.)  прежний {old_ns:6.0f}"
+            f"  один проход {cold_ns:6.0f} (×{old_ns / max(cold_ns, 1e-9):.2f})"
+            f"  из кэша {warm_ns:4.0f} (×{old_ns / max(warm_ns, 1e-9):.1f})"
+        )
+
+
+@benchmark("playbook")
+def _bench_playbook() -> None:
+    """План разметки: классификация против отпечатка экрана и поиска в плейбуке."""
+    classifier = ButtonClassifier(("USDT", "LTC"), _is_own_qty_label)
+    book = MarkupPlaybook(Path(os.devnull), "USDT,LTC")
+    n = 5_000
+    console.print("[bold]playbook[/] — мкс на экран")
+    for screen, rows in BENCH_MARKUPS.items():
+        markup = _bench_markup(rows)
+        book.put(MarkupPlaybook.fingerprint(markup), "5", classifier.classify(markup, "5"))
+        cls_ns = _bench_ns_per_op(lambda k: [classifier.classify(markup, "5") for _ in range(k)], n)
+        hit_ns = _bench_ns_per_op(lambda k: [book.get(MarkupPlaybook.fingerprint(markup), "5") for _ in range(k)], n)
+        console.print(
+            f"  {screen:<8} классификация {cls_ns / 1000:6.2f}  плейбук {hit_ns / 1000:6.2f}"
+            f"  ×{cls_ns / max(hit_ns, 1e-9):.1f}"
+        )
+
+
+@benchmark("sim")
+def _bench_sim() -> None:
+    """Сквозной _orchestrate_attempts на симуляторе: время от старта до нажатия оплаты (виртуальное)."""
+    console.print("[bold]sim[/] — от старта попытки до нажатия оплаты, мс виртуального времени")
+    for scenario in SIM_SCENARIOS:
+        r = run_sim_scenario(scenario)
+        h = r["to_pay"]
+        if h.count:
+            dist = (
+                f"p50 {h.percentile(50) / 1e6:6.0f}  p90 {h.percentile(90) / 1e6:6.0f}"
+                f"  p99 {h.percentile(99) / 1e6:6.0f}  max {h.max / 1e6:6.0f}"
+            )
+        else:
+            dist = f"оплаты нет, вышли через {r['elapsed']:.0f} с"
+        console.print(
+            f"  {scenario.name:<19} n={scenario.runs:<3} успех {r['paid'] * 100:3.0f}%"
+            f" (по покупателю {r['claimed'] * 100:3.0f}%)  {dist}"
+            f"  попыток {r['attempts']:.1f}  RPC {r['rpc']:.0f}  ({r['real_ms']:.0f} мс/прогон)"
+        )
+
+
+@benchmark("batch")
+def _bench_batch() -> None:
+    """BATCH_SEND против последовательной и конвейерной отправки на симуляторе.
+
+    Магазин-бот симулятора не принимает число до промпта, так что контейнер
+    /start+число здесь не выигрывает — он лишь проверяет, что отказ не рвёт попытку.
+    """
+    console.print("[bold]batch[/] — от старта попытки до нажатия оплаты, мс виртуального времени")
+    modes = [
+        ("последовательно", {}),
+        ("PIPELINE_QTY", {"PIPELINE_QTY": True}),
+        ("PIPELINE+BATCH", {"PIPELINE_QTY": True, "BATCH_SEND": True}),
+        ("PREEMPTIVE+BATCH", {"PREEMPTIVE_QTY": True, "BATCH_SEND": True}),
+    ]
+    by_name = {scenario.name: scenario for scenario in SIM_SCENARIOS}
+    # laggy_rate_limit — /start чаще ответа бота и FloodWait: здесь поздний /start мог сбросить пачку
+    for base in (by_name["fast"], by_name["slow"], by_name["laggy_rate_limit"]):
+        sequential_paid = None
+        for label, overrides in modes:
+            scenario = SimScenario(**{**base.__dict__, "overrides": {**base.overrides, **overrides}})
+            r = run_sim_scenario(scenario)
+            h = r["to_pay"]
+            dist = (
+                f"p50 {h.percentile(50) / 1e6:6.0f}  p90 {h.percentile(90) / 1e6:6.0f}"
+                if h.count else "оплаты нет"
+            )
+            console.print(
+                f"  {base.name:<16} {label:<17} успех {r['paid'] * 100:3.0f}%"
+                f" (по покупателю {r['claimed'] * 100:3.0f}%)  {dist}"
+                f"  RPC {r['rpc']:.1f}  контейнеров {r['containers']:.1f}"
+            )
+            if sequential_paid is None:
+                sequential_paid = h.count
+            elif overrides.get("BATCH_SEND"):
+                assert h.count >= sequential_paid, (
+                    f"{base.name}: {label} оплатил {h.count} из {base.runs}, последовательно {sequential_paid}"
+                )
+
+
+def run_benchmarks(names: List[str]) -> None:
+    selected = names or list(BENCHMARKS)
+    for name in selected:
+        fn = BENCHMARKS.get(name)
+        if fn is None:
+            console.print(f"[red]Неизвестный бенчмарк: {name}. Доступны: {', '.join(BENCHMARKS)}[/]")
+            continue
+        fn()